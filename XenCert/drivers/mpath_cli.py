@@ -17,6 +17,9 @@ import util
 import re
 import exceptions
 import time
+import socket
+import struct
+import threading
 
 class MPathCLIFail(exceptions.Exception):
 	def __init__(self):
@@ -27,11 +30,119 @@ class MPathCLIFail(exceptions.Exception):
 
 mpathcmd = ["multipathd","-k"]
 
-def mpexec(cmd):
+# Control sockets of multipathd, the abstract one first as used by all
+# recent versions
+SOCKET_NAMES = ["\0/org/kernel/linux/storage/multipathd", "/var/run/multipathd.sock"]
+
+# Seconds to wait for multipathd to answer a command
+SOCKET_TIMEOUT = 30
+
+# Seconds before connecting is tried again once it failed, the commands
+# are run through "multipathd -k" meanwhile
+RECONNECT_INTERVAL = 10
+
+# Largest reply accepted from multipathd
+MAX_REPLY = 64 * 1024 * 1024
+
+# Requests and replies are preceded by their length as a native size_t
+LENGTH = struct.Struct("L")
+
+class MPathClient:
+    """Keeps one connection to the multipathd control socket open and
+    speaks its protocol directly, instead of forking "multipathd -k" for
+    every command. A broken connection is reopened once per command;
+    command() returns None when multipathd cannot be reached so that the
+    caller falls back to the command line."""
+    def __init__(self):
+        self.sock = None
+        self.lock = threading.Lock()
+        self.retryAfter = 0
+
+    def connect(self):
+        error = None
+        for name in SOCKET_NAMES:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.settimeout(SOCKET_TIMEOUT)
+                sock.connect(name)
+                self.sock = sock
+                return
+            except socket.error, e:
+                sock.close()
+                error = e
+        raise error
+
+    def close(self):
+        if self.sock != None:
+            self.sock.close()
+            self.sock = None
+
+    def recv_all(self, length):
+        data = ''
+        while len(data) < length:
+            chunk = self.sock.recv(length - len(data))
+            if not chunk:
+                raise socket.error("multipathd closed the connection")
+            data += chunk
+        return data
+
+    def send_command(self, cmd):
+        request = cmd + '\0'
+        self.sock.sendall(LENGTH.pack(len(request)) + request)
+        (length,) = LENGTH.unpack(self.recv_all(LENGTH.size))
+        if length > MAX_REPLY:
+            raise socket.error("reply of %d bytes from multipathd is too large" % length)
+        return self.recv_all(length).rstrip('\0')
+
+    def command(self, cmd):
+        self.lock.acquire()
+        try:
+            for attempt in range(2):
+                try:
+                    if self.sock == None:
+                        if time.time() < self.retryAfter:
+                            return None
+                        try:
+                            self.connect()
+                        except socket.error, e:
+                            util.SMlog("Cannot connect to multipathd socket: %s" % str(e))
+                            self.retryAfter = time.time() + RECONNECT_INTERVAL
+                            return None
+                    return self.send_command(cmd)
+                except (socket.error, struct.error), e:
+                    util.SMlog("multipathd socket command %s failed: %s" % (cmd, str(e)))
+                    self.close()
+            return None
+        finally:
+            self.lock.release()
+
+client = MPathClient()
+
+def strip_prompt(stdout, cmd):
+    # Removes the prompts, and the echoed command of some versions, from
+    # the output of "multipathd -k"
+    lines = stdout.split('\n')[:-1]
+    if len(lines):
+        if lines[0] == "multipathd> " + cmd:
+            lines = lines[1:]
+        else:
+            m=regex2.search(lines[0])
+            if m:
+                lines[0]=str(m.group(2))
+    return '\n'.join(lines)
+
+def mpquery(cmd):
+    """Returns the reply of multipathd to cmd"""
     util.SMlog("mpath cmd: %s" % cmd)
-    (rc,stdout,stderr) = util.doexec(mpathcmd,cmd)
-    if stdout != "multipathd> ok\nmultipathd> " \
-            and stdout != "multipathd> "+cmd+"\nok\nmultipathd> ":
+    reply = client.command(cmd)
+    if reply == None:
+        (rc,stdout,stderr) = util.doexec(mpathcmd,cmd)
+        reply = strip_prompt(stdout, cmd)
+    util.SMlog("mpath output: %s" % reply)
+    return reply
+
+def mpexec(cmd):
+    if mpquery(cmd).strip() != "ok":
         raise MPathCLIFail
 
 def add_path(path):
@@ -57,10 +168,8 @@ regex4 = re.compile("[0-9A-Fa-f]+ dm-[0-9]+ \w+,\w+")
 
 def is_working():
     cmd="help"
-    util.SMlog("mpath cmd: %s" % cmd)
     try:
-        (rc,stdout,stderr) = util.doexec(mpathcmd,cmd)
-	util.SMlog("mpath output: %s" % stdout)
+        stdout = mpquery(cmd)
 	m=regex3.search(stdout)
 	if m:
 	    return True
@@ -70,13 +179,9 @@ def is_working():
         return False
         
 def do_get_topology(cmd):
-    util.SMlog("mpath cmd: %s" % cmd)
-    (rc,stdout,stderr) = util.doexec(mpathcmd,cmd)
-    util.SMlog("mpath output: %s" % stdout)
-    lines = stdout.split('\n')[:-1]
-    if len(lines):
-	    m=regex2.search(lines[0])
-	    lines[0]=str(m.group(2))
+    lines = mpquery(cmd).split('\n')
+    while len(lines) and not lines[-1].strip():
+        lines.pop()
     return lines
 
 def get_topology(scsi_id):
@@ -87,6 +192,79 @@ def get_all_topologies():
     cmd="show topology"
     return do_get_topology(cmd)
 
+# Header line of a map in the topology, e.g.
+# "360a98000... dm-0 NETAPP,LUN", "create: 360a98000... dm-0 NETAPP,LUN"
+# or "mpatha (360a98000...) dm-0 NETAPP,LUN" with user friendly names
+regex_map = re.compile("^(?:[a-z]+: )?(\S+)(?: \((\S+)\))? (dm-[0-9]+) ")
+regex_path = re.compile("([0-9]+:[0-9]+:[0-9]+:[0-9]+.*)$")
+
+# Seconds a topology snapshot is reused before it is fetched again
+TOPOLOGY_MAX_AGE = 1.0
+
+class MapTopology:
+    def __init__(self, scsi_id, devname):
+        self.scsi_id = scsi_id
+        self.devname = devname
+        self.lines = []
+        # (hbtl, device, dm status, path status) of each path
+        self.paths = []
+
+class TopologyIndex:
+    """Snapshot of the topology of every multipath map taken with a single
+    "show topology", indexed by SCSI id and by dm device."""
+    def __init__(self, lines=None):
+        self.maps = {}
+        self.devices = {}
+        self.time = 0
+        if lines != None:
+            self.parse(lines)
+
+    def parse(self, lines):
+        maps = {}
+        devices = {}
+        current = None
+        for line in lines:
+            m = regex_map.search(line)
+            if m:
+                scsi_id = m.group(2) or m.group(1)
+                current = MapTopology(scsi_id, m.group(3))
+                maps[scsi_id] = current
+                devices[current.devname] = current
+            if current == None:
+                continue
+            current.lines.append(line)
+            n = regex_path.search(line)
+            if n:
+                l = n.group(1).split()
+                if len(l) >= 5:
+                    current.paths.append((l[0], l[1], l[3], l[4]))
+        self.maps = maps
+        self.devices = devices
+        self.time = time.time()
+
+    def refresh(self):
+        self.parse(get_all_topologies())
+
+    def get(self, scsi_id):
+        return self.maps.get(scsi_id)
+
+    def get_by_device(self, devname):
+        return self.devices.get(devname)
+
+topology_index = TopologyIndex()
+topology_lock = threading.Lock()
+
+def get_topology_index(max_age=TOPOLOGY_MAX_AGE):
+    """Returns the topology snapshot, refreshed first if it is older than
+    max_age seconds. A max_age of 0 always refreshes it."""
+    topology_lock.acquire()
+    try:
+        if time.time() - topology_index.time >= max_age:
+            topology_index.refresh()
+        return topology_index
+    finally:
+        topology_lock.release()
+
 def list_paths(scsi_id):
     lines = get_topology(scsi_id)
     matches = []
@@ -98,10 +276,8 @@ def list_paths(scsi_id):
 
 def list_maps():
     cmd="list maps"
-    util.SMlog("mpath cmd: %s" % cmd)
-    (rc,stdout,stderr) = util.doexec(mpathcmd,cmd)
-    util.SMlog("mpath output: %s" % stdout)
-    return map(lambda x: x.split(' ')[0], stdout.split('\n')[1:-1])
+    lines = mpquery(cmd).split('\n')[1:]
+    return map(lambda x: x.split(' ')[0], filter(lambda x: x.strip(), lines))
 
 def ensure_map_gone(scsi_id):
     while True:
@@ -115,7 +115,10 @@ def get_path_count(SCSIid, active=True):
     if (mpp_luncheck.is_RdacLun(SCSIid)):
         (total_count, active_count) = mpp_mpathutil.get_pathinfo(SCSIid)
         return (total_count, active_count)
-    lines = mpath_cli.get_topology(SCSIid)
+    lines = []
+    topology = mpath_cli.get_topology_index().get(SCSIid)
+    if topology != None:
+        lines = topology.lines
     for line in filter(match_dmpLUN,lines):
         if not active:
             count += 1
@@ -0,0 +1,96 @@
+#!/usr/bin/python
+#
+# Copyright (C) Inspur Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""ALUA target port group state of the paths of a LUN"""
+import os
+from Logging import XenCertPrint
+
+ACTIVE_OPTIMIZED = 'active/optimized'
+ACTIVE_NON_OPTIMIZED = 'active/non-optimized'
+UNKNOWN = 'unknown'
+
+# States in which a path accepts IO, the others are not benchmarked
+ACTIVE_STATES = [ACTIVE_OPTIMIZED, ACTIVE_NON_OPTIMIZED]
+
+# Designator type of the target port group in the device identification
+# VPD page (0x83)
+DESIGNATOR_TARGET_PORT_GROUP = 0x5
+
+def ReadSysfs(path):
+    try:
+        f = open(path)
+        try:
+            return f.read()
+        finally:
+            f.close()
+    except IOError:
+        return None
+
+def DeviceName(device):
+    # /dev/sdb or sdb -> sdb
+    return os.path.basename(os.path.realpath(device))
+
+def GetAccessState(device):
+    """Returns the ALUA access state of the path as reported by the
+    scsi_dh_alua device handler, or UNKNOWN when it is not attached"""
+    state = ReadSysfs('/sys/block/%s/device/access_state' % DeviceName(device))
+    if state == None or not state.strip():
+        return UNKNOWN
+    return state.strip()
+
+def ParseTargetPortGroup(page):
+    """Returns the target port group id found in a raw device
+    identification VPD page, or None"""
+    if page == None or len(page) < 4:
+        return None
+    end = min(len(page), 4 + ((ord(page[2]) << 8) | ord(page[3])))
+    offset = 4
+    while offset + 4 <= end:
+        designatorType = ord(page[offset + 1]) & 0xf
+        length = ord(page[offset + 3])
+        if designatorType == DESIGNATOR_TARGET_PORT_GROUP and length >= 4 and offset + 8 <= end:
+            return (ord(page[offset + 6]) << 8) | ord(page[offset + 7])
+        offset += 4 + length
+    return None
+
+def GetTargetPortGroup(device):
+    return ParseTargetPortGroup(ReadSysfs('/sys/block/%s/device/vpd_pg83' % DeviceName(device)))
+
+class PortGroup:
+    def __init__(self, group, state):
+        self.group = group
+        self.state = state
+        self.devices = []
+
+    def __str__(self):
+        if self.group == None:
+            return self.state
+        return '%d (%s)' % (self.group, self.state)
+
+def GetPortGroups(devices):
+    """Groups the path devices of a LUN by target port group and access
+    state. Paths whose group id is unknown are grouped by state alone."""
+    groups = {}
+    for device in devices:
+        key = (GetTargetPortGroup(device), GetAccessState(device))
+        if not groups.has_key(key):
+            groups[key] = PortGroup(key[0], key[1])
+        groups[key].devices.append(device)
+    XenCertPrint("ALUA port groups of %s: %s" % (devices, [(str(g), g.devices) for g in groups.values()]))
+    result = groups.values()
+    result.sort(key=lambda g: (ACTIVE_STATES + [g.state]).index(g.state))
+    return result
@@ -0,0 +1,135 @@
+#!/usr/bin/python
+#
+# Copyright (C) Inspur Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""CPU time accounting of the performance workloads"""
+import os
+import time
+import resource
+
+PROC_STAT = '/proc/stat'
+PROC_SOFTIRQS = '/proc/softirqs'
+
+# Columns of the cpu line of /proc/stat, in clock ticks
+CPU_FIELDS = ['user', 'nice', 'system', 'idle', 'iowait', 'irq', 'softirq', 'steal']
+
+# Softirq types which carry storage traffic, block for local completions
+# and the network ones for iSCSI and NFS
+SOFTIRQ_TYPES = ['BLOCK', 'NET_RX', 'NET_TX']
+
+try:
+    CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+except (ValueError, OSError, AttributeError):
+    CLOCK_TICKS = 100
+
+def ReadProcStat():
+    """Returns the system wide cpu line of /proc/stat as a dict of seconds"""
+    times = {}
+    f = open(PROC_STAT)
+    try:
+        for line in f.readlines():
+            fields = line.split()
+            if fields and fields[0] == 'cpu':
+                for i in range(len(CPU_FIELDS)):
+                    value = 0
+                    if i + 1 < len(fields):
+                        value = int(fields[i + 1])
+                    times[CPU_FIELDS[i]] = float(value) / CLOCK_TICKS
+                break
+    finally:
+        f.close()
+    return times
+
+def ReadSoftirqs():
+    """Returns softirq type -> number raised on all CPUs"""
+    counts = {}
+    try:
+        f = open(PROC_SOFTIRQS)
+    except IOError:
+        return counts
+    try:
+        for line in f.readlines()[1:]:
+            fields = line.split()
+            if fields and fields[0].rstrip(':') in SOFTIRQ_TYPES:
+                total = 0
+                for value in fields[1:]:
+                    total += int(value)
+                counts[fields[0].rstrip(':')] = total
+    finally:
+        f.close()
+    return counts
+
+class CPUSnapshot:
+    def __init__(self):
+        self.time = time.time()
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        self.processUser = usage.ru_utime
+        self.processSystem = usage.ru_stime
+        self.system = ReadProcStat()
+        self.softirqs = ReadSoftirqs()
+
+class CPUUsage:
+    """CPU time spent between two snapshots. process* is the time charged to
+    XenCert itself, system* covers every CPU of the host, so it includes the
+    interrupt and softirq work done on behalf of the IO and anything else
+    running in dom0 at the time."""
+    def __init__(self, start, end):
+        self.elapsed = end.time - start.time
+        self.processUser = end.processUser - start.processUser
+        self.processSystem = end.processSystem - start.processSystem
+        self.system = {}
+        for field in CPU_FIELDS:
+            self.system[field] = end.system.get(field, 0.0) - start.system.get(field, 0.0)
+        self.softirqs = {}
+        for name in end.softirqs.keys():
+            self.softirqs[name] = end.softirqs[name] - start.softirqs.get(name, 0)
+
+    def ProcessTime(self):
+        return self.processUser + self.processSystem
+
+    def SystemBusy(self):
+        busy = 0.0
+        for field in CPU_FIELDS:
+            if field not in ['idle', 'iowait', 'steal']:
+                busy += self.system[field]
+        return busy
+
+    def PerIO(self, ios):
+        """Returns (process, system) CPU microseconds per IO"""
+        if ios == 0:
+            return (0.0, 0.0)
+        return (self.ProcessTime() * 1000000 / ios, self.SystemBusy() * 1000000 / ios)
+
+    def PerMB(self, nbytes):
+        """Returns (process, system) CPU microseconds per MB"""
+        if nbytes == 0:
+            return (0.0, 0.0)
+        mb = float(nbytes) / (1024 * 1024)
+        return (self.ProcessTime() * 1000000 / mb, self.SystemBusy() * 1000000 / mb)
+
+    def ToDict(self, ios, nbytes):
+        (processPerIO, systemPerIO) = self.PerIO(ios)
+        (processPerMB, systemPerMB) = self.PerMB(nbytes)
+        return { 'elapsed': self.elapsed,
+                 'process_user_s': self.processUser,
+                 'process_system_s': self.processSystem,
+                 'system_s': self.system,
+                 'system_busy_s': self.SystemBusy(),
+                 'softirqs': self.softirqs,
+                 'process_us_per_io': processPerIO,
+                 'system_us_per_io': systemPerIO,
+                 'process_us_per_mb': processPerMB,
+                 'system_us_per_mb': systemPerMB }
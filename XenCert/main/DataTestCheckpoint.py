@@ -0,0 +1,151 @@
+#!/usr/bin/python
+#
+# Copyright (C) Inspur Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Progress of the data integrity tests, kept so that a run interrupted by
+a session drop can resume instead of starting over"""
+import os
+import glob
+import json
+import time
+from threading import Lock
+from Logging import XenCertPrint
+
+CHECKPOINT_DIR = '/var/tmp/xencert-checkpoints'
+
+# Seed, sample, iteration and outcome of the path IO tests of the run
+RUN_FILE = os.path.join(CHECKPOINT_DIR, 'run.json')
+
+runLock = Lock()
+
+def CheckpointFile(SCSIid, action, device=None):
+    """diskdatatest checkpoint of the write of a LUN, which goes through
+    any of its paths, or of its verify through device"""
+    if action == 'verify':
+        return os.path.join(CHECKPOINT_DIR, '%s-%s-verify' % (SCSIid, os.path.basename(device)))
+    return os.path.join(CHECKPOINT_DIR, '%s-write' % SCSIid)
+
+def Clear(SCSIid=None):
+    """Removes the checkpoints of a LUN, or of the whole run"""
+    if SCSIid == None:
+        paths = glob.glob(os.path.join(CHECKPOINT_DIR, '*'))
+    else:
+        paths = glob.glob(os.path.join(CHECKPOINT_DIR, SCSIid + '-*'))
+    for path in paths:
+        try:
+            os.unlink(path)
+        except OSError, e:
+            XenCertPrint("Failed to remove the checkpoint %s: %s" % (path, str(e)))
+
+class DataTestRun:
+    """State of a run of the data tests saved to RUN_FILE. pathIO maps
+    SCSI id -> device -> None when the path IO test passed, else the error"""
+    def __init__(self, sample, seed, iteration=1, pathIO=None):
+        self.sample = sample
+        self.seed = seed
+        self.iteration = iteration
+        if pathIO == None:
+            pathIO = {}
+        self.pathIO = pathIO
+
+    def PathIOResult(self, SCSIid, device):
+        """Returns (done, error) of the path IO test of device"""
+        results = self.pathIO.get(SCSIid, {})
+        if not results.has_key(device):
+            return (False, None)
+        return (True, results[device])
+
+    def RecordPathIO(self, SCSIid, device, error):
+        runLock.acquire()
+        try:
+            self.pathIO.setdefault(SCSIid, {})[device] = error
+        finally:
+            runLock.release()
+
+    def Save(self):
+        runLock.acquire()
+        try:
+            try:
+                if not os.path.isdir(CHECKPOINT_DIR):
+                    os.makedirs(CHECKPOINT_DIR)
+                # Replaced atomically, a crash leaves the previous state
+                f = open(RUN_FILE + '.tmp', 'w')
+                try:
+                    json.dump({ 'sample': self.sample,
+                                'seed': self.seed,
+                                'iteration': self.iteration,
+                                'pathio': self.pathIO }, f)
+                finally:
+                    f.close()
+                os.rename(RUN_FILE + '.tmp', RUN_FILE)
+            except (IOError, OSError), e:
+                XenCertPrint("Failed to save the data test run %s: %s" % (RUN_FILE, str(e)))
+        finally:
+            runLock.release()
+
+def Load():
+    try:
+        f = open(RUN_FILE)
+        try:
+            run = json.load(f)
+        finally:
+            f.close()
+        return DataTestRun(run['sample'], run['seed'], run['iteration'], run['pathio'])
+    except (IOError, ValueError, KeyError, TypeError):
+        return None
+
+def Progress(path):
+    """Returns (chunks done, complete) according to a diskdatatest
+    checkpoint, (0, False) when there is none"""
+    try:
+        f = open(path)
+        try:
+            lines = f.read().split('\n')
+        finally:
+            f.close()
+    except IOError:
+        return (0, False)
+    # The magic and the key of the run come first
+    done = 0
+    for line in lines[2:]:
+        if line.isdigit():
+            done += int(line)
+    return (done, 'complete' in lines[2:])
+
+def Resumable(sample):
+    """Returns the run interrupted earlier with the same sample, if any"""
+    run = Load()
+    if run != None and run.sample == sample:
+        return run
+    return None
+
+def Start(sample, seed, resume):
+    """Returns the DataTestRun to go on with. With resume, this is the run
+    interrupted earlier with the same sample, if any. Otherwise the old
+    checkpoints are cleared and a new run starts with seed."""
+    if resume:
+        run = Resumable(sample)
+        if run != None:
+            XenCertPrint("Resuming the data test run of %s: sample %s, seed %s, iteration %s" %
+                         (RUN_FILE, run.sample, run.seed, run.iteration))
+            return run
+        XenCertPrint("No data test run with sample %s to resume in %s, starting over." % (sample, RUN_FILE))
+    Clear()
+    # A new generation every run: sectors left over by an earlier run are
+    # then reported as stale
+    run = DataTestRun(sample, seed, int(time.time()))
+    run.Save()
+    return run
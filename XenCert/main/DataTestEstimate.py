@@ -0,0 +1,249 @@
+#!/usr/bin/python
+#
+# Copyright (C) Inspur Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Run time estimate of the data integrity tests from the throughput of
+each LUN, measured with a short burst or remembered from earlier runs"""
+import io
+import os
+import json
+import math
+import time
+from threading import Lock
+import WorkerPool
+from Logging import XenCertPrint
+from IOEngine import MiB, AllocBuffer, OpenTarget, GetTargetSize
+from PerfStats import MeanAndCV
+
+# Throughput of each LUN, by SCSI id, kept across runs
+CACHE_FILE = '/var/tmp/xencert-throughput.json'
+
+# Seconds a remembered throughput is trusted
+CACHE_MAX_AGE = 30 * 24 * 3600
+
+# The burst is made of BURST_IOS IOs of BURST_IO_SIZE spread evenly over
+# the LUN and issued by BURST_WORKERS threads, as diskdatatest does
+BURST_IOS = 32
+BURST_IO_SIZE = 4 * MiB
+BURST_WORKERS = 4
+
+# Relative uncertainty never assumed lower than this for a burst, which
+# is too short to see the array cache fill up, nor for a remembered
+# throughput, which varies from run to run
+MIN_UNCERTAINTY = 0.2
+CACHED_UNCERTAINTY = 0.1
+
+# A LUN whose data must not be overwritten is only measured reading, and
+# its write throughput taken as the read one give or take this much
+READ_ONLY_UNCERTAINTY = 0.5
+
+cacheLock = Lock()
+
+def LoadCache():
+    try:
+        f = open(CACHE_FILE)
+        try:
+            return json.load(f)
+        finally:
+            f.close()
+    except (IOError, ValueError):
+        return {}
+
+def SaveCache(cache):
+    try:
+        f = open(CACHE_FILE, 'w')
+        try:
+            json.dump(cache, f)
+        finally:
+            f.close()
+    except IOError, e:
+        XenCertPrint("Failed to save the LUN throughput cache %s: %s" % (CACHE_FILE, str(e)))
+
+class Throughput:
+    """Write and read MB/s of a LUN and their relative uncertainty"""
+    def __init__(self, write, read, uncertainty, source, when=None):
+        self.write = write
+        self.read = read
+        self.uncertainty = uncertainty
+        self.source = source
+        if when == None:
+            when = time.time()
+        self.time = when
+
+    def ToDict(self):
+        return { 'write_mbs': self.write,
+                 'read_mbs': self.read,
+                 'uncertainty': self.uncertainty,
+                 'source': self.source,
+                 'time': self.time }
+
+def CachedThroughput(scsiid, maxAge=CACHE_MAX_AGE):
+    cacheLock.acquire()
+    try:
+        entry = LoadCache().get(scsiid)
+    finally:
+        cacheLock.release()
+    if entry == None or time.time() - entry.get('time', 0) > maxAge:
+        return None
+    if entry.get('write_mbs', 0) <= 0 or entry.get('read_mbs', 0) <= 0:
+        return None
+    return Throughput(entry['write_mbs'], entry['read_mbs'], entry.get('uncertainty', CACHED_UNCERTAINTY),
+                      'cached', entry['time'])
+
+def RecordThroughput(scsiid, write=None, read=None):
+    """Remembers the MB/s diskdatatest actually achieved on a LUN"""
+    cacheLock.acquire()
+    try:
+        cache = LoadCache()
+        entry = cache.get(scsiid, {})
+        if write:
+            entry['write_mbs'] = write
+        if read:
+            entry['read_mbs'] = read
+        entry['uncertainty'] = CACHED_UNCERTAINTY
+        entry['source'] = 'diskdatatest'
+        entry['time'] = time.time()
+        cache[scsiid] = entry
+        SaveCache(cache)
+    finally:
+        cacheLock.release()
+
+def BurstIO(device, offsets, write):
+    # Returns the latency of each IO
+    buf = AllocBuffer(BURST_IO_SIZE)
+    fd = OpenTarget(device)
+    f = io.FileIO(fd, 'r+', closefd=False)
+    latencies = []
+    try:
+        for offset in offsets:
+            os.lseek(fd, offset, 0)
+            start = time.time()
+            if write:
+                done = f.write(buf)
+            else:
+                done = f.readinto(buf)
+            if done != BURST_IO_SIZE:
+                raise Exception("Short IO of %s bytes at offset %d of %s" % (done, offset, device))
+            latencies.append(time.time() - start)
+        if write:
+            os.fsync(fd)
+    finally:
+        f.close()
+        os.close(fd)
+        buf.close()
+    return latencies
+
+def MeasureBurst(device, write):
+    """Returns (MB/s, relative uncertainty) of a burst of writes or reads
+    spread over device"""
+    chunks = GetTargetSize(device) / BURST_IO_SIZE
+    if chunks == 0:
+        raise Exception("Device %s is smaller than %d bytes." % (device, BURST_IO_SIZE))
+    ios = min(BURST_IOS, chunks)
+    offsets = [(i * chunks / ios) * BURST_IO_SIZE for i in range(ios)]
+    pool = WorkerPool.WorkerPool(BURST_WORKERS, 0)
+    for i in range(BURST_WORKERS):
+        pool.Add(i, BurstIO, (device, offsets[i::BURST_WORKERS], write))
+    started = time.time()
+    latencies = []
+    for job in pool.Run():
+        if job.exception != None:
+            raise job.exception
+        latencies.extend(job.result)
+    elapsed = time.time() - started
+    # 95% confidence interval of the mean IO time
+    (mean, cv) = MeanAndCV(latencies)
+    uncertainty = max(MIN_UNCERTAINTY, 2 * cv / math.sqrt(len(latencies)))
+    return (float(ios) * BURST_IO_SIZE / MiB / max(elapsed, 0.001), uncertainty)
+
+def GetThroughput(scsiid, device, readOnly=False):
+    """Returns the Throughput of a LUN, remembered from an earlier run or
+    measured with a burst through device. With readOnly nothing is written
+    to device and the read burst stands for the write throughput too."""
+    throughput = CachedThroughput(scsiid)
+    if throughput != None:
+        XenCertPrint("Using the throughput of %s remembered from %s: %s" % (scsiid, time.ctime(throughput.time), throughput.ToDict()))
+        return throughput
+    if readOnly:
+        (read, readUncertainty) = MeasureBurst(device, False)
+        throughput = Throughput(read, read, max(READ_ONLY_UNCERTAINTY, readUncertainty), 'read burst')
+        XenCertPrint("Measured the read throughput of %s through %s: %s" % (scsiid, device, throughput.ToDict()))
+        return throughput
+    (write, writeUncertainty) = MeasureBurst(device, True)
+    (read, readUncertainty) = MeasureBurst(device, False)
+    throughput = Throughput(write, read, max(writeUncertainty, readUncertainty), 'burst')
+    XenCertPrint("Measured the throughput of %s through %s: %s" % (scsiid, device, throughput.ToDict()))
+    cacheLock.acquire()
+    try:
+        cache = LoadCache()
+        cache[scsiid] = throughput.ToDict()
+        SaveCache(cache)
+    finally:
+        cacheLock.release()
+    return throughput
+
+def GetThroughputs(lunDevices, workers=WorkerPool.DEFAULT_WORKERS, readOnly=False):
+    """Gets the Throughput of all the LUNs at once. lunDevices maps SCSI id
+    -> device to measure through. Returns SCSI id -> Throughput, without
+    the LUNs which could not be measured."""
+    pool = WorkerPool.WorkerPool(workers, 0)
+    for scsiid in lunDevices.keys():
+        pool.Add(scsiid, GetThroughput, (scsiid, lunDevices[scsiid], readOnly))
+    throughputs = {}
+    for job in pool.Run():
+        if job.exception == None:
+            throughputs[job.key] = job.result
+        else:
+            XenCertPrint("Failed to measure the throughput of %s: %s" % (job.key, str(job.exception)))
+    return throughputs
+
+def ProjectTime(lunWrites, throughputs, workers, lunVerifies=None, groupLimit=0):
+    """Projects the seconds taken to write lunWrites (SCSI id -> MiB left to
+    write) once per LUN and then verify them, with up to workers paths
+    tested at once. lunVerifies maps SCSI id -> (MiB left to verify, groups)
+    of each path the LUN is verified through, one verify of all it writes
+    when missing; no more than groupLimit of them run at once per HBA or
+    portal. Returns (expected, low, high) where low and high follow from
+    the uncertainty of each throughput."""
+    if lunVerifies == None:
+        lunVerifies = {}
+    def project(scale):
+        writes = []
+        verifies = []
+        groupSeconds = {}
+        for scsiid in lunWrites.keys():
+            throughput = throughputs[scsiid]
+            # A throughput is never taken below a tenth of its estimate
+            factor = max(0.1, 1 + scale * throughput.uncertainty)
+            writes.append(lunWrites[scsiid] / max(throughput.write * factor, 0.001))
+            # The verifies of a LUN share its read bandwidth, and each one
+            # takes at least its own reads off a worker and its groups
+            seconds = 0
+            for (size, groups) in lunVerifies.get(scsiid) or [(lunWrites[scsiid], [])]:
+                read = size / max(throughput.read * factor, 0.001)
+                seconds += read
+                for group in groups:
+                    groupSeconds[group] = groupSeconds.get(group, 0) + read
+            verifies.append(seconds)
+        if not writes:
+            return 0
+        # The verifies start once every write is done
+        seconds = max(max(writes), sum(writes) / min(workers, len(writes)))
+        verifySeconds = max(max(verifies), sum(verifies) / workers)
+        if groupLimit and groupSeconds:
+            verifySeconds = max(verifySeconds, max(groupSeconds.values()) / groupLimit)
+        return seconds + verifySeconds
+    return (project(0), project(1), project(-1))
@@ -0,0 +1,179 @@
+#!/usr/bin/python
+#
+# Copyright (C) Inspur Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Background sampler of the block layer statistics seen during a test phase"""
+import os
+import time
+from threading import Thread, Event
+from Logging import Print, PrintY, XenCertPrint
+import PerfReport
+
+DISKSTATS = '/proc/diskstats'
+SYS_BLOCK = '/sys/block'
+
+# Seconds between two samples
+DEFAULT_INTERVAL = 1.0
+
+# Field positions of the counters of a device in /proc/diskstats, after
+# its major, minor and name
+RD_IOS, RD_MERGES, RD_SECTORS, RD_TICKS, WR_IOS, WR_MERGES, WR_SECTORS, WR_TICKS, IN_FLIGHT, IO_TICKS, TIME_IN_QUEUE = range(11)
+
+SECTOR = 512
+
+def ReadDiskStats():
+    """Returns device name -> list of the counters of /proc/diskstats"""
+    stats = {}
+    f = open(DISKSTATS)
+    try:
+        for line in f.readlines():
+            fields = line.split()
+            if len(fields) < 14:
+                continue
+            stats[fields[2]] = [int(x) for x in fields[3:14]]
+    finally:
+        f.close()
+    return stats
+
+def GetSlaves(device):
+    """Returns the devices underneath a device mapper device, e.g. the paths
+    of a multipath map."""
+    try:
+        return sorted(os.listdir(os.path.join(SYS_BLOCK, device, 'slaves')))
+    except OSError:
+        return []
+
+def Derive(previous, current, interval):
+    """Derives iostat style metrics from two samples of one device taken
+    interval seconds apart."""
+    delta = []
+    for i in range(len(current)):
+        delta.append(current[i] - previous[i])
+    ios = delta[RD_IOS] + delta[WR_IOS]
+    await = 0.0
+    if ios > 0:
+        await = float(delta[RD_TICKS] + delta[WR_TICKS]) / ios
+    return { 'r/s': delta[RD_IOS] / interval,
+             'w/s': delta[WR_IOS] / interval,
+             'rMB/s': float(delta[RD_SECTORS]) * SECTOR / (1024 * 1024) / interval,
+             'wMB/s': float(delta[WR_SECTORS]) * SECTOR / (1024 * 1024) / interval,
+             'rrqm/s': delta[RD_MERGES] / interval,
+             'wrqm/s': delta[WR_MERGES] / interval,
+             'await': await,
+             'avgqu-sz': delta[TIME_IN_QUEUE] / (interval * 1000),
+             'util': min(100.0, delta[IO_TICKS] / (interval * 10)) }
+
+COLUMNS = ['r/s', 'w/s', 'rMB/s', 'wMB/s', 'rrqm/s', 'wrqm/s', 'await', 'avgqu-sz', 'util']
+
+class DiskStatsSampler(Thread):
+    """Samples the block layer counters of every device of /proc/diskstats
+    every interval seconds until stopped. The devices under test are only
+    known once a phase has discovered them, so none is left out; the slave
+    paths of the dm devices are looked up in /sys/block when displayed."""
+    def __init__(self, interval=DEFAULT_INTERVAL):
+        Thread.__init__(self)
+        self.setDaemon(True)
+        self.interval = interval
+        self.stopEvent = Event()
+        # List of (timestamp, device -> metrics) for each interval
+        self.series = []
+
+    def run(self):
+        try:
+            previous = ReadDiskStats()
+            previousTime = time.time()
+            while not self.stopEvent.isSet():
+                self.stopEvent.wait(self.interval)
+                current = ReadDiskStats()
+                now = time.time()
+                elapsed = now - previousTime
+                metrics = {}
+                for device in current.keys():
+                    if not previous.has_key(device):
+                        continue
+                    # Only devices which saw IO are kept
+                    if current[device][RD_IOS] == previous[device][RD_IOS] and \
+                            current[device][WR_IOS] == previous[device][WR_IOS] and \
+                            current[device][IN_FLIGHT] == 0:
+                        continue
+                    metrics[device] = Derive(previous[device], current[device], elapsed)
+                self.series.append((now, metrics))
+                previous = current
+                previousTime = now
+        except Exception, e:
+            XenCertPrint("Disk statistics sampler stopped: %s" % str(e))
+
+    def Stop(self):
+        self.stopEvent.set()
+        self.join()
+
+    def Summary(self):
+        """Returns device -> average of each metric over the intervals the
+        device was busy in"""
+        totals = {}
+        counts = {}
+        for (timestamp, metrics) in self.series:
+            for device in metrics.keys():
+                if not totals.has_key(device):
+                    totals[device] = dict([(column, 0.0) for column in COLUMNS])
+                    counts[device] = 0
+                for column in COLUMNS:
+                    totals[device][column] += metrics[device][column]
+                counts[device] += 1
+        for device in totals.keys():
+            for column in COLUMNS:
+                totals[device][column] /= counts[device]
+        return totals
+
+def StartSampler(interval=DEFAULT_INTERVAL):
+    sampler = DiskStatsSampler(interval)
+    sampler.start()
+    return sampler
+
+def StopSampler(sampler, phase):
+    """Stops the sampler, displays the per device summary with device mapper
+    devices followed by their slave paths and attaches the time series to
+    the run report."""
+    sampler.Stop()
+    summary = sampler.Summary()
+    if len(summary) == 0:
+        return summary
+
+    PrintY("BLOCK LAYER STATISTICS DURING %s" % phase.upper())
+    Print("   %-12s" % 'Device' + ''.join(['%10s' % column for column in COLUMNS]))
+    shown = {}
+    devices = sorted(summary.keys())
+    for device in devices:
+        if not device.startswith('dm-'):
+            continue
+        Print("   %-12s" % device + ''.join(['%10.2f' % summary[device][column] for column in COLUMNS]))
+        shown[device] = True
+        for slave in GetSlaves(device):
+            if summary.has_key(slave):
+                Print("     %-10s" % slave + ''.join(['%10.2f' % summary[slave][column] for column in COLUMNS]))
+                shown[slave] = True
+    for device in devices:
+        if not shown.has_key(device):
+            Print("   %-12s" % device + ''.join(['%10.2f' % summary[device][column] for column in COLUMNS]))
+
+    series = []
+    for (timestamp, metrics) in sampler.series:
+        series.append({ 'time': timestamp, 'devices': metrics })
+    PerfReport.AddRecord('diskstats', { 'phase': phase,
+                                        'interval': sampler.interval,
+                                        'summary': summary,
+                                        'series': series })
+    return summary
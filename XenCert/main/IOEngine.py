@@ -0,0 +1,551 @@
+#!/usr/bin/python
+#
+# Copyright (C) Inspur Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Native I/O engine used by the storage performance tests"""
+import os
+import io
+import mmap
+import errno
+import random
+import time
+from threading import Thread
+from Logging import XenCertPrint
+from PerfStats import LatencyHistogram, FindSteadyState
+from CPUStats import CPUSnapshot, CPUUsage
+
+KiB = 1024
+MiB = KiB * KiB
+GiB = KiB * KiB * KiB
+
+O_DIRECT = getattr(os, 'O_DIRECT', 040000)
+
+SEQREAD = 'seqread'
+SEQWRITE = 'seqwrite'
+RANDREAD = 'randread'
+RANDWRITE = 'randwrite'
+WORKLOADS = [SEQREAD, SEQWRITE, RANDREAD, RANDWRITE]
+
+DEFAULT_BLOCK_SIZE = { SEQREAD: MiB,
+                       SEQWRITE: MiB,
+                       RANDREAD: 4 * KiB,
+                       RANDWRITE: 4 * KiB }
+
+# Seconds each workload runs for when no duration is given
+DEFAULT_DURATION = 10
+
+# Seconds of IO at the start of each workload which are not measured, to
+# keep the controller cache burst out of the results
+DEFAULT_WARMUP = 0
+
+# Throughput is sampled at this interval (seconds) to detect steady state
+SAMPLE_INTERVAL = 1.0
+
+# Size of the test file created on file system targets
+DEFAULT_FILE_SIZE = GiB
+
+# Outstanding I/O depths visited by the queue depth sweep
+DEFAULT_DEPTHS = [1, 2, 4, 8, 16, 32, 64, 128]
+
+# Block sizes visited by the block size sweep
+DEFAULT_SWEEP_BLOCK_SIZES = [4 * KiB, 8 * KiB, 16 * KiB, 64 * KiB, 256 * KiB, MiB, 4 * MiB]
+
+# Random data the write buffers are cut from, large enough for the
+# biggest block size and for every 4K chunk written to look unique.
+POOL_SIZE = 32 * MiB
+
+# Largest block size written, each write copies a block from a random
+# offset of the pool
+MAX_BLOCK_SIZE = POOL_SIZE / 2
+
+# Blocks repeated over and over to reach a dedupe ratio above 1
+POOL_DUPLICATE_BLOCKS = 16
+
+# Granularity at which arrays compress and dedupe
+POOL_CHUNK = 4 * KiB
+
+# A deeper queue has stopped scaling once it adds less than this
+# fraction of throughput over the previous depth.
+SCALING_THRESHOLD = 0.10
+
+def ParseSize(value):
+    """Converts a size such as 4K, 1M or 4096 into bytes"""
+    value = str(value).strip().upper()
+    if value.endswith('B'):
+        value = value[:-1]
+    units = { 'K': KiB, 'M': MiB, 'G': GiB }
+    try:
+        if value and value[-1] in units:
+            return int(value[:-1]) * units[value[-1]]
+        return int(value)
+    except ValueError:
+        raise Exception("Invalid size: %s" % value)
+
+def CheckBlockSize(size):
+    if size < 512 or size > MAX_BLOCK_SIZE:
+        raise Exception("Invalid block size %s, must be 512 bytes to %s" % (FormatSize(size), FormatSize(MAX_BLOCK_SIZE)))
+
+def FormatSize(size):
+    for (unit, factor) in (('G', GiB), ('M', MiB), ('K', KiB)):
+        if size >= factor and size % factor == 0:
+            return "%d%s" % (size / factor, unit)
+    return str(size)
+
+def ParseDepths(spec):
+    if not spec:
+        return list(DEFAULT_DEPTHS)
+    depths = []
+    for item in str(spec).split(','):
+        if item.strip():
+            try:
+                depth = int(item)
+            except ValueError:
+                depth = 0
+            if depth < 1:
+                raise Exception("Invalid IO depth: %s" % item.strip())
+            depths.append(depth)
+    return depths
+
+def ParseBlockSizes(spec):
+    if not spec:
+        return list(DEFAULT_SWEEP_BLOCK_SIZES)
+    blocksizes = []
+    for item in str(spec).split(','):
+        if item.strip():
+            blocksizes.append(ParseSize(item))
+    return blocksizes
+
+class Workload:
+    def __init__(self, name, blocksize=None, duration=DEFAULT_DURATION, warmup=DEFAULT_WARMUP):
+        if name not in WORKLOADS:
+            raise Exception("Unsupported workload %s, %s only" % (name, ', '.join(WORKLOADS)))
+        self.name = name
+        if blocksize == None:
+            blocksize = DEFAULT_BLOCK_SIZE[name]
+        self.blocksize = blocksize
+        self.duration = duration
+        self.warmup = warmup
+        self.read = name in (SEQREAD, RANDREAD)
+        self.random = name in (RANDREAD, RANDWRITE)
+
+    def __str__(self):
+        return "%s/%s" % (self.name, FormatSize(self.blocksize))
+
+def ParseWorkloads(spec, blocksize=None, duration=DEFAULT_DURATION, warmup=DEFAULT_WARMUP):
+    """Builds the workload list from a string like 'seqread,randwrite:8K'.
+    A block size given per workload wins over the common one."""
+    workloads = []
+    if not spec:
+        spec = ','.join(WORKLOADS)
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        bs = blocksize
+        if ':' in item:
+            (item, bs) = item.split(':', 1)
+            bs = ParseSize(bs)
+        workloads.append(Workload(item, bs, duration, warmup))
+    return workloads
+
+class WorkloadResult:
+    def __init__(self, workload, target):
+        self.workload = workload
+        self.target = target
+        self.depth = 1
+        self.bytes = 0
+        self.ios = 0
+        self.errors = 0
+        self.elapsed = 0.0
+        self.latencyTotal = 0.0
+        self.latencyMin = None
+        self.latencyMax = 0.0
+        self.histogram = LatencyHistogram()
+        # Bytes completed in each SAMPLE_INTERVAL of the measured period
+        self.samples = []
+        # CPUUsage of the measured period
+        self.cpu = None
+
+    def Record(self, nbytes, latency, offset=None):
+        if offset != None:
+            interval = int(offset / SAMPLE_INTERVAL)
+            while len(self.samples) <= interval:
+                self.samples.append(0)
+            self.samples[interval] += nbytes
+        self.bytes += nbytes
+        self.ios += 1
+        self.latencyTotal += latency
+        self.histogram.Record(latency)
+        if self.latencyMin == None or latency < self.latencyMin:
+            self.latencyMin = latency
+        if latency > self.latencyMax:
+            self.latencyMax = latency
+
+    def Merge(self, other):
+        self.bytes += other.bytes
+        self.ios += other.ios
+        self.errors += other.errors
+        self.latencyTotal += other.latencyTotal
+        self.histogram.Merge(other.histogram)
+        while len(self.samples) < len(other.samples):
+            self.samples.append(0)
+        for i in range(len(other.samples)):
+            self.samples[i] += other.samples[i]
+        if self.latencyMin == None or (other.latencyMin != None and other.latencyMin < self.latencyMin):
+            self.latencyMin = other.latencyMin
+        if other.latencyMax > self.latencyMax:
+            self.latencyMax = other.latencyMax
+        if other.elapsed > self.elapsed:
+            self.elapsed = other.elapsed
+
+    def Throughput(self):
+        # MB/s
+        if self.elapsed <= 0:
+            return 0.0
+        return float(self.bytes) / MiB / self.elapsed
+
+    def IOPS(self):
+        if self.elapsed <= 0:
+            return 0.0
+        return self.ios / self.elapsed
+
+    def AverageLatency(self):
+        # milliseconds
+        if self.ios == 0:
+            return 0.0
+        return self.latencyTotal * 1000 / self.ios
+
+    def SteadyStateDict(self):
+        (start, throughput, cv) = self.SteadyState()
+        return { 'reached': start != None,
+                 'start': start,
+                 'throughput_mbs': throughput,
+                 'cv': cv }
+
+    def ThroughputSamples(self):
+        """MB/s of each complete sample interval"""
+        complete = int(self.elapsed / SAMPLE_INTERVAL)
+        samples = []
+        for nbytes in self.samples[:complete]:
+            samples.append(float(nbytes) / MiB / SAMPLE_INTERVAL)
+        return samples
+
+    def SteadyState(self):
+        """Returns (start, throughput, cv) where start is the offset in
+        seconds from which throughput stayed steady, or (None, 0, 0)."""
+        samples = self.ThroughputSamples()
+        (index, mean, cv) = FindSteadyState(samples)
+        if index == None:
+            return (None, 0.0, 0.0)
+        return (index * SAMPLE_INTERVAL, mean, cv)
+
+    def CPUPerIO(self):
+        """Returns (process, system) CPU microseconds per IO"""
+        if self.cpu == None:
+            return (0.0, 0.0)
+        return self.cpu.PerIO(self.ios)
+
+    def CPUPerMB(self):
+        """Returns (process, system) CPU microseconds per MB"""
+        if self.cpu == None:
+            return (0.0, 0.0)
+        return self.cpu.PerMB(self.bytes)
+
+    def ToDict(self):
+        cpu = None
+        if self.cpu != None:
+            cpu = self.cpu.ToDict(self.ios, self.bytes)
+        return { 'target': self.target,
+                 'workload': self.workload.name,
+                 'blocksize': self.workload.blocksize,
+                 'depth': self.depth,
+                 'duration': self.elapsed,
+                 'bytes': self.bytes,
+                 'ios': self.ios,
+                 'errors': self.errors,
+                 'throughput_mbs': self.Throughput(),
+                 'iops': self.IOPS(),
+                 'latency_avg_ms': self.AverageLatency(),
+                 'latency_max_ms': self.latencyMax * 1000,
+                 'warmup': self.workload.warmup,
+                 'throughput_samples_mbs': self.ThroughputSamples(),
+                 'steady_state': self.SteadyStateDict(),
+                 'latency_percentiles_ms': self.histogram.Summary(),
+                 'latency_histogram_ms': self.histogram.Buckets(),
+                 'cpu': cpu }
+
+def AllocBuffer(size):
+    # Anonymous maps are page aligned which is what O_DIRECT needs.
+    return mmap.mmap(-1, size)
+
+def GetTargetSize(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return os.lseek(fd, 0, 2)
+    finally:
+        os.close(fd)
+
+def OpenTarget(path, direct=True, create=False):
+    """Opens path for read/write, with O_DIRECT where the target supports it"""
+    flags = os.O_RDWR
+    if create:
+        flags |= os.O_CREAT
+    if direct:
+        try:
+            return os.open(path, flags | O_DIRECT)
+        except OSError, e:
+            if e.errno != errno.EINVAL:
+                raise
+            XenCertPrint("O_DIRECT not supported on %s, using buffered I/O." % path)
+    return os.open(path, flags)
+
+class BufferPool:
+    """Write data generated once up front and reused by every write. Each
+    write copies a block from a random, unaligned offset of the pool so the
+    data stays incompressible and unique without calling os.urandom per IO.
+    compress is the target compression ratio (1 = incompressible, 2 = half
+    of every 4K chunk is zeros) and dedupe the target dedupe ratio
+    (1 = every block unique, 4 = three writes out of four repeat one of a
+    few fixed blocks)."""
+    def __init__(self, compress=1.0, dedupe=1.0, size=POOL_SIZE):
+        if compress < 1 or dedupe < 1:
+            raise Exception("Compression and dedupe ratios must be at least 1.")
+        self.compress = compress
+        self.dedupe = dedupe
+        self.size = size
+        XenCertPrint("Generating %d bytes of write data, compression ratio %s, dedupe ratio %s." % (size, compress, dedupe))
+        randomBytes = int(POOL_CHUNK / compress)
+        zeros = '\0' * (POOL_CHUNK - randomBytes)
+        chunks = []
+        for i in range(size / POOL_CHUNK):
+            chunks.append(os.urandom(randomBytes) + zeros)
+        self.data = ''.join(chunks)
+        self.duplicateRatio = 1 - 1.0 / dedupe
+
+    def Fill(self, buf, blocksize):
+        if blocksize > self.size / 2:
+            raise Exception("Block size %s is larger than half the %s write data pool." % (FormatSize(blocksize), FormatSize(self.size)))
+        if self.duplicateRatio and random.random() < self.duplicateRatio:
+            # Aligned so that the repeated blocks are identical at 4K too
+            offset = random.randrange(POOL_DUPLICATE_BLOCKS) * POOL_CHUNK
+        else:
+            offset = random.randrange(self.size - blocksize)
+        buf.seek(0)
+        buf.write(self.data[offset:offset + blocksize])
+
+class IOEngine:
+    """Drives sequential and random, read and write workloads against a block
+    device or a file and measures throughput, IOPS and latency."""
+    def __init__(self, path, size=None, direct=True, pool=None):
+        self.path = path
+        self.direct = direct
+        self.pool = pool
+        if size == None:
+            size = GetTargetSize(path)
+        self.size = size
+
+    def Prepare(self, blocksize=MiB):
+        """Makes sure a file target is allocated up to self.size so that
+        reads do not hit holes and writes do not measure allocation."""
+        fd = OpenTarget(self.path, self.direct, create=True)
+        f = io.FileIO(fd, 'r+', closefd=False)
+        try:
+            current = os.lseek(fd, 0, 2)
+            current -= current % blocksize
+            if current >= self.size:
+                return
+            buf = AllocBuffer(blocksize)
+            os.lseek(fd, current, 0)
+            while current < self.size:
+                f.write(buf)
+                current += blocksize
+            os.fsync(fd)
+        finally:
+            f.close()
+            os.close(fd)
+
+    def Run(self, workload, depth=1):
+        """Runs workload with depth synchronous streams in flight at once,
+        each stream in its own thread and on its own file descriptor."""
+        XenCertPrint("Running workload %s at depth %d against %s for %s seconds after %s seconds of warm-up." % (workload, depth, self.path, workload.duration, workload.warmup))
+        nblocks = self.size / workload.blocksize
+        if nblocks == 0:
+            raise Exception("Target %s is smaller than the block size %d." % (self.path, workload.blocksize))
+
+        measureStart = time.time() + workload.warmup
+        deadline = measureStart + workload.duration
+        workers = self.Workers(workload, depth, measureStart, deadline)
+        cpu = RunMeasured(workers, measureStart)
+        result = self.Collect(workload, depth, workers)
+        result.cpu = cpu
+
+        XenCertPrint("Workload %s on %s: %d ios, %d bytes, %d errors in %.2f seconds." % (workload, self.path, result.ios, result.bytes, result.errors, result.elapsed))
+        return result
+
+    def Workers(self, workload, depth, measureStart, deadline):
+        """Creates, without starting them, the depth streams of workload"""
+        nblocks = self.size / workload.blocksize
+        workers = []
+        for i in range(depth):
+            # Sequential streams start evenly spread over the target
+            workers.append(IOWorker(self, workload, measureStart, deadline, i * nblocks / depth))
+        return workers
+
+    def Collect(self, workload, depth, workers):
+        result = WorkloadResult(workload, self.path)
+        result.depth = depth
+        for worker in workers:
+            if worker.exception != None:
+                raise worker.exception
+            result.Merge(worker.result)
+        return result
+
+class IOWorker(Thread):
+    def __init__(self, engine, workload, measureStart, deadline, startBlock=0):
+        Thread.__init__(self)
+        self.engine = engine
+        self.workload = workload
+        self.measureStart = measureStart
+        self.deadline = deadline
+        self.startBlock = startBlock
+        self.result = WorkloadResult(workload, engine.path)
+        self.exception = None
+
+    def run(self):
+        try:
+            self.DoIO()
+        except Exception, e:
+            XenCertPrint("IO worker for %s on %s failed: %s" % (self.workload, self.engine.path, str(e)))
+            self.exception = e
+
+    def DoIO(self):
+        workload = self.workload
+        result = self.result
+        blocksize = workload.blocksize
+        nblocks = self.engine.size / blocksize
+
+        buf = AllocBuffer(blocksize)
+        fd = OpenTarget(self.engine.path, self.engine.direct)
+        f = io.FileIO(fd, 'r+', closefd=False)
+        try:
+            block = self.startBlock
+            measureStart = self.measureStart
+            now = time.time()
+            while now < self.deadline:
+                if workload.random:
+                    block = random.randrange(nblocks)
+                elif block >= nblocks:
+                    block = 0
+                if not workload.read and self.engine.pool != None:
+                    # Copying the data in is not part of the IO latency
+                    self.engine.pool.Fill(buf, blocksize)
+                    now = time.time()
+                os.lseek(fd, block * blocksize, 0)
+                try:
+                    if workload.read:
+                        done = f.readinto(buf)
+                    else:
+                        done = f.write(buf)
+                except (IOError, OSError), e:
+                    XenCertPrint("%s failed at block %d of %s: %s" % (workload, block, self.engine.path, str(e)))
+                    result.errors += 1
+                    done = 0
+                end = time.time()
+                # IOs completing during the warm-up are not measured
+                if done and end >= measureStart:
+                    result.Record(done, end - now, end - measureStart)
+                block += 1
+                now = end
+            result.elapsed = max(now - measureStart, 0)
+            if not workload.read:
+                os.fsync(fd)
+        finally:
+            f.close()
+            os.close(fd)
+            buf.close()
+
+def RunMeasured(workers, measureStart):
+    """Runs the workers to completion and returns the CPUUsage from the end
+    of their warm-up on."""
+    for worker in workers:
+        worker.start()
+    delay = measureStart - time.time()
+    if delay > 0:
+        time.sleep(delay)
+    start = CPUSnapshot()
+    for worker in workers:
+        worker.join()
+    return CPUUsage(start, CPUSnapshot())
+
+def RunWorkloads(path, workloads, size=None, direct=True, pool=None):
+    engine = IOEngine(path, size, direct, pool)
+    results = []
+    for workload in workloads:
+        results.append(engine.Run(workload))
+    return results
+
+def FindSaturationDepth(results):
+    """Returns the depth after which throughput stopped scaling, i.e. the
+    last depth that still added SCALING_THRESHOLD over its predecessor."""
+    if not results:
+        return None
+    saturation = results[0].depth
+    for i in range(1, len(results)):
+        previous = results[i - 1].Throughput()
+        if previous > 0 and results[i].Throughput() < previous * (1 + SCALING_THRESHOLD):
+            break
+        saturation = results[i].depth
+    return saturation
+
+def QueueDepthSweep(path, workload, depths=DEFAULT_DEPTHS, size=None, direct=True, pool=None):
+    engine = IOEngine(path, size, direct, pool)
+    results = []
+    for depth in depths:
+        results.append(engine.Run(workload, depth))
+    return (results, FindSaturationDepth(results))
+
+def BlockSizeSweep(path, workload, blocksizes=DEFAULT_SWEEP_BLOCK_SIZES, size=None, direct=True, pool=None):
+    engine = IOEngine(path, size, direct, pool)
+    results = []
+    for blocksize in blocksizes:
+        results.append(engine.Run(Workload(workload.name, blocksize, workload.duration, workload.warmup)))
+    return results
+
+def AggregateRun(paths, workload, depth=1, direct=True, pool=None):
+    """Runs workload against all paths at the same time. Returns one result
+    per path, in the same order, and the CPUUsage of the whole run."""
+    engines = []
+    for path in paths:
+        engine = IOEngine(path, None, direct, pool)
+        if engine.size / workload.blocksize == 0:
+            raise Exception("Target %s is smaller than the block size %d." % (path, workload.blocksize))
+        engines.append(engine)
+    XenCertPrint("Running workload %s against %d targets at once." % (workload, len(paths)))
+
+    measureStart = time.time() + workload.warmup
+    deadline = measureStart + workload.duration
+    allWorkers = []
+    for engine in engines:
+        allWorkers.append(engine.Workers(workload, depth, measureStart, deadline))
+    workers = []
+    for engineWorkers in allWorkers:
+        workers.extend(engineWorkers)
+    cpu = RunMeasured(workers, measureStart)
+
+    results = []
+    for i in range(len(engines)):
+        results.append(engines[i].Collect(workload, depth, allWorkers[i]))
+    return (results, cpu)
@@ -0,0 +1,258 @@
+#!/usr/bin/python
+#
+# Copyright (C) Inspur Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Continuous timestamped IO stream used to observe path failover"""
+import io
+import os
+import time
+from collections import deque
+from threading import Thread, Event
+from Logging import XenCertPrint
+from IOEngine import KiB, MiB, AllocBuffer, OpenTarget
+from PerfStats import LatencyHistogram
+
+# Size of each IO of the stream, small enough to give millisecond
+# resolution on the timeline
+STREAM_BLOCK_SIZE = 64 * KiB
+
+# The stream cycles over this much of the start of the device
+STREAM_SPAN = 64 * MiB
+
+# Seconds to back off after a failed IO so an erroring device does not
+# flood the timeline
+ERROR_BACKOFF = 0.01
+
+# An IO is part of a stall when it fails or takes longer than
+# STALL_FACTOR times the median latency seen before the first event, and
+# never less than STALL_MIN seconds.
+STALL_FACTOR = 10
+STALL_MIN = 0.05
+
+# Latencies kept to work out the stall threshold, the last ones before
+# the first event
+BASELINE_IOS = 10000
+
+# The IOs fast enough never to be part of a stall are only counted, per
+# slot of this many seconds
+SLOT_TIME = 0.01
+
+class IOStream(Thread):
+    """Writes STREAM_BLOCK_SIZE blocks back to back to a device with O_DIRECT
+    until stopped. The start, latency and outcome of the IOs which failed
+    or took longer than STALL_MIN are recorded, the others are aggregated.
+    Events such as a path block or unblock are marked on the same clock so
+    the stalls around them can be measured."""
+    def __init__(self, device, blocksize=STREAM_BLOCK_SIZE, span=STREAM_SPAN):
+        Thread.__init__(self)
+        self.setDaemon(True)
+        self.device = device
+        self.blocksize = blocksize
+        self.span = span
+        self.stopEvent = Event()
+        self.total = 0
+        self.errors = 0
+        self.histogram = LatencyHistogram()
+        # (end, latency) of the last successful IOs before the first event
+        self.baseline = deque(maxlen=BASELINE_IOS)
+        # (start, latency, ok) of each failed or slow IO
+        self.ios = []
+        # slot -> [IOs started in it, highest latency] of the fast IOs
+        self.slots = {}
+        # (time, label) of each event
+        self.events = []
+        self.startTime = None
+        self.endTime = None
+        self.exception = None
+
+    def run(self):
+        try:
+            self.DoIO()
+        except Exception, e:
+            XenCertPrint("IO stream on %s failed: %s" % (self.device, str(e)))
+            self.exception = e
+
+    def DoIO(self):
+        buf = AllocBuffer(self.blocksize)
+        fd = OpenTarget(self.device)
+        f = io.FileIO(fd, 'r+', closefd=False)
+        nblocks = max(1, self.span / self.blocksize)
+        block = 0
+        try:
+            self.startTime = time.time()
+            while not self.stopEvent.isSet():
+                start = time.time()
+                try:
+                    os.lseek(fd, block * self.blocksize, 0)
+                    f.write(buf)
+                    ok = True
+                except (IOError, OSError), e:
+                    XenCertPrint("IO stream write failed at block %d of %s: %s" % (block, self.device, str(e)))
+                    ok = False
+                self.Record(start, time.time() - start, ok)
+                if not ok:
+                    time.sleep(ERROR_BACKOFF)
+                block = (block + 1) % nblocks
+            self.endTime = time.time()
+        finally:
+            f.close()
+            os.close(fd)
+            buf.close()
+
+    def Record(self, start, latency, ok):
+        self.total += 1
+        if ok:
+            self.histogram.Record(latency)
+            if not self.events:
+                self.baseline.append((start + latency, latency))
+        else:
+            self.errors += 1
+        if not ok or latency > STALL_MIN:
+            self.ios.append((start, latency, ok))
+            return
+        slot = self.slots.setdefault(int(start / SLOT_TIME), [0, 0.0])
+        slot[0] += 1
+        if latency > slot[1]:
+            slot[1] = latency
+
+    def Mark(self, label, when=None):
+        if when == None:
+            when = time.time()
+        self.events.append((when, label))
+
+    def Stop(self):
+        self.stopEvent.set()
+        self.join()
+        if self.endTime == None:
+            self.endTime = time.time()
+
+    def Errors(self):
+        return self.errors
+
+    def Histogram(self):
+        return self.histogram
+
+    def Throughput(self):
+        # MB/s of the successful IOs over the life of the stream
+        if self.startTime == None or self.endTime <= self.startTime:
+            return 0.0
+        return float(self.total - self.errors) * self.blocksize / MiB / (self.endTime - self.startTime)
+
+    def StallThreshold(self):
+        before = []
+        firstEvent = None
+        if self.events:
+            firstEvent = min([when for (when, label) in self.events])
+        for (end, latency) in self.baseline:
+            if firstEvent == None or end < firstEvent:
+                before.append(latency)
+        if not before:
+            return STALL_MIN
+        before.sort()
+        return max(STALL_MIN, before[len(before) / 2] * STALL_FACTOR)
+
+    def Stalls(self, threshold=None):
+        """Returns [start, end, ios, errors] windows during which IO was
+        failing or slower than threshold. Windows closer together than
+        threshold are merged. The threshold is never below STALL_MIN, so
+        the IOs which were only counted cannot be part of a stall."""
+        if threshold == None:
+            threshold = self.StallThreshold()
+        stalls = []
+        for (start, latency, ok) in self.ios:
+            if ok and latency <= threshold:
+                continue
+            end = start + latency
+            if stalls and start - stalls[-1][1] <= threshold:
+                stalls[-1][1] = end
+                stalls[-1][2] += 1
+            else:
+                stalls.append([start, end, 1, 0])
+            if not ok:
+                stalls[-1][3] += 1
+        return stalls
+
+    def Timeline(self):
+        """Returns one dict per event describing the IO from that event to
+        the next: when the stall started and how long it lasted relative to
+        the event, the errors seen and the time until IO was back to normal,
+        all in milliseconds."""
+        threshold = self.StallThreshold()
+        stalls = self.Stalls(threshold)
+        events = sorted(self.events)
+        timeline = []
+        for i in range(len(events)):
+            (when, label) = events[i]
+            if i + 1 < len(events):
+                until = events[i + 1][0]
+            else:
+                until = self.endTime
+            ios = 0
+            errors = 0
+            maxLatency = 0.0
+            for (start, latency, ok) in self.ios:
+                if start + latency <= when or start >= until:
+                    continue
+                ios += 1
+                if not ok:
+                    errors += 1
+                elif latency > maxLatency:
+                    maxLatency = latency
+            # The fast IOs are placed by the slot they started in
+            for (slot, (count, latency)) in self.slots.items():
+                if slot * SLOT_TIME >= when and slot * SLOT_TIME < until:
+                    ios += count
+                    if latency > maxLatency:
+                        maxLatency = latency
+            # Stalls still in progress at the event count towards it
+            windows = []
+            for stall in stalls:
+                if stall[1] > when and stall[0] < until:
+                    windows.append(stall)
+            entry = { 'event': label,
+                      'time': when,
+                      'ios': ios,
+                      'errors': errors,
+                      'max_latency_ms': maxLatency * 1000,
+                      'stall_threshold_ms': threshold * 1000,
+                      'stalled': len(windows) > 0,
+                      'stall_start_ms': 0.0,
+                      'stall_ms': 0.0,
+                      'recovery_ms': 0.0 }
+            if windows:
+                entry['stall_start_ms'] = (windows[0][0] - when) * 1000
+                entry['stall_ms'] = (windows[-1][1] - windows[0][0]) * 1000
+                entry['recovery_ms'] = (windows[-1][1] - when) * 1000
+            timeline.append(entry)
+        return timeline
+
+    def ToDict(self):
+        histogram = self.Histogram()
+        base = self.startTime or 0.0
+        return { 'device': self.device,
+                 'blocksize': self.blocksize,
+                 'ios': self.total,
+                 'errors': self.Errors(),
+                 'duration': max(0.0, (self.endTime or base) - base),
+                 'throughput_mbs': self.Throughput(),
+                 'latency_percentiles_ms': histogram.Summary(),
+                 'stalls': [[(s[0] - base) * 1000, (s[1] - base) * 1000, s[2], s[3]] for s in self.Stalls()],
+                 'timeline': self.Timeline() }
+
+def StartStream(device):
+    stream = IOStream(device)
+    stream.start()
+    return stream
@@ -0,0 +1,79 @@
+#!/usr/bin/python
+#
+# Copyright (C) Inspur Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Machine readable report of the performance results of a XenCert run"""
+import os
+import json
+import time
+from Logging import GetLogFileName, XenCertPrint
+
+records = []
+
+def GetReportFileName():
+    logfilename = GetLogFileName()
+    if logfilename == None:
+        return None
+    return os.path.splitext(logfilename)[0] + '-perf.json'
+
+def AddRecord(kind, record):
+    """Adds a record of the given kind (e.g. 'workload') to the report. The
+    report file is rewritten each time so an aborted run keeps its data."""
+    record = dict(record)
+    record['kind'] = kind
+    record['time'] = time.time()
+    records.append(record)
+    WriteReport()
+
+def WriteReport():
+    filename = GetReportFileName()
+    if filename == None:
+        return
+    try:
+        f = open(filename, 'w')
+        try:
+            json.dump({'records': records}, f)
+        finally:
+            f.close()
+    except Exception, e:
+        XenCertPrint("Failed to write the performance report %s: %s" % (filename, str(e)))
+
+def GetCSVFileName(name):
+    logfilename = GetLogFileName()
+    if logfilename == None:
+        return None
+    return os.path.splitext(logfilename)[0] + '-%s.csv' % name
+
+def AppendCSV(name, header, row):
+    """Appends row to the CSV series called name, writing header first
+    when the file is new."""
+    filename = GetCSVFileName(name)
+    if filename == None:
+        return
+    try:
+        newFile = not os.path.exists(filename)
+        f = open(filename, 'a')
+        try:
+            if newFile:
+                f.write(','.join(header) + '\n')
+            f.write(','.join([str(item) for item in row]) + '\n')
+        finally:
+            f.close()
+    except Exception, e:
+        XenCertPrint("Failed to write the CSV series %s: %s" % (filename, str(e)))
+
+def HasRecords():
+    return len(records) > 0
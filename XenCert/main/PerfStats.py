@@ -0,0 +1,177 @@
+#!/usr/bin/python
+#
+# Copyright (C) Inspur Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Statistics helpers for the performance and failover tests"""
+import math
+
+# Percentiles reported for every workload
+PERCENTILES = [50.0, 90.0, 99.0, 99.9]
+
+# Each power of two is split into this many linear sub buckets, which keeps
+# the relative error of a recorded value below 1/SUB_BUCKETS_HALF (~1.6%).
+SUB_BUCKET_BITS = 7
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+SUB_BUCKETS_HALF = SUB_BUCKETS / 2
+
+# Largest power of two tracked above SUB_BUCKETS. Values are in microseconds
+# so this covers well over a day, anything larger lands in the last bucket.
+MAX_SHIFT = 32
+
+# Number of consecutive throughput samples which must agree, and the
+# coefficient of variation below which they are considered to agree,
+# for a workload to be in steady state.
+STEADY_WINDOW = 5
+STEADY_CV = 0.10
+
+def _BitLength(value):
+    # int.bit_length() is not available on python 2.6
+    return math.frexp(value)[1]
+
+class LatencyHistogram:
+    """Log bucketed (HDR style) latency histogram of fixed size. Latencies
+    are recorded in seconds and stored as microseconds."""
+    def __init__(self):
+        self.counts = [0] * (SUB_BUCKETS + MAX_SHIFT * SUB_BUCKETS_HALF)
+        self.total = 0
+        self.max = 0
+
+    def _Index(self, value):
+        if value < SUB_BUCKETS:
+            return value
+        shift = _BitLength(value) - SUB_BUCKET_BITS
+        if shift > MAX_SHIFT:
+            return len(self.counts) - 1
+        sub = value >> shift
+        return SUB_BUCKETS + (shift - 1) * SUB_BUCKETS_HALF + (sub - SUB_BUCKETS_HALF)
+
+    def _HighestValue(self, index):
+        # Highest microsecond value which falls into this bucket
+        if index < SUB_BUCKETS:
+            return index
+        index -= SUB_BUCKETS
+        shift = index / SUB_BUCKETS_HALF + 1
+        sub = index % SUB_BUCKETS_HALF + SUB_BUCKETS_HALF
+        return ((sub + 1) << shift) - 1
+
+    def Record(self, latency):
+        value = int(latency * 1000000)
+        if value < 0:
+            value = 0
+        self.counts[self._Index(value)] += 1
+        self.total += 1
+        if value > self.max:
+            self.max = value
+
+    def Merge(self, other):
+        for i in range(len(self.counts)):
+            self.counts[i] += other.counts[i]
+        self.total += other.total
+        if other.max > self.max:
+            self.max = other.max
+
+    def Percentile(self, percentile):
+        """Returns the latency in milliseconds at or below which the given
+        percentage of the recorded values fall."""
+        if self.total == 0:
+            return 0.0
+        target = int(math.ceil(self.total * percentile / 100.0))
+        if target < 1:
+            target = 1
+        seen = 0
+        for i in range(len(self.counts)):
+            seen += self.counts[i]
+            if seen >= target:
+                return min(self._HighestValue(i), self.max) / 1000.0
+        return self.max / 1000.0
+
+    def Max(self):
+        return self.max / 1000.0
+
+    def Summary(self):
+        summary = {}
+        for percentile in PERCENTILES:
+            summary['p%g' % percentile] = self.Percentile(percentile)
+        summary['max'] = self.Max()
+        return summary
+
+    def Buckets(self):
+        """Non empty buckets as [highest value in ms, count] pairs"""
+        buckets = []
+        for i in range(len(self.counts)):
+            if self.counts[i]:
+                buckets.append([self._HighestValue(i) / 1000.0, self.counts[i]])
+        return buckets
+
+def FormatPercentiles(histogram):
+    text = ''
+    for percentile in PERCENTILES:
+        text += 'p%g %.3f ' % (percentile, histogram.Percentile(percentile))
+    text += 'max %.3f ms' % histogram.Max()
+    return text
+
+def MeanAndCV(samples):
+    """Returns the mean and the coefficient of variation of samples"""
+    if not samples:
+        return (0.0, 0.0)
+    mean = float(sum(samples)) / len(samples)
+    if mean == 0:
+        return (0.0, 0.0)
+    variance = 0.0
+    for sample in samples:
+        variance += (sample - mean) ** 2
+    variance /= len(samples)
+    return (mean, math.sqrt(variance) / mean)
+
+def FindSteadyState(samples, window=STEADY_WINDOW, threshold=STEADY_CV):
+    """Finds the first sample from which every window of samples varies by
+    less than threshold. Returns (index, mean, cv) of the samples from
+    that index on, or (None, mean, cv) of all samples when none is found."""
+    if len(samples) < window:
+        (mean, cv) = MeanAndCV(samples)
+        return (None, mean, cv)
+    # Steady state starts right after the last window which still varied
+    start = 0
+    for i in range(len(samples) - window + 1):
+        if MeanAndCV(samples[i:i + window])[1] >= threshold:
+            start = i + 1
+    if start > len(samples) - window:
+        (mean, cv) = MeanAndCV(samples)
+        return (None, mean, cv)
+    (mean, cv) = MeanAndCV(samples[start:])
+    return (start, mean, cv)
+
+def Distribution(values):
+    """Returns the count, min, median, p95 and max of values, using the
+    nearest rank so that every figure is one of the values."""
+    ordered = sorted(values)
+    if not ordered:
+        return { 'count': 0, 'min': 0.0, 'median': 0.0, 'p95': 0.0, 'max': 0.0 }
+    def rank(percentile):
+        index = int(math.ceil(len(ordered) * percentile / 100.0)) - 1
+        return ordered[max(0, min(index, len(ordered) - 1))]
+    return { 'count': len(ordered),
+             'min': ordered[0],
+             'median': rank(50.0),
+             'p95': rank(95.0),
+             'max': ordered[-1] }
+
+def FormatDistribution(values, format='%.3f'):
+    distribution = Distribution(values)
+    text = 'n %d' % distribution['count']
+    for key in ['min', 'median', 'p95', 'max']:
+        text += (' %s ' + format) % (key, distribution[key])
+    return text
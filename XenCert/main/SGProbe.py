@@ -0,0 +1,203 @@
+#!/usr/bin/python
+#
+# Copyright (C) Inspur Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Per path latency probe sending SCSI commands over SG_IO"""
+import os
+import glob
+import time
+import ctypes
+import WorkerPool
+from Logging import XenCertPrint
+from PerfStats import LatencyHistogram
+
+SG_IO = 0x2285
+SG_DXFER_NONE = -1
+SG_DXFER_FROM_DEV = -3
+SG_INTERFACE_ID = ord('S')
+
+TEST_UNIT_READY = 0x00
+READ_10 = 0x28
+
+SENSE_SIZE = 32
+
+# Milliseconds the kernel waits for each probe command
+PROBE_TIMEOUT = 5000
+
+# Number of commands of each kind sent down every path
+PROBE_COUNT = 20
+
+# Size of the probe reads
+PROBE_READ_SIZE = 4096
+
+# A path is reported as slow when its median read latency is this many
+# times the median of its siblings
+SLOW_FACTOR = 2.0
+
+class SgIoHdr(ctypes.Structure):
+    # struct sg_io_hdr from <scsi/sg.h>
+    _fields_ = [('interface_id', ctypes.c_int),
+                ('dxfer_direction', ctypes.c_int),
+                ('cmd_len', ctypes.c_ubyte),
+                ('mx_sb_len', ctypes.c_ubyte),
+                ('iovec_count', ctypes.c_ushort),
+                ('dxfer_len', ctypes.c_uint),
+                ('dxferp', ctypes.c_void_p),
+                ('cmdp', ctypes.c_void_p),
+                ('sbp', ctypes.c_void_p),
+                ('timeout', ctypes.c_uint),
+                ('flags', ctypes.c_uint),
+                ('pack_id', ctypes.c_int),
+                ('usr_ptr', ctypes.c_void_p),
+                ('status', ctypes.c_ubyte),
+                ('masked_status', ctypes.c_ubyte),
+                ('msg_status', ctypes.c_ubyte),
+                ('sb_len_wr', ctypes.c_ubyte),
+                ('host_status', ctypes.c_ushort),
+                ('driver_status', ctypes.c_ushort),
+                ('resid', ctypes.c_int),
+                ('duration', ctypes.c_uint),
+                ('info', ctypes.c_uint)]
+
+libc = ctypes.CDLL(None, use_errno=True)
+
+def SendCommand(fd, cdb, dataLength=0):
+    """Sends cdb to the device open on fd and returns the latency in
+    seconds. Raises an exception when the command fails."""
+    command = ctypes.create_string_buffer(cdb, len(cdb))
+    sense = ctypes.create_string_buffer(SENSE_SIZE)
+    hdr = SgIoHdr()
+    hdr.interface_id = SG_INTERFACE_ID
+    hdr.cmd_len = len(cdb)
+    hdr.cmdp = ctypes.cast(command, ctypes.c_void_p)
+    hdr.mx_sb_len = SENSE_SIZE
+    hdr.sbp = ctypes.cast(sense, ctypes.c_void_p)
+    hdr.timeout = PROBE_TIMEOUT
+    if dataLength:
+        data = ctypes.create_string_buffer(dataLength)
+        hdr.dxfer_direction = SG_DXFER_FROM_DEV
+        hdr.dxfer_len = dataLength
+        hdr.dxferp = ctypes.cast(data, ctypes.c_void_p)
+    else:
+        hdr.dxfer_direction = SG_DXFER_NONE
+    start = time.time()
+    if libc.ioctl(fd, SG_IO, ctypes.byref(hdr)) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+    latency = time.time() - start
+    if hdr.status or hdr.host_status or hdr.driver_status:
+        raise Exception("SCSI command 0x%02x failed, status 0x%x host 0x%x driver 0x%x" %
+                        (ord(cdb[0]), hdr.status, hdr.host_status, hdr.driver_status))
+    return latency
+
+def TestUnitReadyCDB():
+    return chr(TEST_UNIT_READY) + '\0' * 5
+
+def Read10CDB(lba, blocks):
+    return chr(READ_10) + '\0' + \
+           chr((lba >> 24) & 0xff) + chr((lba >> 16) & 0xff) + chr((lba >> 8) & 0xff) + chr(lba & 0xff) + \
+           '\0' + chr((blocks >> 8) & 0xff) + chr(blocks & 0xff) + '\0'
+
+def GetLogicalBlockSize(device):
+    try:
+        f = open('/sys/block/%s/queue/logical_block_size' % device)
+        try:
+            return int(f.read().strip())
+        finally:
+            f.close()
+    except (IOError, ValueError):
+        return 512
+
+def DeviceForHBTL(hbtl):
+    """Returns the sdX device of a SCSI host:bus:target:lun, or None"""
+    devices = glob.glob('/sys/class/scsi_device/%s/device/block/*' % hbtl)
+    if devices:
+        return os.path.basename(devices[0])
+    devices = glob.glob('/sys/class/scsi_device/%s/device/block:*' % hbtl)
+    if devices:
+        return os.path.basename(devices[0]).split(':', 1)[1]
+    return None
+
+class PathProbe:
+    """Latencies of the TEST UNIT READY and 4K READ commands sent down one
+    path"""
+    def __init__(self, hbtl, device):
+        self.hbtl = hbtl
+        self.device = device
+        self.tur = LatencyHistogram()
+        self.read = LatencyHistogram()
+        self.errors = 0
+
+    def Run(self, count=PROBE_COUNT):
+        fd = os.open('/dev/' + self.device, os.O_RDONLY | os.O_NONBLOCK)
+        try:
+            blocks = max(1, PROBE_READ_SIZE / GetLogicalBlockSize(self.device))
+            for i in range(count):
+                for (histogram, cdb, length) in [(self.tur, TestUnitReadyCDB(), 0),
+                                                 (self.read, Read10CDB(0, blocks), PROBE_READ_SIZE)]:
+                    try:
+                        histogram.Record(SendCommand(fd, cdb, length))
+                    except Exception, e:
+                        XenCertPrint("Probe of path %s (%s) failed: %s" % (self.hbtl, self.device, str(e)))
+                        self.errors += 1
+        finally:
+            os.close(fd)
+        return self
+
+    def ToDict(self):
+        return { 'hbtl': self.hbtl,
+                 'device': self.device,
+                 'errors': self.errors,
+                 'tur_ms': self.tur.Summary(),
+                 'read_ms': self.read.Summary() }
+
+def ProbePaths(hbtls, count=PROBE_COUNT):
+    """Probes all the paths at the same time. Returns hbtl -> PathProbe for
+    the paths whose device was found and could be opened."""
+    pool = WorkerPool.WorkerPool(max(1, len(hbtls)), 0)
+    for hbtl in hbtls:
+        device = DeviceForHBTL(hbtl)
+        if device == None:
+            XenCertPrint("No block device found for path %s, not probing it." % hbtl)
+            continue
+        pool.Add(hbtl, PathProbe(hbtl, device).Run, (count,))
+    probes = {}
+    for job in pool.Run():
+        if job.exception == None:
+            probes[job.key] = job.result
+    return probes
+
+def FindSlowPaths(probes, factor=SLOW_FACTOR):
+    """Returns (hbtl, ratio) of the paths whose median read latency is at
+    least factor times the median of the other paths of the same map"""
+    medians = {}
+    for hbtl in probes.keys():
+        if probes[hbtl].read.total:
+            medians[hbtl] = probes[hbtl].read.Percentile(50)
+    slow = []
+    for hbtl in medians.keys():
+        siblings = []
+        for other in medians.keys():
+            if other != hbtl:
+                siblings.append(medians[other])
+        if not siblings:
+            continue
+        siblings.sort()
+        reference = siblings[len(siblings) / 2]
+        if reference > 0 and medians[hbtl] >= reference * factor:
+            slow.append((hbtl, medians[hbtl] / reference))
+    slow.sort()
+    return slow
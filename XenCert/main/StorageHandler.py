@@ -31,20 +31,24 @@ from threading import Thread
 import time
 import os
 import random
+import re
 import nfs
 import commands
 import ISCSI
+import IOEngine
+import IOTimeline
+import UEventMonitor
+import SGProbe
+import DataTestEstimate
+import DataTestCheckpoint
+import ALUA
+import WorkerPool
+import PerfReport
+from PerfStats import FormatPercentiles, Distribution, FormatDistribution
 from lvhdutil import VG_LOCATION,VG_PREFIX
 from lvutil import MDVOLUME_NAME, ensurePathExists, remove, rename
 from FileSystem import MOUNT_BASE, EXT4, XFS, OCFS2
 
-retValIO = 0
-timeTaken = '' 
-bytesCopied = ''
-speedOfCopy = ''
-pathsFailed = False
-failoverTime = 0
-
 # simple tracer
 def report(predicate, condition):
     if predicate != condition:
@@ -53,70 +57,99 @@ def report(predicate, condition):
 # Hardcoded time limit for Functional tests in hours
 timeLimitFunctional = 4
 
-class TimedDeviceIO(Thread):
-    def __init__(self, device):
-        Thread.__init__(self)
-        self.device = device
-
-    def run(self):
-        # Sleep for a period of time before checking for any incomplete snapshots to clean.
-        devicename = '/dev/' + self.device
-        ddOutFile = 'of=' + devicename
-        XenCertPrint("Now copy data from /dev/zero to this device and record the time taken to copy it." )
-        cmd = ['dd', 'if=/dev/zero', ddOutFile, 'bs=1M', 'count=1', 'oflag=direct']
-        DebugCmdArray(cmd)
-        try:
-            global retValIO
-            global bytesCopied
-            global timeTaken
-            global speedOfCopy
-            retValIO = 0
-            timeTaken = '' 
-            bytesCopied = ''
-            speedOfCopy = ''
-
-            (retValIO, stdout, stderr) = util.doexec(cmd,'')
-            if retValIO != 0:
-                raise Exception("Disk IO failed for device: %s." % self.device)
-            list = stderr.split('\n')
-            
-            bytesCopied = list[2].split(',')[0]
-            timeTaken = list[2].split(',')[1]
-            speedOfCopy = list[2].split(',')[2]
-
-            XenCertPrint("The IO test returned rc: %s stdout: %s, stderr: %s" % (retValIO, stdout, list))
-        except Exception, e:
-                XenCertPrint("Could not write through the allocated disk space on test disk, please check the storage configuration manually. Exception: %s" % str(e))
+# Seconds the multipath IO stream runs undisturbed before and after the
+# paths are blocked, and the highest latency accepted while undisturbed
+STREAM_BASELINE_TIME = 3
+MAX_BASELINE_LATENCY_MS = 3000
+
+# Seconds allowed for the blocked paths to fail and for the unblocked
+# paths to be restored
+FAILOVER_TIMEOUT = 50
+RESTORE_TIMEOUT = 120
+
+# Seconds allowed for the paths of a map to come back after it was
+# reloaded with another multipath policy
+POLICY_RELOAD_TIMEOUT = 30
+
+# Line of the path block/unblock utility output giving the time the
+# block/unblock took effect
+APPLIED_AT = re.compile(r'applied at ([0-9]+\.?[0-9]*)')
+
+# Throughput line printed by diskdatatest at the end of a write or verify
+DISKDATATEST_THROUGHPUT = re.compile(r'(?:Wrote|Verified) [0-9]+ sectors .*, ([0-9.]+) MB/s')
+
+# Additional performance modes selected with -P
+PERF_MODES = ['qdsweep', 'bssweep', 'aggregate', 'alua', 'mpolicy']
+
+def ParsePerfModes(spec):
+    modes = []
+    if spec:
+        for mode in spec.split(','):
+            mode = mode.strip()
+            if not mode:
+                continue
+            if mode not in PERF_MODES:
+                raise Exception("Unsupported performance mode %s, %s only" % (mode, ', '.join(PERF_MODES)))
+            modes.append(mode)
+    return modes
+
+def FormatDuration(seconds):
+    seconds = int(seconds)
+    return "%d:%02d:%02d" % (seconds / 3600, seconds / 60 % 60, seconds % 60)
 
 class WaitForFailover(Thread):
-    def __init__(self, session, scsiid, activePaths, noOfPaths):
+    def __init__(self, session, scsiid, activePaths, noOfPaths, monitor=None, mpDevname=None, since=None):
         Thread.__init__(self)        
         self.scsiid = scsiid
         self.activePaths = activePaths
         self.noOfPaths = noOfPaths
+        self.monitor = monitor
+        self.mpDevname = mpDevname
+        if since == None:
+            since = time.time()
+        self.since = since
+        self.pathsFailed = False
+        self.failoverTime = 0
 
     def run(self):
         # Here wait for the expected number of paths to fail.        
-        active = 0
-        global pathsFailed
-        global failoverTime
-        pathsFailed = False
-        failoverTime = 0        
-        while not pathsFailed and failoverTime < 50:
+        expected = int(self.activePaths) - self.noOfPaths
+        if self.monitor != None and self.mpDevname != None:
+            # The kernel reports the valid paths left with every path failure
+            failed = self.monitor.WaitForValidPaths(self.mpDevname, lambda valid: valid <= expected, self.since, FAILOVER_TIMEOUT)
+            if failed != None:
+                self.pathsFailed = True
+                self.failoverTime = failed - self.since
+                return
+            # A uevent may have been dropped, multipathd has the last word
+            XenCertPrint("No failover uevent for %s, polling multipathd." % self.mpDevname)
+        # Polled at least once, even when the uevents used up the timeout
+        while True:
             try:
-                (retVal, listPathConfigNew) = StorageHandlerUtil.get_path_status(self.scsiid, True)
+                (retVal, listPathConfigNew, devname) = StorageHandlerUtil.get_path_status(self.scsiid, True, 0)
                 if self.noOfPaths == ((int)(self.activePaths) - len(listPathConfigNew)):
-                    pathsFailed = True
-                time.sleep(1)
-                failoverTime += 1                
+                    self.pathsFailed = True
             except Exception, e:                
-                raise Exception(e)
+                XenCertPrint("Failed to get the path status of %s: %s" % (self.scsiid, str(e)))
+            self.failoverTime = time.time() - self.since
+            if self.pathsFailed or self.failoverTime >= FAILOVER_TIMEOUT:
+                break
+            time.sleep(1)
             
 class StorageHandler:
     def __init__(self, storage_conf):
         XenCertPrint("Reached Storagehandler constructor")
         self.storage_conf = storage_conf
         self.sm_config = {}
+        # Continuous IO streams the path block/unblock events are marked on
+        self.ioStreams = []
+        # Multipath device -> SCSI id and number of paths active before
+        # any path was blocked
+        self.mapSCSIid = {}
+        self.initialActivePaths = {}
+        # Kernel path uevent listener and the time of the last block/unblock
+        self.uevents = None
+        self.lastPathEventTime = None
     
     def MPConfigVerificationTests(self):
         try:
@@ -157,15 +190,11 @@ class StorageHandler:
                 checkPoint += 1
 
             PrintB(">> Starting Multipath Device IO test")
-            #Print(">> Starting Random Path Block and Restore Iteration test")
-            #Print("   This test will choose a random selection of upto (n -1) paths ")
-            #Print("   of a total of n to block, and verify that the IO continues")
-            #Print("   i.e. the correct paths are detected as failed, within 50 seconds.")
-            #Print("   The test then verifies that after unblocking the path, it is ")
-            #Print("   restored within 2 minutes.\n\n")
-            #Print("   Path Connectivity Details")
             self.DisplayPathStatus()
 
+            # Listen for path failures and restores before any path is blocked
+            self.uevents = UEventMonitor.StartMonitor()
+
             for (mpDevname, listPathConfig) in self.mapPathConfig.items():
                 totalCheckPoints += 1
                 # make sure there are at least 2 paths for the multipath tests to make any sense.
@@ -173,105 +202,58 @@ class StorageHandler:
                     PrintY("FATAL! At least 2 paths are required for multipath failover testing, please configure your storage accordingly.")
                     
                 # Calculate the number of active paths here
-                self.initialActivePaths = 0
+                self.initialActivePaths[mpDevname] = 0
                 for tuple in listPathConfig:
                     if tuple[1] == 'active':
-                        self.initialActivePaths += 1
+                        self.initialActivePaths[mpDevname] += 1
                 # Now testing failure times for the paths.  
-                global retValIO
-                global timeTaken
-                global bytesCopied
-                global speedOfCopy
                 Print("")
                 Print("Iteration 1 for Multipath Device %s:\n" % mpDevname)
                 Print(" -> No manual blocking of paths.")
-                s = TimedDeviceIO(mpDevname)
-                s.start()
-                s.join()
+                stream = IOTimeline.StartStream('/dev/' + mpDevname)
+                time.sleep(STREAM_BASELINE_TIME)
+                stream.Stop()
+                PerfReport.AddRecord('iostream', stream.ToDict())
                 
-                if retValIO != 0:
+                if stream.exception != None or stream.Errors() or not stream.total:
                     displayOperationStatus(False)
                     raise Exception(" IO tests failed for device: %s" % mpDevname)
                 
-                initialDataCopyTime = float(timeTaken.split()[0])
-                if initialDataCopyTime > 3:
-                    displayOperationStatus(False, timeTaken)
-                    Print("    - The initial data copy is too slow at %s" % timeTaken )
+                histogram = stream.Histogram()
+                if histogram.Max() > MAX_BASELINE_LATENCY_MS:
+                    displayOperationStatus(False, "%.3f ms" % histogram.Max())
+                    Print("    - The IO latency without failover is too high, %s" % FormatPercentiles(histogram))
                     dataCopyTooSlow = True
                 else:
-                    Print("    - IO test passed. Time: %s. Data: %s. Throughput: %s" % (timeTaken, '1MB', speedOfCopy))
+                    Print("    - IO test passed. IOs: %d of %s. Throughput: %.2f MB/s. Latency %s" %
+                          (stream.total, IOEngine.FormatSize(stream.blocksize), stream.Throughput(), FormatPercentiles(histogram)))
                     displayOperationStatus(True)
 
                 checkPoint += 1
 
-            #comment multipath failover test
-            '''
-            if len(listPathConfig) > 1:                
-                for i in range(2, iterationCount):
-                    maxTimeTaken = 0
-                    throughputForMaxTime = ''
-                    totalCheckPoints += 2
-                    Print("Iteration %d:\n" % i)                                    
-                    if not self.RandomlyFailPaths():                                            
-                        raise Exception("Failed to block paths.")
-                    
-                    XenCertPrint("Dev Path Config = '%s', no of Blocked switch Paths = '%s'" % (listPathConfig, self.noOfPaths))
-
-                    # Fail path calculation needs to be done only in case of hba SRs
-                    if "blockunblockhbapaths" in \
-                            self.storage_conf['pathHandlerUtil'].split('/')[-1]:
-                        #Calculate the number of devices to be found after the path block
-                        devicesToFail = (len(listPathConfig)/self.noOfTotalPaths) * self.noOfPaths
-                        XenCertPrint("Expected devices to fail: %s" % devicesToFail)
-                    else:
-                        devicesToFail = self.noOfPaths
+            if 'mpolicy' in self.GetPerfModes():
+                Print("")
+                PrintB(">> Starting Multipath Policy Benchmark")
+                Print("   This test reloads each multipath device with every candidate")
+                Print("   path selector and grouping policy in turn, runs the same")
+                Print("   workloads each time and ranks the policies.\n")
+                totalCheckPoints += 1
+                self.MultipathPolicyBenchmark()
+                checkPoint += 1
 
-                    s = WaitForFailover(self.session, device_config['SCSIid'], len(listPathConfig), devicesToFail)
-                    s.start()
-                    
-                    while s.isAlive():
-                        timeTaken = 0
-                        s1 = TimedDeviceIO(self.session.xenapi.VBD.get_device(vbd_ref))                    
-                        s1.start()
-                        s1.join()
-                        
-                        if retValIO != 0:                        
-                            displayOperationStatus(False)
-                            raise Exception("    - IO test failed for device %s." % self.session.xenapi.VBD.get_device(vbd_ref))
-                        else:
-                            XenCertPrint("    - IO test passed. Time: %s. Data: %s. Throughput: %s." % (timeTaken, '1MB', speedOfCopy))
-                            
-                        if timeTaken > maxTimeTaken:
-                            maxTimeTaken = timeTaken
-                            throughputForMaxTime = speedOfCopy
-                    
-                    if pathsFailed:
-                        Print("    - Paths failover time: %s seconds" % failoverTime)
-                        Print("    - Maximum IO completion time: %s. Data: %s. Throughput: %s" % (maxTimeTaken, '1MB', throughputForMaxTime))
-                        displayOperationStatus(True)
-                        checkPoint += 1
-                    else:
-                        displayOperationStatus(False)
-                        self.BlockUnblockPaths(False, self.storage_conf['pathHandlerUtil'], self.noOfPaths, self.blockedpathinfo)
-                        raise Exception("    - Paths did not failover within expected time.")
-                    
-                    self.BlockUnblockPaths(False, self.storage_conf['pathHandlerUtil'], self.noOfPaths, self.blockedpathinfo)
-                    Print(" -> Unblocking paths, waiting for restoration.")
-                    count = 0
-                    pathsMatch = False
-                    while not pathsMatch and count < 120:
-                        pathsMatch = self.DoNewPathsMatch(device_config)
-                        time.sleep(1)
-                        count += 1
-                        
-                    if not pathsMatch:
-                        displayOperationStatus(False, "> 2 mins")
-                        retVal = False 
-                        raise Exception("The path restoration took more than 2 mins.")
-                    else:
-                        displayOperationStatus(True, " " + str(count) + " seconds")
-                        checkPoint += 1
-            '''
+            if self.storage_conf['pathHandlerUtil'] == None:
+                Print("")
+                Print("- No path block/unblock utility given with -u, skipping the path failover iterations.")
+            elif iterationCount > 2:
+                Print("")
+                PrintB(">> Starting Random Path Block and Restore Iteration test")
+                Print("   This test will choose a random selection of upto (n -1) paths ")
+                Print("   of a total of n to block, and verify that the IO continues")
+                Print("   i.e. the correct paths are detected as failed, within %d seconds." % FAILOVER_TIMEOUT)
+                Print("   The test then verifies that after unblocking the path, it is ")
+                Print("   restored within %d seconds.\n\n" % RESTORE_TIMEOUT)
+                totalCheckPoints += 2 * (iterationCount - 2)
+                checkPoint += self.PathFailoverIterations(iterationCount - 2)
 
             Print("- Test succeeded.")
  
@@ -286,6 +268,10 @@ class StorageHandler:
 
             # If multipath was enabled by us, disable it, else continue.
             #TODO
+
+            if self.uevents != None:
+                self.uevents.Stop()
+                self.uevents = None
                 
             checkPoint += 1
                 
@@ -308,7 +294,16 @@ class StorageHandler:
             else:
                 cmd = [os.path.join(os.getcwd(), script), 'unblock', str(noOfPaths), passthrough]
             
+            started = time.time()
             (rc, stdout, stderr) = util.doexec(cmd,'')
+            # Utilities which apply their rules in one batch report when it
+            # took effect, otherwise the time the utility was run is used.
+            m = APPLIED_AT.search(stderr)
+            if m:
+                started = float(m.group(1))
+            self.lastPathEventTime = started
+            for stream in self.ioStreams:
+                stream.Mark(cmd[1], started)
 
             XenCertPrint("The path block/unblock utility returned rc: %s stdout: '%s', stderr: '%s'" % (rc, stdout, stderr))
             if rc != 0:                
@@ -317,6 +312,44 @@ class StorageHandler:
         except Exception, e:            
             raise e        
     
+    def ProbePaths(self, listPathConfig):
+        # Latency of small SCSI commands sent down every path of a map at
+        # once, without blocking any of them
+        try:
+            return SGProbe.ProbePaths([item[0] for item in listPathConfig])
+        except Exception, e:
+            XenCertPrint("Failed to probe the paths %s: %s" % (listPathConfig, str(e)))
+            return {}
+
+    def FormatProbe(self, probe):
+        if probe == None or (probe.tur.total == 0 and probe.read.total == 0):
+            return 'n/a'
+        text = '%.3f / %.3f' % (probe.tur.Percentile(50), probe.read.Percentile(50))
+        if probe.errors:
+            text += ' (%d errors)' % probe.errors
+        return text
+
+    def DisplaySlowPaths(self, mpDevname, probes):
+        for (hbtl, ratio) in SGProbe.FindSlowPaths(probes):
+            PrintY("       Path %s is %.1fx slower than its siblings" % (hbtl, ratio))
+        if probes:
+            PerfReport.AddRecord('pathprobe', { 'device': mpDevname,
+                                                'paths': [probe.ToDict() for probe in probes.values()],
+                                                'slow': SGProbe.FindSlowPaths(probes) })
+
+    def DisplayIOTimeline(self, stream):
+        # Stall window, errors and recovery of the IO stream around each
+        # path block/unblock, relative to the moment the script was run.
+        PrintB('\tIO timeline on %s, stall threshold %.0f ms' % (stream.device, stream.StallThreshold() * 1000))
+        PrintB('\t%-10s %10s %12s %12s %8s %14s %12s' % ('Event', 'IOs', 'Stall at ms', 'Stall ms', 'Errors', 'Recovery ms', 'Max lat ms'))
+        for entry in stream.Timeline():
+            PrintB('\t%-10s %10d %12.1f %12.1f %8d %14.1f %12.1f' %
+                   (entry['event'], entry['ios'], entry['stall_start_ms'], entry['stall_ms'],
+                    entry['errors'], entry['recovery_ms'], entry['max_latency_ms']))
+        if stream.exception != None:
+            PrintY('\tThe IO stream stopped early: %s' % str(stream.exception))
+        PerfReport.AddRecord('iostream', stream.ToDict())
+
     def __del__(self):
         XenCertPrint("Reached Storagehandler destructor")
         
@@ -324,14 +357,13 @@ class StorageHandler:
         # This class specific function will create an SR of the required type and return the required parameters.
         XenCertPrint("Reached StorageHandler Create")
         
-    def DoNewPathsMatch(self, device_config):
+    def DoNewPathsMatch(self, SCSIid, initialActivePaths):
         try:
             # get new config
-            (retVal, listPathConfigNew) = StorageHandlerUtil.get_path_status(device_config['SCSIid'])
-            XenCertPrint("listpathconfig: %s" % self.listPathConfig)
+            (retVal, listPathConfigNew, devname) = StorageHandlerUtil.get_path_status(SCSIid, False, 0)
             XenCertPrint("listpathconfigNew: %s" % listPathConfigNew)
             if not retVal:                
-                raise Exception("     - Failed to get path status information for SCSI Id: %s" % device_config['SCSIid'])
+                raise Exception("     - Failed to get path status information for SCSI Id: %s" % SCSIid)
             
             # Find new number of active paths
             newActivePaths = 0
@@ -339,40 +371,691 @@ class StorageHandler:
                 if tuple[1] == 'active':
                     newActivePaths += 1
             
-            if newActivePaths < self.initialActivePaths:                            
+            if newActivePaths < initialActivePaths:                            
                     return False
             return True
         except Exception, e:
             XenCertPrint("Failed to match new paths with old paths.")
             return False
 
-    def RawDiskPerformance(self, diskpath):
-        size = 1000
-        cmd = ['dd', 'if=/dev/zero', 'of=%s' % diskpath, 'bs=1M', 'count=%s' % size, 'conv=nocreat', 'oflag=direct']
+    def WaitForPathRestore(self, mpDevname, since):
+        """Waits up to RESTORE_TIMEOUT seconds after since for the paths of
+        mpDevname to be back. The kernel path uevents are used when available
+        and multipathd is only asked to confirm, otherwise it is polled every
+        second. Returns (restored, seconds taken)."""
+        SCSIid = self.mapSCSIid[mpDevname]
+        initialActivePaths = self.initialActivePaths[mpDevname]
+        if self.uevents != None:
+            restored = self.uevents.WaitForValidPaths(mpDevname, lambda valid: valid >= initialActivePaths, since, RESTORE_TIMEOUT)
+            if restored != None and self.DoNewPathsMatch(SCSIid, initialActivePaths):
+                return (True, restored - since)
+            XenCertPrint("No restore uevent for %s, polling multipathd." % mpDevname)
+        # Polled at least once, even when the uevents used up the timeout
+        while True:
+            if self.DoNewPathsMatch(SCSIid, initialActivePaths):
+                return (True, time.time() - since)
+            if time.time() - since >= RESTORE_TIMEOUT:
+                return (False, time.time() - since)
+            time.sleep(1)
+
+    def ApplyPolicy(self, mpDevname, policy=None):
+        """Reloads mpDevname with policy, or with the default configuration
+        when policy is None, and waits for its paths to come back. Returns
+        False when the policy could not be applied."""
+        SCSIid = self.mapSCSIid[mpDevname]
+        multipaths = None
+        if policy != None:
+            multipaths = { SCSIid: policy.Settings() }
+        if not StorageHandlerUtil.update_multipath_conf(multipaths):
+            return False
+        if not StorageHandlerUtil.reload_map(SCSIid):
+            PrintR("    - Failed to reload multipath device %s." % mpDevname)
+            return False
+        started = time.time()
+        while not self.DoNewPathsMatch(SCSIid, self.initialActivePaths[mpDevname]):
+            if time.time() - started > POLICY_RELOAD_TIMEOUT:
+                PrintR("    - The paths of %s did not come back within %d seconds of the reload." % (mpDevname, POLICY_RELOAD_TIMEOUT))
+                return False
+            time.sleep(1)
+        if policy != None:
+            selectors = StorageHandlerUtil.get_map_policies(SCSIid)
+            XenCertPrint("Path selectors of %s after the reload: %s" % (mpDevname, selectors))
+            for selector in selectors:
+                if not selector.startswith(policy.selector):
+                    PrintY("    - multipathd reports path selector %s instead of %s for %s." % (selector, policy.selector, mpDevname))
+                    return False
+        return True
+
+    def MultipathPolicyBenchmark(self):
+        """Runs the performance workloads against every multipath device once
+        for each candidate policy and ranks the policies of each workload by
+        throughput, then p99 latency. The default configuration is put back
+        afterwards."""
+        policies = StorageHandlerUtil.ParsePolicies(self.storage_conf.get('policies'))
+        workloads = self.GetWorkloads()
+        for mpDevname in self.mapPathConfig.keys():
+            device = '/dev/' + mpDevname
+            outcomes = []
+            try:
+                for policy in policies:
+                    Print("    - Policy %s on %s" % (policy, mpDevname))
+                    if not self.ApplyPolicy(mpDevname, policy):
+                        displayOperationStatus(False)
+                        continue
+                    results = IOEngine.RunWorkloads(device, workloads, pool=self.GetBufferPool())
+                    self.CheckPerformanceResults(results, device)
+                    outcomes.append((policy, results))
+                    displayOperationStatus(True)
+            finally:
+                if not self.ApplyPolicy(mpDevname):
+                    PrintR("    - Failed to restore the default multipath configuration of %s." % mpDevname)
+            if not outcomes:
+                raise Exception("None of the multipath policies could be applied to %s." % mpDevname)
+
+            PrintB('>' * 20 + '  Multipath Policy Ranking on %s  ' % mpDevname + '>' * 20)
+            for i in range(len(workloads)):
+                ranking = [(policy, results[i]) for (policy, results) in outcomes]
+                ranking.sort(key=lambda item: (-item[1].Throughput(), item[1].histogram.Percentile(99)))
+                PrintB('\t%s' % workloads[i])
+                PrintB('\t%-4s %-36s %12s %12s %16s %12s' % ('Rank', 'Policy', 'MB/s', 'IOPS', 'Latency avg(ms)', 'p99(ms)'))
+                rank = 0
+                for (policy, result) in ranking:
+                    rank += 1
+                    PrintB('\t%-4d %-36s %12.2f %12.1f %16.3f %12.3f' % (rank, policy, result.Throughput(), result.IOPS(),
+                           result.AverageLatency(), result.histogram.Percentile(99)))
+                record = { 'device': mpDevname,
+                           'workload': workloads[i].name,
+                           'blocksize': workloads[i].blocksize,
+                           'ranking': [{ 'policy': str(policy),
+                                         'path_selector': policy.selector,
+                                         'path_grouping_policy': policy.grouping,
+                                         'rr_min_io_rq': policy.rrMinIORq,
+                                         'result': result.ToDict() } for (policy, result) in ranking] }
+                PerfReport.AddRecord('mpolicy', record)
+            PrintB('>' * 20 + '  End of Multipath Policy Ranking  ' + '>' * 20)
+
+    def PathFailoverIterations(self, iterations):
+        """Blocks a random set of paths with the path handler utility and
+        restores them, iterations times, while IO runs on every multipath
+        device and the paths of all of them are watched in parallel. Reports
+        the distribution of the failover and restore times and of the IO
+        stalls. Returns the number of checks passed, two per iteration."""
+        passed = 0
+        failoverTimes = []
+        restoreTimes = []
+        stallTimes = []
+        iterationRecords = []
+        script = self.storage_conf['pathHandlerUtil']
+        for i in range(iterations):
+            Print("")
+            Print("Iteration %d:\n" % (i + 2))
+            record = { 'iteration': i + 2, 'failover': {}, 'restore': {} }
+            self.ioStreams = []
+            blocked = False
+            try:
+                for mpDevname in self.mapPathConfig.keys():
+                    self.ioStreams.append(IOTimeline.StartStream('/dev/' + mpDevname))
+                time.sleep(STREAM_BASELINE_TIME)
+
+                if not self.RandomlyFailPaths():
+                    raise Exception("Failed to block paths.")
+                blocked = True
+                blockTime = self.lastPathEventTime
+                record['blocked'] = self.blockedpathinfo
+
+                waiters = []
+                for (mpDevname, listPathConfig) in self.mapPathConfig.items():
+                    # Fail path calculation needs to be done only in case of hba SRs
+                    if "blockunblockhbapaths" in script.split('/')[-1]:
+                        #Calculate the number of devices to be found after the path block
+                        devicesToFail = (len(listPathConfig)/self.noOfTotalPaths) * self.noOfPaths
+                    else:
+                        devicesToFail = self.noOfPaths
+                    XenCertPrint("Expected paths of %s to fail: %s" % (mpDevname, devicesToFail))
+                    waiter = WaitForFailover(None, self.mapSCSIid[mpDevname], self.initialActivePaths[mpDevname],
+                                             devicesToFail, self.uevents, mpDevname, blockTime)
+                    waiter.start()
+                    waiters.append((mpDevname, waiter))
+
+                allFailed = True
+                for (mpDevname, waiter) in waiters:
+                    waiter.join()
+                    if waiter.pathsFailed:
+                        Print("    - Paths failover time for %s: %.3f seconds" % (mpDevname, waiter.failoverTime))
+                        failoverTimes.append(waiter.failoverTime)
+                        record['failover'][mpDevname] = waiter.failoverTime
+                    else:
+                        Print("    - Paths of %s did not failover within %d seconds." % (mpDevname, FAILOVER_TIMEOUT))
+                        record['failover'][mpDevname] = None
+                        allFailed = False
+                displayOperationStatus(allFailed)
+                if allFailed:
+                    passed += 1
+
+                blocked = False
+                self.BlockUnblockPaths(False, script, self.noOfPaths, self.blockedpathinfo)
+                unblockTime = self.lastPathEventTime
+                Print(" -> Unblocking paths, waiting for restoration.")
+                pool = WorkerPool.WorkerPool(len(self.mapPathConfig), 0)
+                for mpDevname in self.mapPathConfig.keys():
+                    pool.Add(mpDevname, self.WaitForPathRestore, (mpDevname, unblockTime))
+                allRestored = True
+                for job in pool.Run():
+                    (restored, restoreTime) = (False, RESTORE_TIMEOUT)
+                    if job.exception == None:
+                        (restored, restoreTime) = job.result
+                    if restored:
+                        Print("    - Paths restore time for %s: %.3f seconds" % (job.key, restoreTime))
+                        restoreTimes.append(restoreTime)
+                        record['restore'][job.key] = restoreTime
+                    else:
+                        Print("    - Paths of %s were not restored within %d seconds." % (job.key, RESTORE_TIMEOUT))
+                        record['restore'][job.key] = None
+                        allRestored = False
+                time.sleep(STREAM_BASELINE_TIME)
+            finally:
+                if blocked:
+                    self.BlockUnblockPaths(False, script, self.noOfPaths, self.blockedpathinfo)
+                for stream in self.ioStreams:
+                    stream.Stop()
+
+            for stream in self.ioStreams:
+                self.DisplayIOTimeline(stream)
+                for entry in stream.Timeline():
+                    if entry['event'] == 'block':
+                        stallTimes.append(entry['stall_ms'])
+            self.ioStreams = []
+            iterationRecords.append(record)
+
+            if not allRestored:
+                displayOperationStatus(False, "> %d seconds" % RESTORE_TIMEOUT)
+                # The next iterations would start with paths missing
+                raise Exception("The path restoration took more than %d seconds." % RESTORE_TIMEOUT)
+            displayOperationStatus(True)
+            passed += 1
+
+        PrintB('\tPath failover over %d iterations' % iterations)
+        PrintB('\t  Failover time (s):  %s' % FormatDistribution(failoverTimes))
+        PrintB('\t  Restore time (s):   %s' % FormatDistribution(restoreTimes))
+        PrintB('\t  IO stall (ms):      %s' % FormatDistribution(stallTimes, '%.1f'))
+        PerfReport.AddRecord('failover', { 'iterations': iterationRecords,
+                                           'failover_s': Distribution(failoverTimes),
+                                           'restore_s': Distribution(restoreTimes),
+                                           'stall_ms': Distribution(stallTimes) })
+        return passed
+
+    def PathIOTest(self, ioTest, device):
+        # Execute a disk IO test against a path to the LUN to verify that it is writeable
+        XenCertPrint("First write a small chunk on the device %s to make sure it works." % device)
+        ioTest(device)
+        XenCertPrint("Device %s passed the disk IO test. " % device)
+
+    def DiskDataTest(self, action, device, seed=None, SCSIid=None, iteration=1, checkpoint=None):
+        sample = self.storage_conf.get('sample') or None
+        # Sectors stamped with the SCSI id, so that writes landing on
+        # another LUN are caught
+        cmd = StorageHandlerUtil.DiskDataTestCommand(action, device, iteration, sample, seed, checkpoint, SCSIid)
+        XenCertPrint("The command to be fired is: %s" % cmd)
         DebugCmdArray(cmd)
-        time1 = time.time()
-        util.pread(cmd)
-        duration = time.time() - time1
+        try:
+            stdout = util.pread(cmd)
+        except util.CommandException, e:
+            # The verify ends with the count of bad sectors by class
+            badSectors = [line for line in e.reason.split('\n') if line.startswith('Bad sectors')]
+            if badSectors:
+                PerfReport.AddRecord('datatest', { 'device': device, 'scsiid': SCSIid, 'result': badSectors[-1] })
+                raise Exception("diskdatatest %s failed on %s. %s" % (action, device, badSectors[-1]))
+            raise Exception("diskdatatest %s failed on %s: %s" % (action, device, e.reason.split('\n')[-1]))
+        XenCertPrint("diskdatatest %s passed on %s." % (action, device))
+        for line in stdout.split('\n'):
+            if line.startswith('Resuming') or line.find('already completed') != -1:
+                Print("        %s: %s" % (device, line))
+        m = DISKDATATEST_THROUGHPUT.search(stdout)
+        if m and SCSIid != None:
+            # The next estimates start from what the LUN really achieved
+            if action == 'write':
+                DataTestEstimate.RecordThroughput(SCSIid, write=float(m.group(1)))
+            else:
+                DataTestEstimate.RecordThroughput(SCSIid, read=float(m.group(1)))
+        if sample and action == 'verify':
+            # Coverage of the sample and confidence that the unsampled
+            # part of the LUN is sound
+            for line in stdout.split('\n'):
+                if line.startswith('Sampled') or line.startswith('Confidence'):
+                    Print("        %s: %s" % (device, line))
+
+    def EstimateDataTestTime(self, lunDevices, lunSizes, lunToPaths):
+        """Projects the seconds the data tests take to write and verify
+        lunSizes (SCSI id -> MiB), from the throughput of each LUN either
+        remembered from an earlier run or measured through lunDevices (SCSI
+        id -> device), all LUNs at once. Each LUN is written once and read
+        back through every other path in lunToPaths, as RunPathIOTests
+        does. A run to resume is only charged what its checkpoints have
+        left, and its LUNs are not written to measure them, which would
+        overwrite the pattern. Returns (expected, low, high)."""
+        workers = int(self.storage_conf.get('pathworkers') or WorkerPool.DEFAULT_WORKERS)
+        groupLimit = int(self.storage_conf.get('grouplimit') or WorkerPool.DEFAULT_GROUP_LIMIT)
+        run = None
+        if self.storage_conf.get('resume'):
+            run = DataTestCheckpoint.Resumable(self.storage_conf.get('sample') or None)
+        throughputs = DataTestEstimate.GetThroughputs(lunDevices, workers, run != None)
+
+        def left(SCSIid, paths, action, device=None):
+            # MiB of the write or of a verify of a LUN still to do
+            if run == None:
+                return lunSizes[SCSIid]
+            # The path IO test of a path not tested yet overwrites the pattern
+            for (path, groups) in paths:
+                if not run.PathIOResult(SCSIid, path)[0]:
+                    return lunSizes[SCSIid]
+            (done, complete) = DataTestCheckpoint.Progress(DataTestCheckpoint.CheckpointFile(SCSIid, action, device))
+            if complete:
+                return 0
+            return max(0, lunSizes[SCSIid] - done * StorageHandlerUtil.DISKDATATEST_BUFFER_MB)
+
+        writes = {}
+        verifies = {}
+        for SCSIid in lunSizes.keys():
+            if not throughputs.has_key(SCSIid):
+                PrintY("   The throughput of the LUN with SCSI ID %s could not be measured, it is left out of the run time." % SCSIid)
+                continue
+            # The first path writes, the others verify, or the first one
+            # alone when there are no others
+            paths = lunToPaths.get(SCSIid, [])
+            writes[SCSIid] = left(SCSIid, paths, 'write')
+            verifies[SCSIid] = [(left(SCSIid, paths, 'verify', device), groups) for (device, groups) in paths[1:] or paths[:1]]
+            throughput = throughputs[SCSIid]
+            XenCertPrint("LUN %s: %d MiB to test, %d MiB left to write and %d MiB to verify through %d paths, write %.1f MB/s, read %.1f MB/s +/- %.0f%% ( %s )" %
+                         (SCSIid, lunSizes[SCSIid], writes[SCSIid], sum([v[0] for v in verifies[SCSIid]]), max(1, len(verifies[SCSIid])),
+                          throughput.write, throughput.read, throughput.uncertainty * 100, throughput.source))
+        (expected, low, high) = DataTestEstimate.ProjectTime(writes, throughputs, workers, verifies, groupLimit)
+        PerfReport.AddRecord('estimate', { 'expected_s': expected,
+                                           'low_s': low,
+                                           'high_s': high,
+                                           'resumed': run != None,
+                                           'verify_paths': dict([(SCSIid, max(1, len(verifies[SCSIid]))) for SCSIid in writes.keys()]),
+                                           'luns': dict([(SCSIid, throughputs[SCSIid].ToDict()) for SCSIid in writes.keys()]) })
+        return (int(expected), int(low), int(high))
+
+    def DataTestTimeLimitMessage(self, lunSizes, seconds):
+        """Explains that the data tests of lunSizes (SCSI id -> MiB to test)
+        taking seconds run over timeLimitFunctional, with the size or the
+        sample of each LUN which would fit"""
+        fitInMiB = timeLimitFunctional * 60 * 60 * sum(lunSizes.values()) / seconds
+        if self.storage_conf.get('sample'):
+            return ("The disk IO tests will take more than %s hours, please sample at most %dM of each LUN with --sample." %
+                    (timeLimitFunctional, fitInMiB / len(lunSizes)))
+        return ("The disk IO tests will take more than %s hours, please restrict the total disk sizes above to %d GiB or sample %dM of each LUN with --sample." %
+                (timeLimitFunctional, fitInMiB / 1024, fitInMiB / len(lunSizes)))
+
+    def RunPathIOTests(self, type, ioTest, lunToPaths, quickTest):
+        """Runs the IO tests of every path of every LUN on a bounded pool of
+        threads. lunToPaths maps SCSI id -> list of (device, groups) where
+        groups are the HBA/portal the path goes through. Performance tests
+        run one path at a time so that paths do not skew each other.
+
+        Unless quickTest, the data pattern of each LUN is written once
+        through its first working path and then verified through all its
+        other paths at once, which also checks that every path sees the
+        data written through another one. The progress is checkpointed and,
+        with the resume option, an interrupted run goes on where it stopped.
+        Returns SCSI id -> list of (device, exception or None)."""
+        workers = int(self.storage_conf.get('pathworkers') or WorkerPool.DEFAULT_WORKERS)
+        groupLimit = int(self.storage_conf.get('grouplimit') or WorkerPool.DEFAULT_GROUP_LIMIT)
+        if type == 'Perf':
+            workers = 1
+        XenCertPrint("Testing LUN paths with %d workers, at most %d per HBA or portal." % (workers, groupLimit))
+
+        def runStage(jobs):
+            # jobs are (key, device, groups, func, args), returns
+            # (key, device) -> exception or None
+            pool = WorkerPool.WorkerPool(workers, groupLimit)
+            for (key, device, groups, func, args) in jobs:
+                pool.Add((key, device), func, args, groups)
+            outcome = {}
+            for job in pool.Run():
+                outcome[job.key] = job.exception
+            return outcome
+
+        run = None
+        if not quickTest:
+            # The same seed makes write and verify pick the same regions
+            seed = None
+            sample = self.storage_conf.get('sample') or None
+            if sample:
+                seed = random.randint(1, 2 ** 31 - 1)
+            run = DataTestCheckpoint.Start(sample, seed, self.storage_conf.get('resume'))
+            if sample:
+                Print("   Sampling %s of each LUN with seed %d." % (sample, run.seed))
+
+        # The small IO test overwrites the start of the device, so it runs
+        # on every path before any pattern is written. A resumed run keeps
+        # the outcome of the paths already tested.
+        exceptions = {}
+        jobs = []
+        for key in lunToPaths.keys():
+            for (device, groups) in lunToPaths[key]:
+                if run != None:
+                    (done, error) = run.PathIOResult(key, device)
+                    if done:
+                        if error != None:
+                            exceptions[(key, device)] = Exception(error)
+                        else:
+                            exceptions[(key, device)] = None
+                        continue
+                    # The pattern written so far is about to be overwritten
+                    DataTestCheckpoint.Clear(key)
+                jobs.append((key, device, groups, self.PathIOTest, (ioTest, device)))
+        tested = runStage(jobs)
+        for jobKey in tested.keys():
+            exceptions[jobKey] = tested[jobKey]
+            if run != None:
+                error = None
+                if tested[jobKey] != None:
+                    error = str(tested[jobKey])
+                run.RecordPathIO(jobKey[0], jobKey[1], error)
+        if run != None and jobs:
+            run.Save()
+
+        if not quickTest:
+            writers = {}
+            jobs = []
+            for key in lunToPaths.keys():
+                for (device, groups) in lunToPaths[key]:
+                    if exceptions[(key, device)] == None:
+                        writers[key] = (device, groups)
+                        jobs.append((key, device, groups, self.DiskDataTest,
+                                     ('write', device, run.seed, key, run.iteration,
+                                      DataTestCheckpoint.CheckpointFile(key, 'write'))))
+                        break
+            if jobs:
+                Print("   Writing the data pattern once per LUN, then verifying it over all the other paths at once.")
+            written = runStage(jobs)
+
+            jobs = []
+            for key in writers.keys():
+                (writer, writerGroups) = writers[key]
+                if written[(key, writer)] != None:
+                    exceptions[(key, writer)] = written[(key, writer)]
+                    for (device, groups) in lunToPaths[key]:
+                        if device != writer and exceptions[(key, device)] == None:
+                            exceptions[(key, device)] = Exception("Not verified, writing the data pattern through %s failed." % writer)
+                    continue
+                verifiers = []
+                for (device, groups) in lunToPaths[key]:
+                    if device != writer and exceptions[(key, device)] == None:
+                        verifiers.append((device, groups))
+                if not verifiers:
+                    verifiers = [(writer, writerGroups)]
+                XenCertPrint("LUN %s written through %s, verifying through %s" % (key, writer, [v[0] for v in verifiers]))
+                for (device, groups) in verifiers:
+                    jobs.append((key, device, groups, self.DiskDataTest,
+                                 ('verify', device, run.seed, key, run.iteration,
+                                  DataTestCheckpoint.CheckpointFile(key, 'verify', device))))
+            verified = runStage(jobs)
+            for jobKey in verified.keys():
+                exceptions[jobKey] = verified[jobKey]
+
+            # The checkpoints are only kept to retry what failed
+            if not [e for e in written.values() + verified.values() if e != None]:
+                DataTestCheckpoint.Clear()
+
+        results = {}
+        for key in lunToPaths.keys():
+            results[key] = []
+            for (device, groups) in lunToPaths[key]:
+                results[key].append((device, exceptions[(key, device)]))
+        return results
+
+    def GetWorkloads(self):
+        blocksize = None
+        if self.storage_conf.get('blocksize'):
+            blocksize = IOEngine.ParseSize(self.storage_conf['blocksize'])
+        duration = IOEngine.DEFAULT_DURATION
+        if self.storage_conf.get('duration'):
+            duration = int(self.storage_conf['duration'])
+        warmup = IOEngine.DEFAULT_WARMUP
+        if self.storage_conf.get('warmup'):
+            warmup = int(self.storage_conf['warmup'])
+        return IOEngine.ParseWorkloads(self.storage_conf.get('workloads'), blocksize, duration, warmup)
+
+    def DisplayPerformanceResults(self, results):
         PrintB('>' * 20 + '  Start of Performance Test Result  ' + '>' * 20)
-        PrintB('\tTest1 : %sMB Data Writen in %.2f seconds, Throuput %.2f MB/s' % (size, duration, size/duration))
+        if results:
+            PrintB('\tTarget: %s' % results[0].target)
+        testNo = 0
+        for result in results:
+            testNo += 1
+            PrintB('\tTest%d : %-9s bs=%-5s %sMB Data in %.2f seconds, Throuput %.2f MB/s, IOPS %.1f, Latency avg %.3f ms max %.3f ms' %
+                   (testNo, result.workload.name, IOEngine.FormatSize(result.workload.blocksize), result.bytes / IOEngine.MiB,
+                    result.elapsed, result.Throughput(), result.IOPS(), result.AverageLatency(), result.latencyMax * 1000))
+            PrintB('\t        Latency %s' % FormatPercentiles(result.histogram))
+            if result.cpu != None:
+                (processPerIO, systemPerIO) = result.CPUPerIO()
+                (processPerMB, systemPerMB) = result.CPUPerMB()
+                PrintB('\t        CPU %.1f us/IO, %.0f us/MB ( XenCert ), %.1f us/IO, %.0f us/MB ( all CPUs, softirq %.2f s )' %
+                       (processPerIO, processPerMB, systemPerIO, systemPerMB, result.cpu.system['softirq']))
+            (steadyStart, steadyThroughput, steadyCV) = result.SteadyState()
+            if steadyStart != None:
+                PrintB('\t        Steady state from %.0f seconds after warm-up: %.2f MB/s, variation %.1f%%' % (steadyStart, steadyThroughput, steadyCV * 100))
+            else:
+                PrintY('\t        Steady state not reached, throughput varied by %.1f%%, consider a longer duration' % (steadyCV * 100))
         PrintB('>' * 20 + '  End of Performance Test Result  ' + '>' * 20)
 
+    def GetBufferPool(self):
+        # Generated once and shared by every performance workload of the run
+        if getattr(self, 'bufferPool', None) == None:
+            compress = float(self.storage_conf.get('compress') or 1)
+            dedupe = float(self.storage_conf.get('dedupe') or 1)
+            self.bufferPool = IOEngine.BufferPool(compress, dedupe)
+        return self.bufferPool
+
+    def GetPerfModes(self):
+        return ParsePerfModes(self.storage_conf.get('perfmode'))
+
+    def CheckPerformanceResults(self, results, path):
+        for result in results:
+            if result.errors:
+                raise Exception("%d IO errors during %s on %s." % (result.errors, result.workload, path))
+
+    def QueueDepthSweep(self, path, workloads, size=None):
+        depths = IOEngine.ParseDepths(self.storage_conf.get('depths'))
+        for workload in workloads:
+            (results, saturation) = IOEngine.QueueDepthSweep(path, workload, depths, size, pool=self.GetBufferPool())
+            PrintB('>' * 20 + '  Queue Depth Sweep %s on %s  ' % (workload, path) + '>' * 20)
+            PrintB('\t%-6s %12s %12s %16s %12s %12s' % ('Depth', 'IOPS', 'MB/s', 'Latency avg(ms)', 'p99(ms)', 'p99.9(ms)'))
+            for result in results:
+                PrintB('\t%-6d %12.1f %12.2f %16.3f %12.3f %12.3f' % (result.depth, result.IOPS(), result.Throughput(), result.AverageLatency(),
+                       result.histogram.Percentile(99), result.histogram.Percentile(99.9)))
+                PerfReport.AddRecord('qdsweep', result.ToDict())
+            PrintB('\tThroughput stops scaling beyond depth %s' % saturation)
+            PrintB('>' * 20 + '  End of Queue Depth Sweep  ' + '>' * 20)
+            self.CheckPerformanceResults(results, path)
+
+    def BlockSizeSweep(self, path, workloads, size=None):
+        blocksizes = IOEngine.ParseBlockSizes(self.storage_conf.get('blocksizes'))
+        header = ['target', 'workload', 'blocksize', 'throughput_mbs', 'iops', 'latency_avg_ms', 'latency_p99_ms']
+        for workload in workloads:
+            results = IOEngine.BlockSizeSweep(path, workload, blocksizes, size, pool=self.GetBufferPool())
+            PrintB('>' * 20 + '  Block Size Sweep %s on %s  ' % (workload.name, path) + '>' * 20)
+            PrintB('\t%-10s %12s %12s %16s %12s' % ('Block size', 'MB/s', 'IOPS', 'Latency avg(ms)', 'p99(ms)'))
+            for result in results:
+                PrintB('\t%-10s %12.2f %12.1f %16.3f %12.3f' % (IOEngine.FormatSize(result.workload.blocksize), result.Throughput(),
+                       result.IOPS(), result.AverageLatency(), result.histogram.Percentile(99)))
+                PerfReport.AddRecord('bssweep', result.ToDict())
+                PerfReport.AppendCSV('bssweep', header, [path, result.workload.name, result.workload.blocksize, '%.2f' % result.Throughput(),
+                                     '%.1f' % result.IOPS(), '%.3f' % result.AverageLatency(), '%.3f' % result.histogram.Percentile(99)])
+            PrintB('>' * 20 + '  End of Block Size Sweep  ' + '>' * 20)
+            self.CheckPerformanceResults(results, path)
+
+    def AggregatePerformance(self, lunToPaths):
+        """Drives every path of every LUN at the same time and reports the
+        total throughput and how it was shared among LUNs and HBAs/portals.
+        lunToPaths is as for RunPathIOTests."""
+        paths = []
+        pathToLun = {}
+        pathToGroups = {}
+        for key in lunToPaths.keys():
+            for (device, groups) in lunToPaths[key]:
+                paths.append(device)
+                pathToLun[device] = key
+                pathToGroups[device] = groups
+        if not paths:
+            return
+
+        for workload in self.GetWorkloads():
+            (results, cpu) = IOEngine.AggregateRun(paths, workload, pool=self.GetBufferPool())
+            total = 0.0
+            totalIOPS = 0.0
+            totalIOs = 0
+            totalBytes = 0
+            lunShare = {}
+            groupShare = {}
+            for result in results:
+                total += result.Throughput()
+                totalIOPS += result.IOPS()
+                totalIOs += result.ios
+                totalBytes += result.bytes
+                lun = pathToLun[result.target]
+                lunShare[lun] = lunShare.get(lun, 0.0) + result.Throughput()
+                for group in pathToGroups[result.target]:
+                    groupShare[group] = groupShare.get(group, 0.0) + result.Throughput()
+
+            PrintB('>' * 20 + '  Aggregate Throughput %s across %d LUNs, %d paths  ' % (workload, len(lunShare), len(paths)) + '>' * 20)
+            PrintB('\tTotal: %.2f MB/s, IOPS %.1f' % (total, totalIOPS))
+            (processPerIO, systemPerIO) = cpu.PerIO(totalIOs)
+            (processPerMB, systemPerMB) = cpu.PerMB(totalBytes)
+            PrintB('\tCPU: %.1f us/IO, %.0f us/MB ( XenCert ), %.1f us/IO, %.0f us/MB ( all CPUs, softirq %.2f s )' %
+                   (processPerIO, processPerMB, systemPerIO, systemPerMB, cpu.system['softirq']))
+            PrintB('\t%-36s %12s %8s' % ('LUN', 'MB/s', 'Share'))
+            for lun in lunShare.keys():
+                PrintB('\t%-36s %12.2f %7.1f%%' % (lun, lunShare[lun], lunShare[lun] * 100 / max(total, 0.001)))
+            PrintB('\t%-36s %12s %8s' % ('HBA/Portal', 'MB/s', 'Share'))
+            for group in groupShare.keys():
+                PrintB('\t%-36s %12.2f %7.1f%%' % (group, groupShare[group], groupShare[group] * 100 / max(total, 0.001)))
+            PrintB('>' * 20 + '  End of Aggregate Throughput  ' + '>' * 20)
+
+            record = { 'workload': workload.name,
+                       'blocksize': workload.blocksize,
+                       'throughput_mbs': total,
+                       'iops': totalIOPS,
+                       'luns': lunShare,
+                       'groups': groupShare,
+                       'cpu': cpu.ToDict(totalIOs, totalBytes),
+                       'paths': [result.ToDict() for result in results] }
+            PerfReport.AddRecord('aggregate', record)
+            self.CheckPerformanceResults(results, 'all LUNs')
+
+    def ALUAPerformance(self, lunToPaths):
+        """Benchmarks each ALUA target port group of every LUN on its own,
+        driving all the paths of the group at once, and reports the
+        throughput and latency penalty of the non-optimized groups against
+        the optimized one. lunToPaths is as for RunPathIOTests."""
+        for key in lunToPaths.keys():
+            devices = [device for (device, groups) in lunToPaths[key]]
+            portGroups = ALUA.GetPortGroups(devices)
+            PrintB('>' * 20 + '  ALUA Port Groups of %s  ' % key + '>' * 20)
+            for portGroup in portGroups:
+                PrintB('\tGroup %-28s paths %s' % (portGroup, ', '.join(portGroup.devices)))
+            active = [g for g in portGroups if g.state in ALUA.ACTIVE_STATES]
+            optimized = [g for g in active if g.state == ALUA.ACTIVE_OPTIMIZED]
+            nonOptimized = [g for g in active if g.state == ALUA.ACTIVE_NON_OPTIMIZED]
+            if not optimized or not nonOptimized:
+                PrintY('\tNo active/optimized and active/non-optimized groups to compare, skipping LUN %s.' % key)
+                PrintB('>' * 20 + '  End of ALUA Port Groups  ' + '>' * 20)
+                continue
+
+            for workload in self.GetWorkloads():
+                PrintB('\t%s' % workload)
+                PrintB('\t%-32s %6s %12s %12s %16s %12s' % ('Group', 'Paths', 'MB/s', 'IOPS', 'Latency avg(ms)', 'p99(ms)'))
+                groupResults = []
+                for portGroup in active:
+                    (results, cpu) = IOEngine.AggregateRun(portGroup.devices, workload, pool=self.GetBufferPool())
+                    self.CheckPerformanceResults(results, str(portGroup))
+                    total = IOEngine.WorkloadResult(workload, ','.join(portGroup.devices))
+                    for result in results:
+                        total.Merge(result)
+                    total.cpu = cpu
+                    groupResults.append((portGroup, total))
+                    PrintB('\t%-32s %6d %12.2f %12.1f %16.3f %12.3f' % (portGroup, len(portGroup.devices), total.Throughput(),
+                           total.IOPS(), total.AverageLatency(), total.histogram.Percentile(99)))
+
+                # Paths of the optimized groups are the reference
+                reference = IOEngine.WorkloadResult(workload, 'optimized')
+                for (portGroup, total) in groupResults:
+                    if portGroup.state == ALUA.ACTIVE_OPTIMIZED:
+                        reference.Merge(total)
+                referencePaths = sum([len(g.devices) for g in optimized])
+                referencePerPath = reference.Throughput() / referencePaths
+                penalties = []
+                for (portGroup, total) in groupResults:
+                    if portGroup.state != ALUA.ACTIVE_NON_OPTIMIZED:
+                        continue
+                    # Per path figures so that groups of different sizes compare
+                    perPath = total.Throughput() / len(portGroup.devices)
+                    throughputPenalty = 0.0
+                    if referencePerPath > 0:
+                        throughputPenalty = (1 - perPath / referencePerPath) * 100
+                    latencyRatio = 0.0
+                    if reference.histogram.Percentile(99) > 0:
+                        latencyRatio = total.histogram.Percentile(99) / reference.histogram.Percentile(99)
+                    averageRatio = 0.0
+                    if reference.AverageLatency() > 0:
+                        averageRatio = total.AverageLatency() / reference.AverageLatency()
+                    if throughputPenalty > 0:
+                        PrintY('\tGroup %s: %.1f%% less throughput per path, average latency %.2fx, p99 latency %.2fx of the optimized paths' %
+                               (portGroup, throughputPenalty, averageRatio, latencyRatio))
+                    else:
+                        PrintB('\tGroup %s: no throughput penalty per path, average latency %.2fx, p99 latency %.2fx of the optimized paths' %
+                               (portGroup, averageRatio, latencyRatio))
+                    penalties.append({ 'group': portGroup.group,
+                                       'throughput_penalty_pct': throughputPenalty,
+                                       'latency_avg_ratio': averageRatio,
+                                       'latency_p99_ratio': latencyRatio })
+
+                record = { 'lun': key,
+                           'workload': workload.name,
+                           'blocksize': workload.blocksize,
+                           'groups': [{ 'group': g.group,
+                                        'state': g.state,
+                                        'paths': g.devices,
+                                        'result': total.ToDict() } for (g, total) in groupResults],
+                           'penalties': penalties }
+                PerfReport.AddRecord('alua', record)
+            PrintB('>' * 20 + '  End of ALUA Port Groups  ' + '>' * 20)
+
+    def RunPerformanceWorkloads(self, path, size=None):
+        workloads = self.GetWorkloads()
+        XenCertPrint("Running performance workloads %s against %s" % ([str(w) for w in workloads], path))
+        results = IOEngine.RunWorkloads(path, workloads, size, pool=self.GetBufferPool())
+        self.DisplayPerformanceResults(results)
+        for result in results:
+            PerfReport.AddRecord('workload', result.ToDict())
+        self.CheckPerformanceResults(results, path)
+
+        modes = self.GetPerfModes()
+        if 'qdsweep' in modes:
+            self.QueueDepthSweep(path, workloads, size)
+        if 'bssweep' in modes:
+            self.BlockSizeSweep(path, workloads, size)
+        return results
+
+    def RawDiskPerformance(self, diskpath):
+        return self.RunPerformanceWorkloads(diskpath)
+
     def RawDiskFunctional(self, diskpath):
         cmd = ['dd', 'if=/dev/zero', 'of=%s' % diskpath, 'bs=1M', 'count=1', 'conv=nocreat', 'oflag=direct']
         DebugCmdArray(cmd)
         util.pread(cmd)
 
     def FileSystemPerformance(self, testfile):
-        size = 1000
-        cmd = ['dd', 'if=/dev/zero', 'of=%s' % testfile, 'bs=1M', 'count=%s' % size, 'oflag=direct']
-        DebugCmdArray(cmd)
-        time1 = time.time()
-        (rc, stdout, stderr) = util.doexec(cmd, '')
-        duration = time.time() - time1
-        PrintB('>' * 20 + '  Start of Performance Test Result  ' + '>' * 20)
-        PrintB('\tTest1 : %sMB Data Writen in %.2f seconds, Throuput %.2f MB/s' % (size, duration, size/duration))
-        PrintB('>' * 20 + '  End of Performance Test Result  ' + '>' * 20)
-        return (rc, stdout, stderr)
+        try:
+            engine = IOEngine.IOEngine(testfile, IOEngine.DEFAULT_FILE_SIZE)
+            engine.Prepare()
+            self.RunPerformanceWorkloads(testfile, IOEngine.DEFAULT_FILE_SIZE)
+        except Exception, e:
+            return (1, '', str(e))
+        return (0, '', '')
 
     def FileSystemFunctional(self, testfile):
         cmd = ['dd', 'if=/dev/zero', 'of=%s' % testfile, 'bs=1M', 'count=1', 'oflag=direct']
@@ -482,10 +1165,12 @@ class StorageHandlerISCSI(StorageHandler):
 
     def DisplayPathStatus(self):
         for (mpDevname, listPathConfig) in self.mapPathConfig.items():
+            probes = self.ProbePaths(listPathConfig)
             PrintY("       Multipath Mapping Device on %s" % mpDevname)
-            Print("       %-15s %-15s %-25s %-15s" % ('IP address', 'HBTL','Path DM status','Path status')            )
+            Print("       %-15s %-15s %-25s %-15s %-22s" % ('IP address', 'HBTL','Path DM status','Path status', 'TUR/4K read p50 ms')            )
             for item in listPathConfig:
-                Print("       %-15s %-15s %-25s %-15s" % (StorageHandlerUtil.findIPAddress(self.mapIPToHost, item[0]), item[0], item[1], item[2]))
+                Print("       %-15s %-15s %-25s %-15s %-22s" % (StorageHandlerUtil.findIPAddress(self.mapIPToHost, item[0]), item[0], item[1], item[2], self.FormatProbe(probes.get(item[0]))))
+            self.DisplaySlowPaths(mpDevname, probes)
             
     def RandomlyFailPaths(self):
         try:
@@ -569,7 +1254,10 @@ class StorageHandlerISCSI(StorageHandler):
         checkPoint = 0
         totalCheckPoints = 4
         timeForIOTestsInSec = 0
-        totalSizeInMiB = 0
+        # SCSI id -> device its throughput is measured through, and MiB
+        # of it the data tests write and verify
+        lunDevices = {}
+        lunSizes = {}
         quickTest = False
 
         try:
@@ -651,15 +1339,14 @@ class StorageHandlerISCSI(StorageHandler):
                         Print("     %-23s\t%-4s\t%-34s\t%-10s" % (portal, key, lunToScsi[key][0], size))
 
                         devname = lunToScsi[key][1]
-                        if os.path.realpath(util.getrootdev()) != devname and not quickTest:
-                            timeForIOTestsInSec += StorageHandlerUtil.FindDiskDataTestEstimate(devname, size)
+                        if os.path.realpath(util.getrootdev()) != devname and not quickTest and not lunDevices.has_key(lunToScsi[key][0]):
+                            lunDevices[lunToScsi[key][0]] = devname
+                            lunSizes[lunToScsi[key][0]] = size * StorageHandlerUtil.SampleFraction(self.storage_conf.get('sample'), size)
 
                         if scsiToTupleMap.has_key(lunToScsi[key][0]):
                             scsiToTupleMap[lunToScsi[key][0]].append(( portal, iqn, lunToScsi[key][1]))
                         else:
                             scsiToTupleMap[lunToScsi[key][0]] = [( portal, iqn, lunToScsi[key][1])]
-                        
-                        totalSizeInMiB += size                                                   
                 except Exception, e:
                     Print("     ERROR: No LUNs reported by portal %s for iqn %s. Exception: %s" % (portal, iqn, str(e)))
                     XenCertPrint("     ERROR: No LUNs reported by portal %s for iqn %s." % (portal, iqn))
@@ -681,7 +1368,16 @@ class StorageHandlerISCSI(StorageHandler):
             Print("   the tests attempt to write to the LUN over each available path and")
             Print("   reports the number of writable paths to each LUN.")
 
+            # Paths behind the root device are not tested.
+            lunToPaths = {}
+            for key in scsiToTupleMap.keys():
+                lunToPaths[key] = []
+                for tuple in scsiToTupleMap[key]:
+                    if os.path.realpath(util.getrootdev()) != tuple[2]:
+                        lunToPaths[key].append((tuple[2], ['portal:' + tuple[0]]))
+
             if not quickTest:                            
+                (timeForIOTestsInSec, lowInSec, highInSec) = self.EstimateDataTestTime(lunDevices, lunSizes, lunToPaths)
                 seconds = timeForIOTestsInSec
                 minutes = 0
                 hrs = 0
@@ -694,7 +1390,7 @@ class StorageHandlerISCSI(StorageHandler):
                         minutes = int(minutes - (hrs * 60))
                 
                 if hrs > timeLimitFunctional or hrs == timeLimitFunctional and minutes > 0:
-                    raise Exception("The disk IO tests will take more than %s hours, please restrict the total disk sizes above to %d GiB." % (timeLimitFunctional, (timeLimitFunctional*60*60*totalSizeInMiB)/timeForIOTestsInSec))
+                    raise Exception(self.DataTestTimeLimitMessage(lunSizes, timeForIOTestsInSec))
                     
                 if hrs > 0:
                     Print("   APPROXIMATE RUN TIME: %s hours, %s minutes, %s seconds." % (hrs, minutes, seconds))
@@ -702,11 +1398,17 @@ class StorageHandlerISCSI(StorageHandler):
                     Print("   APPROXIMATE RUN TIME: %s minutes, %s seconds." % (minutes, seconds))
                 elif seconds > 0:
                     Print("   APPROXIMATE RUN TIME: %s seconds." % seconds)
+                if highInSec > lowInSec:
+                    Print("   RUN TIME RANGE: %s to %s ( hours:minutes:seconds )." % (FormatDuration(lowInSec), FormatDuration(highInSec)))
 
             Print("   START TIME: %s " % (time.asctime(time.localtime())))
             Print("")
-            firstPortal = True
-            lunsMatch = True
+            if type == 'Func':
+                ioTest = self.ISCSIFunctional
+            else:
+                ioTest = self.ISCSIPerformance
+            pathResults = self.RunPathIOTests(type, ioTest, lunToPaths, quickTest)
+
             for key in scsiToTupleMap.keys():                                
                 try:                    
                     totalCheckPoints += 1
@@ -724,37 +1426,17 @@ class StorageHandlerISCSI(StorageHandler):
                             continue
                         
                         pathNo += 1
-        
-                        # Execute a disk IO test against each path to the LUN to verify that it is writeable
-                        # and there is no apparent disk corruption
                         PrintOnSameLine("        Path num: %d. Device: %s" % (pathNo, tuple[2]))
-                        try:
-                            # First write a small chunk on the device to make sure it works                    
-                            XenCertPrint("First write a small chunk on the device %s to make sure it works." % tuple[2])
-
-                            if type == 'Func':
-                                self.ISCSIFunctional(tuple[2])
-                            elif type == 'Perf':
-                                self.ISCSIPerformance(tuple[2])
-
-                            if not quickTest:                            
-                                cmd = [DISKDATATEST, 'write', '1', tuple[2]]
-                                XenCertPrint("The command to be fired is: %s" % cmd)
-                                DebugCmdArray(cmd)
-                                util.pread(cmd)
-                                
-                                cmd = [DISKDATATEST, 'verify', '1', tuple[2]]
-                                XenCertPrint("The command to be fired is: %s" % cmd)
-                                DebugCmdArray(cmd)
-                                util.pread(cmd)
-                                
-                            XenCertPrint("Device %s passed the disk IO test. " % tuple[2])
+                        exception = None
+                        for (device, e) in pathResults[key]:
+                            if device == tuple[2]:
+                                exception = e
+                        if exception == None:
                             pathPassed += 1
                             Print("")
                             displayOperationStatus(True)
-                            
-                        except Exception, e:  
-                            Print("        Exception: %s" % str(e))
+                        else:
+                            Print("        Exception: %s" % str(exception))
                             displayOperationStatus(False)
                             XenCertPrint("Device %s failed the disk IO test. Please check if the disk is writable." % tuple[2] )
                         
@@ -769,6 +1451,20 @@ class StorageHandlerISCSI(StorageHandler):
                 except Exception, e:                    
                     raise Exception("   - Testing failed while testing devices with SCSI ID: %s." % key)
                 
+            if type == 'Perf' and 'aggregate' in self.GetPerfModes():
+                Print("AGGREGATE THROUGHPUT TEST")
+                Print(">> This test drives all the LUNs over all their paths at the same time")
+                Print("   and reports the total throughput and its share per LUN and portal.")
+                self.AggregatePerformance(lunToPaths)
+                displayOperationStatus(True)
+
+            if type == 'Perf' and 'alua' in self.GetPerfModes():
+                Print("ALUA PATH GROUP PERFORMANCE TEST")
+                Print(">> This test drives each ALUA target port group of every LUN on its own")
+                Print("   and reports the penalty of the active/non-optimized paths.")
+                self.ALUAPerformance(lunToPaths)
+                displayOperationStatus(True)
+
             Print("   END TIME: %s " % (time.asctime(time.localtime())))
             
             checkPoint += 1
@@ -840,6 +1536,7 @@ class StorageHandlerHBA(StorageHandler):
                     raise Exception("Failed to get path status information for SCSI Id: %s" % SCSIid)
                 XenCertPrint("The path status extracted from multipathd is %s" % listPathConfig)
                 self.mapPathConfig[mpDevname] = listPathConfig
+                self.mapSCSIid[mpDevname] = SCSIid
             
             return True
         except Exception, e:
@@ -848,10 +1545,12 @@ class StorageHandlerHBA(StorageHandler):
 
     def DisplayPathStatus(self):
         for (mpDevname, listPathConfig) in self.mapPathConfig.items():
+            probes = self.ProbePaths(listPathConfig)
             PrintY("       Multipath Mapping Device on %s" % mpDevname)
-            Print("       %-15s %-25s %-15s" % ('HBTL','Path DM status','Path status')            )
+            Print("       %-15s %-25s %-15s %-22s" % ('HBTL','Path DM status','Path status', 'TUR/4K read p50 ms')            )
             for item in listPathConfig:
-                Print("       %-15s %-25s %-15s" % (item[0], item[1], item[2]))
+                Print("       %-15s %-25s %-15s %-22s" % (item[0], item[1], item[2], self.FormatProbe(probes.get(item[0]))))
+            self.DisplaySlowPaths(mpDevname, probes)
             
     def RandomlyFailPaths(self):
         try:
@@ -892,7 +1591,10 @@ class StorageHandlerHBA(StorageHandler):
         checkPoint = 0
         totalCheckPoints = 3
         timeForIOTestsInSec = 0
-        totalSizeInMiB = 0
+        # SCSI id -> device its throughput is measured through, and MiB
+        # of it the data tests write and verify
+        lunDevices = {}
+        lunSizes = {}
         quickTest = False
 
         if self.storage_conf['type'] == 'q' or self.storage_conf == 'quick':
@@ -945,6 +1647,8 @@ class StorageHandlerHBA(StorageHandler):
             hostIdToLunList = {}
             # map from SCSI id -> list of devices
             scsiToTupleMap = {}
+            # map from device -> host id
+            deviceToHost = {}
             for map in listMaps:
                 try:
                     (rVal, listLunInfo) = StorageHandlerUtil.GetLunInformation(map['id'])
@@ -981,16 +1685,16 @@ class StorageHandlerHBA(StorageHandler):
                         Print("     %-4s\t%-34s\t%-20s\t%-10s" % (lun['id'], lun['SCSIid'], lun['device'], size))
 
                         devname = lun['device']
-                        if os.path.realpath(util.getrootdev()) != devname and not quickTest:
-                            timeForIOTestsInSec += StorageHandlerUtil.FindDiskDataTestEstimate(devname, size)
+                        if os.path.realpath(util.getrootdev()) != devname and not quickTest and not lunDevices.has_key(lun['SCSIid']):
+                            lunDevices[lun['SCSIid']] = devname
+                            lunSizes[lun['SCSIid']] = size * StorageHandlerUtil.SampleFraction(self.storage_conf.get('sample'), size)
 
                         if scsiToTupleMap.has_key(lun['SCSIid']):
                             scsiToTupleMap[lun['SCSIid']].append(lun['device'])
                         else:
                             scsiToTupleMap[lun['SCSIid']] = [lun['device']]
+                        deviceToHost[lun['device']] = map['id']
                         
-                        totalSizeInMiB += size           
-
                 except Exception, e:
                     Print("     EXCEPTION: No LUNs reported for host id %s." % map['id'])
                     continue
@@ -1004,7 +1708,17 @@ class StorageHandlerHBA(StorageHandler):
             Print("   that they are writeable and there is no apparent disk corruption.")
             Print("   the tests attempt to write to the LUN over each available path and")
             Print("   reports the number of writable paths to each LUN.")
+
+            # Paths behind the root device are not tested.
+            lunToPaths = {}
+            for key in scsiToTupleMap.keys():
+                lunToPaths[key] = []
+                for device in scsiToTupleMap[key]:
+                    if os.path.realpath(util.getrootdev()) != device:
+                        lunToPaths[key].append((device, ['host:' + deviceToHost[device]]))
+
             if not quickTest:
+                (timeForIOTestsInSec, lowInSec, highInSec) = self.EstimateDataTestTime(lunDevices, lunSizes, lunToPaths)
                 seconds = timeForIOTestsInSec
                 minutes = 0
                 hrs = 0
@@ -1017,18 +1731,27 @@ class StorageHandlerHBA(StorageHandler):
                         minutes = int(minutes - (hrs * 60))
                 
                 if hrs > timeLimitFunctional or hrs == timeLimitFunctional and minutes > 0:
-                    raise Exception("The disk IO tests will take more than %s hours, please restrict the total disk sizes above to %d GiB." % (timeLimitFunctional, (timeLimitFunctional*60*60*totalSizeInMiB)/timeForIOTestsInSec))                
+                    raise Exception(self.DataTestTimeLimitMessage(lunSizes, timeForIOTestsInSec))
 
                 if hrs > 0:
                     Print("   APPROXIMATE RUN TIME: %s hours, %s minutes, %s seconds." % (hrs, minutes, seconds))
                 elif minutes > 0:
                     Print("   APPROXIMATE RUN TIME: %s minutes, %s seconds." % (minutes, seconds))
                 elif seconds > 0:
-                    Print("   APPROXIMATE RUN TIME: %s seconds." % seconds)            
+                    Print("   APPROXIMATE RUN TIME: %s seconds." % seconds)
+                if highInSec > lowInSec:
+                    Print("   RUN TIME RANGE: %s to %s ( hours:minutes:seconds )." % (FormatDuration(lowInSec), FormatDuration(highInSec)))
             
             Print("   START TIME: %s " % (time.asctime(time.localtime())))
             Print("")            
             totalCheckPoints += 1
+
+            if type == 'Func':
+                ioTest = self.HBAFunctional
+            else:
+                ioTest = self.HBAPerformance
+            pathResults = self.RunPathIOTests(type, ioTest, lunToPaths, quickTest)
+
             for key in scsiToTupleMap.keys():
                 try:
                     totalCheckPoints += 1
@@ -1046,35 +1769,17 @@ class StorageHandlerHBA(StorageHandler):
                             continue
 
                         pathNo += 1
-                        
-                        # Execute a disk IO test against each path to the LUN to verify that it is writeable
-                        # and there is no apparent disk corruption
                         PrintOnSameLine("        Path num: %d. Device: %s" % (pathNo, device))
-                        try:
-                            # First write a small chunk on the device to make sure it works
-                            XenCertPrint("First write a small chunk on the device %s to make sure it works." % device)
-
-                            if type == 'Func':
-                                self.HBAFunctional(device)
-                            elif type == 'Perf':
-                                self.HBAPerformance(device)
-
-                            if not quickTest:                            
-                                cmd = [DISKDATATEST, 'write', '1', device]
-                                XenCertPrint("The command to be fired is: %s" % cmd)
-                                util.pread(cmd)
-                                
-                                cmd = [DISKDATATEST, 'verify', '1', device]
-                                XenCertPrint("The command to be fired is: %s" % cmd)
-                                util.pread(cmd)
-                                
-                            XenCertPrint("Device %s passed the disk IO test. " % device)
+                        exception = None
+                        for (path, e) in pathResults[key]:
+                            if path == device:
+                                exception = e
+                        if exception == None:
                             pathPassed += 1
                             Print("")
                             displayOperationStatus(True)
-
-                        except Exception, e:
-                            Print("        Exception: %s" % str(e))
+                        else:
+                            Print("        Exception: %s" % str(exception))
                             displayOperationStatus(False)
                             XenCertPrint("Device %s failed the disk IO test. Please check if the disk is writable." % device )
                     if pathPassed == 0 and not rootDevice:
@@ -1088,6 +1793,20 @@ class StorageHandlerHBA(StorageHandler):
                 except Exception, e:
                     raise Exception("   - Testing failed while testing devices with SCSI ID: %s." % key)
 
+            if type == 'Perf' and 'aggregate' in self.GetPerfModes():
+                Print("AGGREGATE THROUGHPUT TEST")
+                Print(">> This test drives all the LUNs over all their paths at the same time")
+                Print("   and reports the total throughput and its share per LUN and HBA.")
+                self.AggregatePerformance(lunToPaths)
+                displayOperationStatus(True)
+
+            if type == 'Perf' and 'alua' in self.GetPerfModes():
+                Print("ALUA PATH GROUP PERFORMANCE TEST")
+                Print(">> This test drives each ALUA target port group of every LUN on its own")
+                Print("   and reports the penalty of the active/non-optimized paths.")
+                self.ALUAPerformance(lunToPaths)
+                displayOperationStatus(True)
+
             Print("   END TIME: %s " % (time.asctime(time.localtime())))
             checkPoint += 1
 
@@ -61,6 +61,11 @@ BUF_ZEROS = "\0" * 512
 
 DISKDATATEST = '/opt/inspur/XenCert/diskdatatest'
 
+# diskdatatest writes and verifies its pattern with this many workers, each
+# doing O_DIRECT IOs of this many MiB
+DISKDATATEST_WORKERS = 4
+DISKDATATEST_BUFFER_MB = 4
+
 multiPathDefaultsMap = { 'udev_dir':'/dev',
 			    'polling_interval':'5',
 			    'path_selector': "round-robin 0",
@@ -118,19 +123,42 @@ def _init_adapters():
             pass
     return adapter
 
-def blockIP(ip):
+def applyIPRules(action, ips):
+    # Adds (-A) or deletes (-D) the DROP rules of all the IPs in a single
+    # iptables-restore transaction, so they take effect at the same moment.
+    # Returns the time they took effect.
+    rules = ['*filter']
+    for ip in ips:
+        rules.append('%s INPUT -s %s -j DROP' % (action, ip))
+    rules.append('COMMIT')
+    cmd = ['iptables-restore', '--noflush']
+    DebugCmdArray(cmd)
+    (rc, stdout, stderr) = util.doexec(cmd, '\n'.join(rules) + '\n')
+    applied = time.time()
+    if rc != 0:
+        raise Exception("iptables-restore returned %d: %s" % (rc, stderr))
+    XenCertPrint("Applied %s of the rules for %s at %.6f" % (action, ips, applied))
+    return applied
+
+def blockIPs(ips):
     try:
-	cmd = ['iptables', '-A', 'INPUT', '-s', ip, '-j', 'DROP']
-        util.pread(cmd)
+        return applyIPRules('-A', ips)
     except Exception, e:
-        XenCertPrint("There was an exception in blocking ip: %s. Exception: %s" % (ip, str(e)))
+        XenCertPrint("There was an exception in blocking ips: %s. Exception: %s" % (ips, str(e)))
+        return None
 
-def unblockIP(ip):
+def unblockIPs(ips):
     try:
-	cmd = ['iptables', '-D', 'INPUT', '-s', ip, '-j', 'DROP']
-        util.pread(cmd)
+        return applyIPRules('-D', ips)
     except Exception, e:
-        XenCertPrint("There was an exception in unblocking ip: %s. Exception: %s" % (ip, str(e)))
+        XenCertPrint("There was an exception in unblocking ips: %s. Exception: %s" % (ips, str(e)))
+        return None
+
+def blockIP(ip):
+    return blockIPs([ip])
+
+def unblockIP(ip):
+    return unblockIPs([ip])
    
 def actualSRFreeSpace(size):
     num = (size - lvutil.LVM_SIZE_INCREMENT - 4096 - vhdutil.calcOverheadEmpty(MSIZE)) * vhdutil.VHD_BLOCK_SIZE
@@ -656,27 +684,109 @@ def get_lun_scsiid_devicename_mapping(targetIQN, portal):
         XenCertPrint("Failed to find any LUNs for IQN: %s and portal: %s" % targetIQN, portal)
         return {}
 
-def update_multipath_conf():
+def _multipath_conf_value(value):
+    value = str(value).strip()
+    if ' ' in value:
+        return '"' + value + '"'
+    return value
+
+# multipaths maps a wwid to the settings which override the defaults and
+# the built-in device settings for that map only
+def update_multipath_conf(multipaths=None):
     try:
         f = open("/etc/multipath.conf", "w")
         f.write('defaults {\n')
         for key, value in multiPathDefaultsMap.items(): 
-            value = value.strip()
-            value = '"' + str(value) + '"' if ' ' in value else str(value)
-            f.write('\t' + key + ' ' + value + '\n')
+            f.write('\t' + key + ' ' + _multipath_conf_value(value) + '\n')
         f.write('}\n')
+        if multipaths:
+            f.write('multipaths {\n')
+            for wwid in multipaths.keys():
+                f.write('\tmultipath {\n')
+                f.write('\t\twwid ' + wwid + '\n')
+                for key, value in multipaths[wwid].items():
+                    f.write('\t\t' + key + ' ' + _multipath_conf_value(value) + '\n')
+                f.write('\t}\n')
+            f.write('}\n')
         f.close()
         return True
     except Exception, e:
         XenCertPrint("Failed to write to multipath config, Error: %s" % str(e))
         return False
 
+PATH_SELECTORS = ['round-robin', 'queue-length', 'service-time']
+PATH_GROUPING_POLICIES = ['failover', 'multibus', 'group_by_serial', 'group_by_prio', 'group_by_node_name']
+
+# Multipath policies compared by the mpolicy performance mode, as
+# path_selector:path_grouping_policy:rr_min_io_rq
+DEFAULT_POLICIES = 'round-robin:multibus:1,round-robin:multibus:100,queue-length:multibus:1,' \
+                   'service-time:multibus:1,service-time:group_by_prio:1,round-robin:failover:1'
+
+class MultipathPolicy:
+    def __init__(self, selector, grouping, rrMinIORq):
+        if selector not in PATH_SELECTORS:
+            raise Exception("Unsupported path selector %s, %s only" % (selector, ', '.join(PATH_SELECTORS)))
+        if grouping not in PATH_GROUPING_POLICIES:
+            raise Exception("Unsupported path grouping policy %s, %s only" % (grouping, ', '.join(PATH_GROUPING_POLICIES)))
+        self.selector = selector
+        self.grouping = grouping
+        self.rrMinIORq = int(rrMinIORq)
+
+    def __str__(self):
+        return "%s:%s:%d" % (self.selector, self.grouping, self.rrMinIORq)
+
+    def Settings(self):
+        return { 'path_selector': self.selector + ' 0',
+                 'path_grouping_policy': self.grouping,
+                 'rr_min_io_rq': str(self.rrMinIORq) }
+
+def ParsePolicies(spec):
+    """Builds the policy list from a string like
+    'service-time:multibus:1,round-robin:failover:100'. The grouping policy
+    defaults to multibus and rr_min_io_rq to 1."""
+    if not spec:
+        spec = DEFAULT_POLICIES
+    policies = []
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        fields = item.split(':') + ['multibus', '1'][len(item.split(':')) - 1:]
+        if len(fields) != 3:
+            raise Exception("Invalid multipath policy %s, expected path_selector:path_grouping_policy:rr_min_io_rq" % item)
+        policies.append(MultipathPolicy(fields[0], fields[1], fields[2]))
+    return policies
+
+def reload_map(scsi_id):
+    # Rebuilds the map from the current multipath.conf, leaving the other
+    # maps alone unlike a multipathd reconfigure
+    cmd = ['multipath', '-r', scsi_id]
+    DebugCmdArray(cmd)
+    (rc, stdout, stderr) = util.doexec(cmd, '')
+    XenCertPrint("multipath -r %s returned rc: %s stdout: %s stderr: %s" % (scsi_id, rc, stdout, stderr))
+    return rc == 0
+
+regex_policy = re.compile("policy='([^']*)'")
+
+def get_map_policies(scsi_id):
+    """Returns the path selector of each path group of the map, as shown by
+    multipathd, e.g. ['service-time 0']"""
+    topology = mpath_cli.get_topology_index(0).get(scsi_id)
+    if topology == None:
+        return []
+    policies = []
+    for line in topology.lines:
+        m = regex_policy.search(line)
+        if m:
+            policies.append(m.group(1))
+    return policies
+
 def parse_config(vendor, product):
     try:
 	retVal = True
     	cmd="show config"		
 	XenCertPrint("mpath cmd: %s" % cmd)
-        (rc,stdout,stderr) = util.doexec(mpath_cli.mpathcmd,cmd)
+        stdout = mpath_cli.mpquery(cmd)
         XenCertPrint("mpath output: %s" % stdout)
         stdout = stdout.rstrip('}\nmultipaths {\n}\nmultipathd> ') + '\t'
         XenCertPrint("mpath output after stripping: %s" % stdout)
@@ -753,48 +863,27 @@ def parse_xml_config(file):
 
 #Returns a list of following tuples for the SCSI Id given
 #(HBTL, Path dm status, Path status) 
-def get_path_status(scsi_id, onlyActive = False):
-    listPaths = []
+def get_path_status(scsi_id, onlyActive = False, maxAge = mpath_cli.TOPOLOGY_MAX_AGE):
+    # The paths come from the shared topology snapshot, which is refreshed
+    # when older than maxAge seconds. Pass 0 to see the current state.
     list = []
     retVal = True
     devname = None
     try:
-        lines = mpath_cli.get_topology(scsi_id)
-        listPaths = []
-        for line in lines:
-            m=mpath_cli.regex.search(line)
-            if(m):
-                listPaths.append(line)
-
-            n=mpath_cli.regex4.search(line)
-            if(n):
-                devname = line.split()[1].strip()
-
-        XenCertPrint("list_paths returned: %s" % listPaths)
-
-        # Extract hbtl, dm and path status from the multipath topology output
-        # e.g. "| |- 0:0:0:0 sda 8:0   active ready running"
-        pat = re.compile(r'(\d+:\d+:\d+:\d+.*)$')
-
-        for node in listPaths:
-            XenCertPrint("Looking at node: %s" % node)
-            match_res = pat.search(node)
-            if match_res is None:
-                continue
-
-            # Extract path info if pattern matched successfully
-            l = match_res.group(1).split()
-            hbtl = l[0]
-            dm_status = l[3]
-            path_status = l[4]
-            XenCertPrint("HBTL: %s" % hbtl)
-            XenCertPrint("Path status: %s, %s" % (dm_status, path_status))
-
-            if onlyActive:
-                if dm_status == 'active':
+        topology = mpath_cli.get_topology_index(maxAge).get(scsi_id)
+        if topology != None:
+            devname = topology.devname
+            XenCertPrint("Topology of %s: %s" % (scsi_id, topology.lines))
+            # e.g. "| |- 0:0:0:0 sda 8:0   active ready running"
+            for (hbtl, device, dm_status, path_status) in topology.paths:
+                XenCertPrint("HBTL: %s" % hbtl)
+                XenCertPrint("Path status: %s, %s" % (dm_status, path_status))
+
+                if onlyActive:
+                    if dm_status == 'active':
+                        list.append((hbtl, dm_status, path_status))
+                else:
                     list.append((hbtl, dm_status, path_status))
-            else:
-                list.append((hbtl, dm_status, path_status))
 
         XenCertPrint("Returning list: %s" % list)
         if len(list) == 0:
@@ -818,24 +907,40 @@ def _get_localhost_uuid():
         domid = line.split("'")[1]
     return domid
 
-def FindDiskDataTestEstimate(device, size):
-    estimatedTime = 0
-    # Run diskdatatest in a report mode
-    XenCertPrint("Run diskdatatest in a report mode with device %s to find the estimated time." % device)
-    cmd = [DISKDATATEST, 'report', '1', device]
-    DebugCmdArray(cmd)
-    XenCertPrint("The command to be fired is: %s" % cmd)
-    (rc, stdout, stderr) = util.doexec(cmd)
-    if rc == 0:
-        lastString = (stdout.split('\n')[-1])
-        XenCertPrint("diskdatatest returned : %s" % lastString)
-        estimatedTime = int(lastString.split(' ')[-1])
-    else:
-        XenCertPrint("Diskdatatest return Error : %s" % stderr)
-        estimateTime = 0
- 
-    XenCertPrint("Total estimated time for testing IO with the device %s as %d" % (device, estimatedTime))
-    return estimatedTime
+def DiskDataTestCommand(action, device, iteration=1, sample=None, seed=None, checkpoint=None, id=None):
+    cmd = [DISKDATATEST, '-t', str(DISKDATATEST_WORKERS), '-b', str(DISKDATATEST_BUFFER_MB), '-d']
+    if id:
+        # Checksummed sectors stamped with id, telling torn, stale,
+        # misdirected and corrupted sectors apart
+        cmd += ['-i', id]
+    if sample:
+        cmd += ['-s', str(sample), '-e', str(seed or 0)]
+    if checkpoint:
+        cmd += ['-c', checkpoint]
+    return cmd + [action, str(iteration), device]
+
+def SampleFraction(sample, sizeInMiB):
+    """Fraction of a LUN of sizeInMiB written and verified with the given
+    sample, either a fraction such as 0.05 or a byte budget such as 100G,
+    as understood by diskdatatest -s"""
+    if not sample:
+        return 1.0
+    spec = str(sample).strip().upper()
+    units = { 'K': KiB, 'M': MiB, 'G': GiB, 'T': GiB * KiB }
+    try:
+        if spec[-1] in units:
+            budget = float(spec[:-1]) * units[spec[-1]]
+        else:
+            budget = float(spec)
+            if budget <= 1:
+                if budget <= 0:
+                    raise ValueError
+                return budget
+    except (ValueError, IndexError):
+        raise Exception("Invalid sample %s, expected a fraction such as 0.05 or a size such as 100G" % sample)
+    if budget <= 0:
+        raise Exception("Invalid sample %s, expected a fraction such as 0.05 or a size such as 100G" % sample)
+    return min(1.0, budget / MiB / max(sizeInMiB, 1))
 
 def _find_LUN(svid):
     basepath = "/dev/disk/by-csldev/"
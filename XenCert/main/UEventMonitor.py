@@ -0,0 +1,146 @@
+#!/usr/bin/python
+#
+# Copyright (C) Inspur Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Listener for the device mapper path uevents sent by the kernel"""
+import socket
+import time
+from threading import Thread, Event, Condition
+from Logging import XenCertPrint
+
+NETLINK_KOBJECT_UEVENT = 15
+
+# Multicast group of the uevents sent by the kernel itself, udev
+# rebroadcasts them on group 2 only after running its rules.
+KERNEL_GROUP = 1
+
+RECEIVE_BUFFER = 64 * 1024
+
+# Seconds between checks for a stop request while no uevent arrives
+RECEIVE_TIMEOUT = 0.5
+
+PATH_FAILED = 'PATH_FAILED'
+PATH_REINSTATED = 'PATH_REINSTATED'
+
+def ParseUEvent(data):
+    """Returns the key/value pairs of a kernel uevent, the header
+    "action@devpath" is returned under the key 'HEADER'."""
+    fields = data.split('\0')
+    uevent = { 'HEADER': fields[0] }
+    for field in fields[1:]:
+        if '=' in field:
+            (key, value) = field.split('=', 1)
+            uevent[key] = value
+    return uevent
+
+class UEventMonitor(Thread):
+    """Records the device mapper multipath PATH_FAILED and PATH_REINSTATED
+    uevents together with the time they were received. When the netlink
+    socket cannot be opened available is False and callers fall back to
+    polling multipathd."""
+    def __init__(self):
+        Thread.__init__(self)
+        self.setDaemon(True)
+        self.stopEvent = Event()
+        self.cond = Condition()
+        # (time, uevent dict) of each path event
+        self.events = []
+        self.sock = None
+        self.available = False
+        try:
+            self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 1024)
+            # Port id 0 lets the kernel pick one that is not in use
+            self.sock.bind((0, KERNEL_GROUP))
+            self.sock.settimeout(RECEIVE_TIMEOUT)
+            self.available = True
+        except Exception, e:
+            XenCertPrint("Cannot listen to kernel uevents, path changes will be polled: %s" % str(e))
+            if self.sock != None:
+                self.sock.close()
+                self.sock = None
+
+    def run(self):
+        try:
+            while not self.stopEvent.isSet():
+                try:
+                    data = self.sock.recv(RECEIVE_BUFFER)
+                except socket.timeout:
+                    continue
+                received = time.time()
+                uevent = ParseUEvent(data)
+                if uevent.get('DM_ACTION') not in [PATH_FAILED, PATH_REINSTATED]:
+                    continue
+                XenCertPrint("Path uevent: %s %s %s valid paths %s" % (uevent.get('DM_NAME', uevent['HEADER']),
+                             uevent['DM_ACTION'], uevent.get('DM_PATH'), uevent.get('DM_NR_VALID_PATHS')))
+                self.cond.acquire()
+                try:
+                    self.events.append((received, uevent))
+                    self.cond.notifyAll()
+                finally:
+                    self.cond.release()
+        except Exception, e:
+            XenCertPrint("Stopped listening to kernel uevents: %s" % str(e))
+            self.available = False
+            self.cond.acquire()
+            self.cond.notifyAll()
+            self.cond.release()
+
+    def Stop(self):
+        self.stopEvent.set()
+        if self.isAlive():
+            self.join()
+        if self.sock != None:
+            self.sock.close()
+            self.sock = None
+
+    def MapEvents(self, mpDevname, since=0):
+        """Returns the (time, uevent) of mpDevname (e.g. dm-3) received at
+        or after since"""
+        events = []
+        for (received, uevent) in self.events:
+            if received >= since and uevent['HEADER'].endswith('/' + mpDevname):
+                events.append((received, uevent))
+        return events
+
+    def WaitForValidPaths(self, mpDevname, check, since, timeout):
+        """Waits for a path uevent of mpDevname received after since whose
+        DM_NR_VALID_PATHS satisfies check. Returns the time that uevent was
+        received, or None on timeout or when the monitor stopped."""
+        deadline = since + timeout
+        self.cond.acquire()
+        try:
+            while True:
+                for (received, uevent) in self.MapEvents(mpDevname, since):
+                    try:
+                        if check(int(uevent.get('DM_NR_VALID_PATHS'))):
+                            return received
+                    except (TypeError, ValueError):
+                        pass
+                remaining = deadline - time.time()
+                if remaining <= 0 or not self.available:
+                    return None
+                self.cond.wait(remaining)
+        finally:
+            self.cond.release()
+
+def StartMonitor():
+    """Returns a running UEventMonitor, or None if uevents are unavailable"""
+    monitor = UEventMonitor()
+    if not monitor.available:
+        return None
+    monitor.start()
+    return monitor
@@ -0,0 +1,112 @@
+#!/usr/bin/python
+#
+# Copyright (C) Inspur Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Bounded thread pool used to test LUNs and paths concurrently"""
+from threading import Thread, Condition
+from Logging import XenCertPrint
+
+# Default number of paths tested at once
+DEFAULT_WORKERS = 8
+
+# Default number of paths tested at once through the same HBA or portal
+DEFAULT_GROUP_LIMIT = 2
+
+class Job:
+    def __init__(self, key, func, args, groups):
+        self.key = key
+        self.func = func
+        self.args = args
+        self.groups = groups
+        self.result = None
+        self.exception = None
+
+class WorkerPool:
+    """Runs the added jobs on at most maxWorkers threads. A job may belong to
+    groups, e.g. the HBA and the portal its path goes through, and no more
+    than groupLimit jobs of one group run at the same time. Jobs start in
+    the order they were added unless their groups are busy."""
+    def __init__(self, maxWorkers=DEFAULT_WORKERS, groupLimit=DEFAULT_GROUP_LIMIT):
+        self.maxWorkers = max(1, maxWorkers)
+        self.groupLimit = groupLimit
+        self.jobs = []
+        self.pending = []
+        self.running = {}
+        self.cond = Condition()
+
+    def Add(self, key, func, args=(), groups=[]):
+        job = Job(key, func, args, groups)
+        self.jobs.append(job)
+        return job
+
+    def _Runnable(self, job):
+        if not self.groupLimit:
+            return True
+        for group in job.groups:
+            if self.running.get(group, 0) >= self.groupLimit:
+                return False
+        return True
+
+    def _Next(self):
+        # Called with self.cond held, returns None once all jobs are taken
+        while self.pending:
+            for job in self.pending:
+                if self._Runnable(job):
+                    self.pending.remove(job)
+                    for group in job.groups:
+                        self.running[group] = self.running.get(group, 0) + 1
+                    return job
+            self.cond.wait()
+        return None
+
+    def _Done(self, job):
+        self.cond.acquire()
+        try:
+            for group in job.groups:
+                self.running[group] -= 1
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    def _Worker(self):
+        while True:
+            self.cond.acquire()
+            try:
+                job = self._Next()
+            finally:
+                self.cond.release()
+            if job == None:
+                return
+            try:
+                job.result = job.func(*job.args)
+            except Exception, e:
+                XenCertPrint("Job %s failed: %s" % (str(job.key), str(e)))
+                job.exception = e
+            self._Done(job)
+
+    def Run(self):
+        """Runs all the jobs and returns them, in the order they were added,
+        with their result or exception filled in."""
+        self.pending = list(self.jobs)
+        threads = []
+        for i in range(min(self.maxWorkers, len(self.jobs))):
+            thread = Thread(target=self._Worker)
+            thread.setDaemon(True)
+            threads.append(thread)
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return self.jobs
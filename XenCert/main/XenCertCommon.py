@@ -19,6 +19,8 @@
 
 from optparse import OptionParser
 import StorageHandler
+import StorageHandlerUtil
+import IOEngine
 import VmHandler
 from Logging import Print
 
@@ -58,10 +60,23 @@ __vm_args__ = [
     ["path",       "path to create vm", " : ", None,        "optional", "-p", ""   ],
     ["storeOn",       "disk to create new data storage", " : ", None,        "optional", "-o", ""   ] ]
 
+__perf_args__ = [
+    ["workloads",       "comma separated list of performance workloads (seqread, seqwrite, randread, randwrite), each optionally followed by a block size as in randread:4K", " : ", 'seqread,seqwrite,randread,randwrite', "optional", "-W", ""],
+    ["blocksize",       "block size used by all the performance workloads, e.g. 4K, 64K, 1M", " : ", None,        "optional", "-B", ""   ],
+    ["duration",        "duration in seconds of each performance workload", " : ", '10',        "optional", "-L", ""   ],
+    ["warmup",          "seconds of IO discarded at the start of each performance workload", " : ", '5',        "optional", "-U", ""   ],
+    ["perfmode",        "comma separated list of additional performance modes: qdsweep (sweep the outstanding IO depth), bssweep (sweep the block size), aggregate (drive all iscsi/hba LUNs at once), alua (compare the ALUA optimized and non-optimized path groups of each iscsi/hba LUN), mpolicy (rank multipath policies during the multipath tests)", " : ", None,        "optional", "-P", ""   ],
+    ["depths",          "comma separated list of IO depths visited by the qdsweep mode", " : ", '1,2,4,8,16,32,64,128',        "optional", "-Q", ""   ],
+    ["blocksizes",      "comma separated list of block sizes visited by the bssweep mode", " : ", '4K,8K,16K,64K,256K,1M,4M',        "optional", "-S", ""   ],
+    ["policies",        "comma separated list of multipath policies compared by the mpolicy mode, each as path_selector:path_grouping_policy:rr_min_io_rq, e.g. service-time:multibus:1", " : ", None,        "optional", "-O", ""   ],
+    ["compress",        "compression ratio of the data written by the performance workloads, 1 for incompressible data", " : ", '1',        "optional", "-C", ""   ],
+    ["dedupe",          "dedupe ratio of the data written by the performance workloads, 1 for unique data", " : ", '1',        "optional", "-E", ""   ] ]
+
 __common__ = [    
     ["functional", "perform functional tests",                          " : ", None, "optional", "-F", ""],
     ["multipath", "perform multipath configuration verification tests", " : ", None, "optional", "-M", ""],
     ["data", "perform data verification tests",                         " : ", None, "optional", "-D", ""],
+    ["resume", "resume the data tests of the iscsi and hba functional phase interrupted earlier instead of starting over", " : ", None, "optional", "-r", "--resume"],
     ["help",    "show this help message and exit",                                  " : ", None,        "optional", "-h", "" ]]
 
 __commonparams__ = [
@@ -72,7 +87,10 @@ __commonparams__ = [
                                                                                     " : ", None, "optional", "-i", ""],
     ["count", "count of iterations to perform in case of multipathing failover testing",
                                                                                     " : ", None, "optional", "-g", ""],
-    ["type",      "type whether skip whole disk check", " : ", 'q',        "optional", "-T", ""  ] ]
+    ["type",      "type whether skip whole disk check", " : ", 'q',        "optional", "-T", ""  ],
+    ["pathworkers", "number of LUN paths tested concurrently by the iscsi and hba functional tests", " : ", '8', "optional", "-j", ""],
+    ["sample", "write and verify only a random sample of each LUN in the iscsi and hba data tests, a fraction such as 0.05 or a byte budget per LUN such as 100G", " : ", None, "optional", "-l", "--sample"],
+    ["grouplimit", "number of LUN paths tested concurrently through the same HBA or iSCSI portal", " : ", '2', "optional", "-k", ""] ]
 
 def parse_args(version_string):
     """Parses the command line arguments"""
@@ -116,6 +134,12 @@ def parse_args(version_string):
                        default=element[3],
                        help=element[1],
                        dest=element[0])
+
+    for element in __perf_args__:
+        opt.add_option(element[5], element[6],
+                       default=element[3],
+                       help=element[1],
+                       dest=element[0])
     
     for element in __common__:
         opt.add_option(element[5], element[6],
@@ -130,6 +154,7 @@ def store_configuration(g_storage_conf, options):
     """Stores the command line arguments in a class"""
 
     g_storage_conf["storage_type"] = options.storage_type
+    g_storage_conf["resume"] = options.resume
     try:
         g_storage_conf["slavehostname"] = options.slavehostname
     except:
@@ -152,6 +177,31 @@ def valid_arguments(options, g_storage_conf):
         value = getattr(options, element[0])
         g_storage_conf[element[0]] = value
 
+    if options.sample:
+        try:
+            StorageHandlerUtil.SampleFraction(options.sample, 1)
+        except Exception, e:
+            Print("Error: %s" % str(e))
+            return 0
+
+    for element in __perf_args__:
+        g_storage_conf[element[0]] = getattr(options, element[0])
+
+    try:
+        blocksize = None
+        if options.blocksize:
+            blocksize = IOEngine.ParseSize(options.blocksize)
+        blocksizes = IOEngine.ParseBlockSizes(options.blocksizes)
+        for workload in IOEngine.ParseWorkloads(options.workloads, blocksize):
+            blocksizes.append(workload.blocksize)
+        for size in blocksizes:
+            IOEngine.CheckBlockSize(size)
+        IOEngine.ParseDepths(options.depths)
+        StorageHandler.ParsePerfModes(options.perfmode)
+    except Exception, e:
+        Print("Error: %s" % str(e))
+        return 0
+
     if options.storage_type == "nfs":
         subargs = __nfs_args__
     elif options.storage_type == "hba":
@@ -233,6 +283,10 @@ def DisplayTestSpecificOptions():
     Print("Multipathing test options (-m above):\n")
     for item in __commonparams__:
         printHelpItem(item)
+    Print("")
+    Print("Performance test options (-D above):\n")
+    for item in __perf_args__:
+        printHelpItem(item)
 
 def DisplayStorageSpecificUsage(storage_type):
     if storage_type == 'iscsi':
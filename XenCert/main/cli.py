@@ -21,6 +21,8 @@
 import os
 import sys
 import XenCertCommon
+import PerfReport
+import DiskStats
 from Logging import Print, PrintR, PrintG, PrintY, PrintB
 from Logging import PrintToLog
 from Logging import InitLogging
@@ -80,7 +82,9 @@ def main():
 
     if options.multipath or testAll:
 	Print("Performing multipath configuration verification.")
+        sampler = DiskStats.StartSampler()
     	(retValMP, checkPointsMP, totalCheckPointsMP) = handler.MPConfigVerificationTests()
+        DiskStats.StopSampler(sampler, 'multipath')
         if checkPointsMP != totalCheckPointsMP:
             pass_all = False
 	Print("***********************************************************************")
@@ -88,7 +92,9 @@ def main():
 
     if options.functional or testAll: 
     	Print("Performing functional tests.")
+        sampler = DiskStats.StartSampler()
     	(retValFunctional, checkPointsFunctional, totalCheckPointsFunctional) = handler.FunctionalTests()
+        DiskStats.StopSampler(sampler, 'functional')
         if checkPointsFunctional != checkPointsFunctional:
             pass_all = False
     	Print("***********************************************************************")
@@ -96,7 +102,9 @@ def main():
 
     if options.data or testAll: 
     	Print("Performing data IO tests.")
+        sampler = DiskStats.StartSampler()
     	(retValData, checkPointsData, totalCheckPointsData) = handler.DataPerformanceTests()
+        DiskStats.StopSampler(sampler, 'data')
         if checkPointsData != checkPointsData:
             pass_all = False
         Print("***********************************************************************")
@@ -144,6 +152,8 @@ def main():
     Print("***********************************************************************")
     PrintB("End of Inspur InCloud Sphere XenCert certification suite.")
     Print("Please find the report for this test run at: %s" % GetLogFileName())
+    if PerfReport.HasRecords():
+        Print("Please find the performance data for this test run at: %s" % PerfReport.GetReportFileName())
     Print("***********************************************************************")
     end = datetime.now()
     Print("Test end time: %s" % time.asctime(time.localtime()))
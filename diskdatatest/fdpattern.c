@@ -26,12 +26,40 @@
 #include <string.h>
 #include "atomicio.h"
 #include <time.h>
+#include <pthread.h>
+#include <sys/time.h>
+#include <math.h>
 
 #define DEFAULT_SECTOR_SIZE 512
 #define SECTOR_SHIFT 9
 
+/* Buffered mode: sectors are written and verified a buffer at a time by
+ * parallel workers, each covering its own region of the device. */
+#define DEFAULT_BUFFER_MB 4
+#define MAX_BUFFER_MB 256
+#define MAX_THREADS 64
+#define BUFFER_ALIGN 4096
+#define PROGRESS_SECTS 1048576
+
+/* Seconds between two saves of the progress to the checkpoint file */
+#define CHECKPOINT_INTERVAL 5
+#define CHECKPOINT_MAGIC "diskdatatest checkpoint 1"
+
+/* Extended pattern, written and verified with -i */
+#define EXT_MAGIC 0x58434454	/* "XCDT" */
+#define MAX_REPORTED 10
+
 unsigned long long iter = 0;
 
+int threads = 0;
+unsigned long buffer_mb = 0;
+int direct = 0;
+char *sample = NULL;
+unsigned long long seed = 0;
+char *checkpoint = NULL;
+char *run_id = NULL;
+unsigned long long id_hash = 0;
+
 struct fd_state {
         unsigned long      sector_size; // size of a sector
         unsigned long long size; // device size in sectors
@@ -44,9 +72,49 @@ struct sector_hdr {
 	unsigned long long iter;
 };
 
+/*
+ * Extended header, at the start of every sector and repeated over the
+ * rest of it. id identifies the device or run the sector was written
+ * for, iter is its generation and crc the CRC32C of the whole sector
+ * computed with crc set to 0.
+ */
+struct sector_ext_hdr {
+	unsigned long long sect;
+	unsigned long long iter;
+	unsigned long long id;
+	unsigned int magic;
+	unsigned int crc;
+};
+
+/* Classes of the bad sectors found by the extended verify */
+enum {
+	SECT_OK,
+	SECT_TORN,		/* stale part of a chunk partly rewritten */
+	SECT_STALE,		/* older generation of its own data, or zeros */
+	SECT_MISDIRECTED,	/* valid, but for another sector or device */
+	SECT_CORRUPTED,		/* checksum mismatch */
+	SECT_CLASSES
+};
+
+static const char *sect_class[SECT_CLASSES] = {
+	"ok", "torn", "stale", "misdirected", "corrupted"
+};
+
 int usage(char *str) {
-	fprintf(stderr, "usage: %s {write|verify|report} <iterations> <FILENAME>\n",
-		str);
+	fprintf(stderr, "usage: %s [-t threads] [-b buffer_MiB] [-d] "
+		"[-s fraction|bytes [-e seed]] [-c checkpoint] [-i id] "
+		"{write|verify|report} <iterations> <FILENAME>\n"
+		"  -t  write/verify with this many parallel workers\n"
+		"  -b  write/verify %d MiB or the given MiB per IO\n"
+		"  -d  write/verify with O_DIRECT\n"
+		"  -s  write/verify only a random sample of the chunks of -b MiB,\n"
+		"      a fraction such as 0.05 or a byte budget such as 100G\n"
+		"  -e  seed picking the sampled chunks, the same for write and verify\n"
+		"  -c  save the progress of write/verify to this file every %d seconds\n"
+		"      and resume from it\n"
+		"  -i  write/verify the extended pattern, checksummed and stamped with\n"
+		"      this device or run id; verify counts the bad sectors by class\n",
+		str, DEFAULT_BUFFER_MB, CHECKPOINT_INTERVAL);
 	exit(1);
 }
 
@@ -242,38 +310,736 @@ int write_testpattern(int fd, struct fd_state *state, int bReportOnly, int *writ
 	return 0;
 }
 
+struct region {
+	pthread_t thread;
+	int fd;
+	int fd_tail;	/* without O_DIRECT, for a final unaligned buffer */
+	int write;
+	unsigned long long *chunks;	/* chunk numbers, NULL for all of them */
+	unsigned long long first;	/* first entry of chunks handled */
+	unsigned long long count;	/* entries of chunks handled */
+	unsigned long long sects;	/* sectors of the whole device */
+	unsigned long buffer_sects;	/* sectors of a chunk */
+	unsigned long long done;	/* sectors written or verified */
+	volatile unsigned long long done_chunks;	/* entries of chunks done */
+	unsigned long long bad[SECT_CLASSES];	/* sectors by class, with -i */
+	int ret;
+};
+
+/* Set by the first worker which fails so the others stop early */
+static volatile int stop_workers = 0;
+static pthread_mutex_t print_lock = PTHREAD_MUTEX_INITIALIZER;
+
+/* Workers which returned, signalled through finished_cond */
+static int finished_workers = 0;
+static pthread_mutex_t finished_lock = PTHREAD_MUTEX_INITIALIZER;
+static pthread_cond_t finished_cond = PTHREAD_COND_INITIALIZER;
+
+static double now(void)
+{
+	struct timeval tv;
+	gettimeofday(&tv, NULL);
+	return tv.tv_sec + tv.tv_usec / 1000000.0;
+}
+
+static int pio(int fd, int write, char *buf, size_t len, off_t off)
+{
+	size_t pos = 0;
+	ssize_t res;
+
+	while (pos < len) {
+		if (write)
+			res = pwrite(fd, buf + pos, len - pos, off + pos);
+		else
+			res = pread(fd, buf + pos, len - pos, off + pos);
+		if (res == -1) {
+			if (errno == EINTR || errno == EAGAIN)
+				continue;
+			return -1;
+		}
+		if (res == 0) {
+			errno = EPIPE;
+			return -1;
+		}
+		pos += (size_t)res;
+	}
+	return 0;
+}
+
+void fill_sectors(char *buf, unsigned long long first, unsigned long count)
+{
+	struct sector_hdr hdr;
+	unsigned long k;
+
+	hdr.iter = iter;
+	for (k = 0; k < count; k++) {
+		hdr.sect = first + k;
+		fill_buf(buf + k * DEFAULT_SECTOR_SIZE, &hdr, DEFAULT_SECTOR_SIZE);
+	}
+}
+
+/* Same checks and return codes as verify_testpattern */
+int check_sectors(char *buf, unsigned long long first, unsigned long count)
+{
+	struct sector_hdr *test;
+	unsigned long k;
+	int j;
+
+	for (k = 0; k < count; k++) {
+		for (j = 0; j < DEFAULT_SECTOR_SIZE/sizeof(struct sector_hdr); j++) {
+			test = (struct sector_hdr *)(buf + k * DEFAULT_SECTOR_SIZE +
+						     sizeof(struct sector_hdr) * j);
+			if (test->sect != first + k) {
+				printf("Val is %llu\n", test->sect);
+				fprintf(stderr, "\nSector %llu, off %d:\n"
+					"Sector number does not match\n",
+					first + k, (int)(sizeof(struct sector_hdr) * j));
+				return 1;
+			}
+			if (test->iter != iter) {
+				fprintf(stderr, "\nSector %llu, off %d:\n"
+					"Iteration number does not match\n",
+					first + k, (int)(sizeof(struct sector_hdr) * j));
+				return 2;
+			}
+		}
+	}
+	return 0;
+}
+
+/* CRC32C (Castagnoli), reflected, computed 8 bytes at a time */
+static unsigned int crc32c_table[8][256];
+
+void crc32c_init(void)
+{
+	unsigned int crc;
+	int i, j;
+
+	for (i = 0; i < 256; i++) {
+		crc = i;
+		for (j = 0; j < 8; j++)
+			crc = (crc >> 1) ^ (crc & 1 ? 0x82f63b78 : 0);
+		crc32c_table[0][i] = crc;
+	}
+	for (i = 0; i < 256; i++)
+		for (j = 1; j < 8; j++)
+			crc32c_table[j][i] = (crc32c_table[j - 1][i] >> 8) ^
+				crc32c_table[0][crc32c_table[j - 1][i] & 0xff];
+}
+
+unsigned int crc32c(const unsigned char *p, size_t len)
+{
+	unsigned int crc = 0xffffffff, lo, hi;
+
+	while (len >= 8) {
+		lo = crc ^ (p[0] | p[1] << 8 | p[2] << 16 | (unsigned int)p[3] << 24);
+		hi = p[4] | p[5] << 8 | p[6] << 16 | (unsigned int)p[7] << 24;
+		crc = crc32c_table[7][lo & 0xff] ^ crc32c_table[6][(lo >> 8) & 0xff] ^
+		      crc32c_table[5][(lo >> 16) & 0xff] ^ crc32c_table[4][lo >> 24] ^
+		      crc32c_table[3][hi & 0xff] ^ crc32c_table[2][(hi >> 8) & 0xff] ^
+		      crc32c_table[1][(hi >> 16) & 0xff] ^ crc32c_table[0][hi >> 24];
+		p += 8;
+		len -= 8;
+	}
+	while (len--)
+		crc = (crc >> 8) ^ crc32c_table[0][(crc ^ *p++) & 0xff];
+	return ~crc;
+}
+
+/* FNV-1a, turns the id given with -i into the one stamped in the headers */
+unsigned long long hash_id(const char *str)
+{
+	unsigned long long h = 0xcbf29ce484222325ULL;
+
+	while (*str) {
+		h ^= (unsigned char)*str++;
+		h *= 0x100000001b3ULL;
+	}
+	return h;
+}
+
+void fill_ext_sectors(char *buf, unsigned long long first, unsigned long count)
+{
+	struct sector_ext_hdr hdr, *sect;
+	unsigned long k;
+	int j;
+
+	hdr.iter = iter;
+	hdr.id = id_hash;
+	hdr.magic = EXT_MAGIC;
+	hdr.crc = 0;
+	for (k = 0; k < count; k++) {
+		hdr.sect = first + k;
+		sect = (struct sector_ext_hdr *)(buf + k * DEFAULT_SECTOR_SIZE);
+		for (j = 0; j < DEFAULT_SECTOR_SIZE / sizeof(hdr); j++)
+			sect[j] = hdr;
+		sect->crc = crc32c((unsigned char *)sect, DEFAULT_SECTOR_SIZE);
+	}
+}
+
+int classify_sector(char *buf, unsigned long long expected)
+{
+	struct sector_ext_hdr *hdr = (struct sector_ext_hdr *)buf;
+	unsigned int crc = hdr->crc;
+	int j;
+
+	if (hdr->magic == EXT_MAGIC) {
+		hdr->crc = 0;
+		if (crc32c((unsigned char *)buf, DEFAULT_SECTOR_SIZE) != crc)
+			return SECT_CORRUPTED;
+		if (hdr->id != id_hash || hdr->sect != expected)
+			return SECT_MISDIRECTED;
+		if (hdr->iter != iter)
+			return SECT_STALE;
+		return SECT_OK;
+	}
+	/* Never written, the write was lost */
+	for (j = 0; j < DEFAULT_SECTOR_SIZE; j++)
+		if (buf[j])
+			return SECT_CORRUPTED;
+	return SECT_STALE;
+}
+
+/*
+ * Classifies every sector of a chunk read back into counts, a chunk
+ * being written with a single IO. Stale sectors next to sectors of the
+ * current generation are counted as torn: the IO only partly reached the
+ * disk. Returns the number of bad sectors.
+ */
+unsigned long check_ext_sectors(char *buf, unsigned long long first, unsigned long count,
+				unsigned long long *counts)
+{
+	static int reported = 0;
+	unsigned long long found[SECT_CLASSES];
+	unsigned long k, bad;
+	int c, torn;
+	struct sector_ext_hdr hdr;
+
+	memset(found, 0, sizeof(found));
+	for (k = 0; k < count; k++) {
+		memcpy(&hdr, buf + k * DEFAULT_SECTOR_SIZE, sizeof(hdr));
+		c = classify_sector(buf + k * DEFAULT_SECTOR_SIZE, first + k);
+		found[c]++;
+		if (c == SECT_OK)
+			continue;
+		pthread_mutex_lock(&print_lock);
+		if (reported++ < MAX_REPORTED)
+			fprintf(stderr, "\nSector %llu is %s: sect %llu iter %llu id %llx magic %x\n",
+				first + k, sect_class[c], hdr.sect, hdr.iter, hdr.id, hdr.magic);
+		pthread_mutex_unlock(&print_lock);
+	}
+	torn = found[SECT_OK] && found[SECT_STALE];
+	bad = 0;
+	for (c = SECT_TORN; c < SECT_CLASSES; c++) {
+		if (torn && c == SECT_STALE)
+			counts[SECT_TORN] += found[c];
+		else
+			counts[c] += found[c];
+		bad += found[c];
+	}
+	return bad;
+}
+
+static void worker_finished(void)
+{
+	pthread_mutex_lock(&finished_lock);
+	finished_workers++;
+	pthread_cond_signal(&finished_cond);
+	pthread_mutex_unlock(&finished_lock);
+}
+
+/*
+ * The checkpoint file records the progress of every region of a write or
+ * verify so that an interrupted run can resume. Its second line is the
+ * key of the run: it is only resumed by a run with the same action,
+ * iteration, seed, sample and region layout. Returns 1 when the run
+ * already completed, 0 when resuming and -1 when starting over.
+ */
+int load_checkpoint(const char *path, const char *key, struct region *regions,
+		    int nregions)
+{
+	char line[256];
+	unsigned long long done;
+	int i, ret = -1;
+	FILE *f;
+
+	f = fopen(path, "r");
+	if (!f)
+		return -1;
+	if (!fgets(line, sizeof(line), f) ||
+	    strncmp(line, CHECKPOINT_MAGIC, strlen(CHECKPOINT_MAGIC)))
+		goto out;
+	if (!fgets(line, sizeof(line), f) || strcmp(line, key)) {
+		printf("Checkpoint %s is for another run, starting over\n", path);
+		goto out;
+	}
+	for (i = 0; i < nregions; i++) {
+		if (!fgets(line, sizeof(line), f) || sscanf(line, "%llu", &done) != 1 ||
+		    done > regions[i].count)
+			goto out;
+		regions[i].done_chunks = done;
+	}
+	ret = 0;
+	if (fgets(line, sizeof(line), f) && !strcmp(line, "complete\n"))
+		ret = 1;
+out:
+	fclose(f);
+	if (ret < 0)
+		for (i = 0; i < nregions; i++)
+			regions[i].done_chunks = 0;
+	return ret;
+}
+
+/* Chunks done by each region, taken before the data is synced so that
+ * no chunk finished after the sync is saved as done */
+void snapshot_progress(struct region *regions, int nregions,
+		       unsigned long long *progress)
+{
+	int i;
+
+	for (i = 0; i < nregions; i++)
+		progress[i] = regions[i].done_chunks;
+}
+
+/* Replaces the checkpoint file atomically, so a crash leaves either the
+ * previous or the new progress */
+int save_checkpoint(const char *path, const char *key, unsigned long long *progress,
+		    int nregions, int complete)
+{
+	char tmp[4096];
+	FILE *f;
+	int i;
+
+	snprintf(tmp, sizeof(tmp), "%s.tmp", path);
+	f = fopen(tmp, "w");
+	if (!f) {
+		fprintf(stderr, "\nUnable to write checkpoint %s (%d)\n", tmp, errno);
+		return -1;
+	}
+	fprintf(f, "%s\n%s", CHECKPOINT_MAGIC, key);
+	for (i = 0; i < nregions; i++)
+		fprintf(f, "%llu\n", progress[i]);
+	if (complete)
+		fprintf(f, "complete\n");
+	if (fflush(f) || fsync(fileno(f))) {
+		fprintf(stderr, "\nUnable to write checkpoint %s (%d)\n", tmp, errno);
+		fclose(f);
+		return -1;
+	}
+	fclose(f);
+	if (rename(tmp, path)) {
+		fprintf(stderr, "\nUnable to write checkpoint %s (%d)\n", path, errno);
+		return -1;
+	}
+	return 0;
+}
+
+int sync_pattern(int fd, int fd_tail)
+{
+	if (fdatasync(fd) || (fd_tail != fd && fdatasync(fd_tail))) {
+		fprintf(stderr, "\nfdatasync failed (%d)\n", errno);
+		return -1;
+	}
+	return 0;
+}
+
+void *region_worker(void *arg)
+{
+	struct region *r = arg;
+	unsigned long long c, i;
+	unsigned long n;
+	size_t len;
+	char *buf;
+	int fd;
+
+	if (posix_memalign((void **)&buf, BUFFER_ALIGN,
+			   r->buffer_sects * DEFAULT_SECTOR_SIZE)) {
+		fprintf(stderr, "\nMalloc failed\n");
+		r->ret = -1;
+		stop_workers = 1;
+		worker_finished();
+		return NULL;
+	}
+
+	/* Chunks done before a resume are skipped */
+	for (c = r->first + r->done_chunks; c < r->first + r->count && !stop_workers; c++) {
+		i = (r->chunks ? r->chunks[c] : c) * r->buffer_sects;
+		n = r->buffer_sects;
+		if (r->sects - i < n)
+			n = r->sects - i;
+		len = n * DEFAULT_SECTOR_SIZE;
+		fd = (len % BUFFER_ALIGN) ? r->fd_tail : r->fd;
+
+		if ((i / PROGRESS_SECTS) != ((i + n - 1) / PROGRESS_SECTS) ||
+		    !(i % PROGRESS_SECTS)) {
+			pthread_mutex_lock(&print_lock);
+			printf("%s sector %llu of %llu\n",
+			       r->write ? "Writing" : "Verifying",
+			       (i + n - 1) / PROGRESS_SECTS * PROGRESS_SECTS, r->sects);
+			pthread_mutex_unlock(&print_lock);
+		}
+
+		if (r->write) {
+			if (run_id)
+				fill_ext_sectors(buf, i, n);
+			else
+				fill_sectors(buf, i, n);
+			if (pio(fd, 1, buf, len, (off_t)i * DEFAULT_SECTOR_SIZE)) {
+				fprintf(stderr, "\nWrite failed %llu (%d)\n", i, errno);
+				r->ret = -1;
+				break;
+			}
+		} else {
+			if (pio(fd, 0, buf, len, (off_t)i * DEFAULT_SECTOR_SIZE)) {
+				fprintf(stderr, "\nRead failed %llu (%d)\n", i, errno);
+				r->ret = -1;
+				break;
+			}
+			if (run_id) {
+				/* Goes on to count all the bad sectors */
+				if (check_ext_sectors(buf, i, n, r->bad))
+					r->ret = 1;
+			} else {
+				r->ret = check_sectors(buf, i, n);
+				if (r->ret)
+					break;
+			}
+		}
+		r->done += n;
+		/* A resume starts over from the first bad chunk */
+		if (!r->ret)
+			r->done_chunks++;
+	}
+
+	if (r->ret && !(run_id && r->ret == 1))
+		stop_workers = 1;
+	free(buf);
+	worker_finished();
+	return NULL;
+}
+
+/* xorshift64*, so that a seed picks the same chunks on every build */
+static unsigned long long next_random(unsigned long long *state)
+{
+	*state ^= *state >> 12;
+	*state ^= *state << 25;
+	*state ^= *state >> 27;
+	return *state * 2685821657736338717ULL;
+}
+
+/*
+ * Picks count of the nchunks chunks uniformly at random, returned in
+ * ascending order (selection sampling, Knuth's algorithm S).
+ */
+unsigned long long *sample_chunks(unsigned long long nchunks,
+				  unsigned long long count, unsigned long long seed)
+{
+	unsigned long long *chunks, state, c, picked = 0;
+
+	chunks = malloc(count * sizeof(unsigned long long));
+	if (!chunks)
+		return NULL;
+	state = seed ? seed : 1;
+	for (c = 0; c < nchunks && picked < count; c++) {
+		/* (nchunks - c) * U < count - picked, U uniform in [0, 1) */
+		if ((next_random(&state) >> 11) * (double)(nchunks - c) <
+		    (double)(count - picked) * 9007199254740992.0)
+			chunks[picked++] = c;
+	}
+	return chunks;
+}
+
+/* Number of chunks covered by a sample given as a fraction (0.05) or as
+ * a byte budget with an optional K, M, G or T suffix (100G) */
+unsigned long long sample_count(const char *spec, unsigned long long nchunks,
+				unsigned long buffer_sects)
+{
+	unsigned long long bytes, count;
+	double value;
+	char *end;
+
+	value = strtod(spec, &end);
+	if (end == spec || value <= 0)
+		return 0;
+	if (!*end && value <= 1) {
+		count = (unsigned long long)(value * nchunks);
+		if (count < value * nchunks)
+			count++;
+	} else {
+		/* Scaled before the conversion so 0.5G is 512 MiB */
+		switch (*end) {
+		case 'T': case 't': value *= 1024;	/* fall through */
+		case 'G': case 'g': value *= 1024;	/* fall through */
+		case 'M': case 'm': value *= 1024;	/* fall through */
+		case 'K': case 'k': value *= 1024;	/* fall through */
+		case '\0': break;
+		default: return 0;
+		}
+		bytes = (unsigned long long)value;
+		count = (bytes + buffer_sects * DEFAULT_SECTOR_SIZE - 1) /
+			(buffer_sects * DEFAULT_SECTOR_SIZE);
+	}
+	if (count < 1)
+		count = 1;
+	if (count > nchunks)
+		count = nchunks;
+	return count;
+}
+
+/*
+ * Writes or verifies the pattern with nthreads workers, a chunk of
+ * buffer_sects at a time. Each worker covers a contiguous run of the
+ * chunks of the whole device, or of the sampled chunks when sample is
+ * given. The on-disk format is the same as write_testpattern. With a
+ * checkpoint file the progress is saved every CHECKPOINT_INTERVAL seconds
+ * and a run interrupted earlier is resumed.
+ */
+int run_regions(int fd, int fd_tail, struct fd_state *state, int write,
+		int nthreads, unsigned long buffer_sects, const char *sample,
+		unsigned long long seed, const char *checkpoint)
+{
+	struct region *regions;
+	unsigned long long sects, nchunks, count, per, first, done = 0;
+	unsigned long long *chunks = NULL;
+	double start_time, elapsed, bound;
+	int i, c, nregions, synced, started = 0, ret = 0;
+	unsigned long long bad[SECT_CLASSES];
+	unsigned long long progress[MAX_THREADS];
+	struct timespec wake;
+	struct timeval tv;
+	char key[256];
+
+	sects = state->size_sects;
+	nchunks = (sects + buffer_sects - 1) / buffer_sects;
+	count = nchunks;
+	if (sample) {
+		count = sample_count(sample, nchunks, buffer_sects);
+		if (!count) {
+			fprintf(stderr, "\nInvalid sample %s\n", sample);
+			return -1;
+		}
+		chunks = sample_chunks(nchunks, count, seed);
+		if (!chunks) {
+			fprintf(stderr, "\nMalloc failed\n");
+			return -1;
+		}
+	}
+	per = (count + nthreads - 1) / nthreads;
+
+	regions = calloc(nthreads, sizeof(struct region));
+	if (!regions) {
+		fprintf(stderr, "\nMalloc failed\n");
+		free(chunks);
+		return -1;
+	}
+
+	for (nregions = 0, first = 0; nregions < nthreads && first < count;
+	     nregions++, first += per) {
+		regions[nregions].fd = fd;
+		regions[nregions].fd_tail = fd_tail;
+		regions[nregions].write = write;
+		regions[nregions].chunks = chunks;
+		regions[nregions].first = first;
+		regions[nregions].count = first + per < count ? per : count - first;
+		regions[nregions].sects = sects;
+		regions[nregions].buffer_sects = buffer_sects;
+	}
+
+	snprintf(key, sizeof(key), "%s %llu %llu %s %llu %lu %d %llx\n",
+		 write ? "write" : "verify", iter, seed, sample ? sample : "-",
+		 nchunks, buffer_sects, nregions, id_hash);
+	if (checkpoint) {
+		switch (load_checkpoint(checkpoint, key, regions, nregions)) {
+		case 1:
+			printf("%s already completed according to checkpoint %s\n",
+			       write ? "Write" : "Verify", checkpoint);
+			free(regions);
+			free(chunks);
+			return 0;
+		case 0:
+			for (i = 0, first = 0; i < nregions; i++)
+				first += regions[i].done_chunks;
+			printf("Resuming from checkpoint %s, %llu of %llu chunks done\n",
+			       checkpoint, first, count);
+			break;
+		}
+	}
+
+	memset(bad, 0, sizeof(bad));
+	start_time = now();
+	stop_workers = 0;
+	finished_workers = 0;
+	for (i = 0; i < nregions; i++) {
+		if (pthread_create(&regions[i].thread, NULL, region_worker, &regions[i])) {
+			fprintf(stderr, "\nUnable to start worker %d\n", i);
+			stop_workers = 1;
+			ret = -1;
+			break;
+		}
+		started++;
+	}
+
+	pthread_mutex_lock(&finished_lock);
+	while (finished_workers < started) {
+		gettimeofday(&tv, NULL);
+		wake.tv_sec = tv.tv_sec + CHECKPOINT_INTERVAL;
+		wake.tv_nsec = tv.tv_usec * 1000;
+		if (pthread_cond_timedwait(&finished_cond, &finished_lock, &wake) != ETIMEDOUT ||
+		    !checkpoint)
+			continue;
+		pthread_mutex_unlock(&finished_lock);
+		/* The chunks counted as written must be on disk first */
+		snapshot_progress(regions, nregions, progress);
+		if (!write || !sync_pattern(fd, fd_tail))
+			save_checkpoint(checkpoint, key, progress, nregions, 0);
+		pthread_mutex_lock(&finished_lock);
+	}
+	pthread_mutex_unlock(&finished_lock);
+
+	for (i = 0; i < started; i++) {
+		pthread_join(regions[i].thread, NULL);
+		done += regions[i].done;
+		for (c = 0; c < SECT_CLASSES; c++)
+			bad[c] += regions[i].bad[c];
+		if (!ret || regions[i].ret < 0)
+			ret = regions[i].ret;
+	}
+	if (run_id && !write && ret >= 0) {
+		/* Stale sectors alone only mean lost writes */
+		if (bad[SECT_TORN] || bad[SECT_MISDIRECTED] || bad[SECT_CORRUPTED])
+			ret = 1;
+		else if (bad[SECT_STALE])
+			ret = 2;
+		else
+			ret = 0;
+		fprintf(ret ? stderr : stdout, "%sBad sectors: %llu torn, %llu stale, %llu misdirected, %llu corrupted\n",
+			ret ? "\n" : "", bad[SECT_TORN], bad[SECT_STALE], bad[SECT_MISDIRECTED], bad[SECT_CORRUPTED]);
+	}
+
+	snapshot_progress(regions, nregions, progress);
+	synced = !write || !sync_pattern(fd, fd_tail);
+	if (!synced)
+		ret = -1;
+	/* A failed run still records how far it got */
+	if (checkpoint && started == nregions && synced)
+		save_checkpoint(checkpoint, key, progress, nregions, !ret);
+	free(regions);
+	free(chunks);
+
+	elapsed = now() - start_time;
+	printf("%s %llu sectors with %d workers in %.1f seconds, %.1f MB/s\n",
+	       write ? "Wrote" : "Verified", done, started, elapsed,
+	       elapsed > 0 ? done * DEFAULT_SECTOR_SIZE / 1048576.0 / elapsed : 0.0);
+	if (sample) {
+		printf("Sampled %llu of %llu chunks of %lu KiB, coverage %.4f%%, seed %llu\n",
+		       count, nchunks, buffer_sects * DEFAULT_SECTOR_SIZE / 1024,
+		       100.0 * count / nchunks, seed);
+		if (!write && !ret) {
+			/* No bad chunk among count drawn: with 95% confidence
+			 * fewer than bound of all chunks are bad, as
+			 * (1 - bound)^count = 0.05. Drawing without
+			 * replacement only makes this bound conservative. */
+			bound = count < nchunks ? 1 - pow(0.05, 1.0 / count) : 0;
+			printf("Confidence: 95%% that fewer than %.4f%% of the chunks "
+			       "(%llu of %llu) are corrupt\n", 100 * bound,
+			       (unsigned long long)(bound * nchunks), nchunks);
+		}
+	}
+	return ret;
+}
+
 int main(int argc, char *argv[])
 {
-	int fd = 0, retval = 0;
+	int fd = 0, fd_tail = -1, retval = 0, c;
 	int o_flags = O_LARGEFILE;
 	struct fd_state *state = calloc(sizeof(struct fd_state),1);
 	int writeEstimate = 0;
 	int verifyEstimate = 0;
+	int buffered;
+
+	while ((c = getopt(argc, argv, "t:b:ds:e:c:i:")) != -1) {
+		switch (c) {
+		case 't':
+			threads = atoi(optarg);
+			if (threads < 1 || threads > MAX_THREADS) {
+				fprintf(stderr, "\nThreads must be 1 to %d\n", MAX_THREADS);
+				return 1;
+			}
+			break;
+		case 'b':
+			buffer_mb = strtoul(optarg, NULL, 10);
+			if (buffer_mb < 1 || buffer_mb > MAX_BUFFER_MB) {
+				fprintf(stderr, "\nBuffer must be 1 to %d MiB\n", MAX_BUFFER_MB);
+				return 1;
+			}
+			break;
+		case 'd':
+			direct = 1;
+			break;
+		case 's':
+			sample = optarg;
+			break;
+		case 'e':
+			seed = strtoull(optarg, NULL, 10);
+			break;
+		case 'c':
+			checkpoint = optarg;
+			break;
+		case 'i':
+			run_id = optarg;
+			break;
+		default:
+			usage(argv[0]);
+		}
+	}
+	buffered = threads || buffer_mb || direct || sample || checkpoint || run_id;
+	if (run_id) {
+		crc32c_init();
+		id_hash = hash_id(run_id);
+	}
+	if (!threads)
+		threads = 1;
+	if (!buffer_mb)
+		buffer_mb = DEFAULT_BUFFER_MB;
 
 	printf("into the file at least.\n");
-	if (argc != 4)
+	if (argc - optind != 3)
 		usage(argv[0]);
+	argv += optind - 1;
 
 	iter = strtoull(argv[2],NULL,10);
 
-	if (!strcmp(argv[1],"write")) {
-		fd = open(argv[3], O_RDWR | o_flags);
+	if (!strcmp(argv[1],"write") || !strcmp(argv[1],"verify")) {
+		int write = !strcmp(argv[1],"write");
+		int mode = write ? O_RDWR : O_RDONLY;
+
+		fd = open(argv[3], mode | o_flags | (direct ? O_DIRECT : 0));
 		if (fd == -1) {
 			fprintf(stderr,"\nUnable to open [%s], (err %d)!\n",argv[3],0 - errno);
 			return 1;
 		}
 		if (getsize(fd, state)!=0)
 			return -1;
-		retval = write_testpattern(fd, state, 0, NULL);
-	} else if (!strcmp(argv[1],"verify")) {
-		fd = open(argv[3], O_RDONLY | o_flags);
-		if (fd == -1) {
-			fprintf(stderr,"\nUnable to open [%s], (err %d)!\n",argv[3],0 - errno);
-			return 1;
+		if (!buffered) {
+			if (write)
+				retval = write_testpattern(fd, state, 0, NULL);
+			else
+				retval = verify_testpattern(fd, state, 0, NULL);
+		} else {
+			fd_tail = fd;
+			if (direct) {
+				fd_tail = open(argv[3], mode | o_flags);
+				if (fd_tail == -1) {
+					fprintf(stderr,"\nUnable to open [%s], (err %d)!\n",argv[3],0 - errno);
+					return 1;
+				}
+			}
+			retval = run_regions(fd, fd_tail, state, write, threads,
+					     buffer_mb * 1048576 / DEFAULT_SECTOR_SIZE,
+					     sample, seed, checkpoint);
+			if (fd_tail != fd)
+				close(fd_tail);
 		}
-		if (getsize(fd, state)!=0)
-			return -1;
-		retval = verify_testpattern(fd, state, 0, NULL);
 	} else if (!strcmp(argv[1],"report")) 
 		{			
 			fd = open(argv[3], O_RDWR | o_flags);